@@ -7,80 +7,136 @@ os.environ['HF_HOME'] = config.HF_HOME
 import argparse
 import copy
 import json
-import pandas as pd
 import sys
 import random
+import time
 from tqdm import tqdm
 
-from parse_string import LlamaParser
-from agents import AgentAction, HuggingfaceChatbot
+from parse_string import LlamaParser, MCQ_ANSWER_PREFIX, MCQ_CHOICES
+from agents.cache import get_response_cache
+from agents import AgentAction, HuggingfaceChatbot, FakeChatbot
 from utils import *
+from results import ResultWriter, case_record, config_hash, load_checkpoint
+from work_queue import WorkQueue
 import random
-import numpy as np
-import torch
 
 from datasets import Dataset
 from datasets import load_dataset, load_from_disk
 import config
 HF_MCQ_path = config.HF_MCQ_path
+STRATEGY = 'mcq'
 dataset_dict = {
     "hard": load_from_disk(os.path.join(HF_MCQ_path, f'MCQ_dict_hard')),
     "easy": load_from_disk(os.path.join(HF_MCQ_path, f'MCQ_dict_easy')),
     "medium": load_from_disk(os.path.join(HF_MCQ_path, f'MCQ_dict_medium'))
 }
-def set_seeds(args):
-    random.seed(args.seed)
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
+def set_seeds(args, seed=None):
+    seed = args.seed if seed is None else seed
+    random.seed(seed)
+    ### numpy and torch are only needed (and imported) for local models
+    if not args.api_name and args.model != 'fake':
+        import numpy as np
+        import torch
+        np.random.seed(seed)
+        torch.manual_seed(seed)
 
 
 
 
 def main(args):
+    ### a shard runs every N-th question with its own log and results files, merged by launch_shards.py
+    shard = parse_shard(args.shard)
+    args.log_path = shard_path(args.log_path, shard)
     set_seeds(args)
+    config_id = config_hash(args)
     log(str(args),args.log_path)
     dataset = dataset_dict[args.strategy]
     if args.api_name:
         chatbot = ''
+    elif args.model == 'fake':
+        ### offline backend to benchmark the pipeline without a model
+        chatbot = FakeChatbot(latency=args.fake_latency, failure_rate=args.fake_failure_rate, seed=args.seed)
     else:    
-        chatbot = HuggingfaceChatbot(args.model)
+        chatbot = HuggingfaceChatbot(args.model, prefix_cache=args.prefix_cache)
     agents = AgentAction(chatbot, 
                          parser_fn = LlamaParser().parse_MCQ,
                          template = args.prompt_template,
                          **vars(args))
     result_save_path = args.log_path.replace('.txt', '_results.txt')
+    ### one structured record per question, the text log only keeps the run arguments and the accuracies
+    results_path = shard_path(args.results_path, shard) if args.results_path else args.log_path.replace('.txt', '.jsonl')
+    ### the records of a previous run with the same config are its checkpoint, the --sample draw only depends on the seed
+    checkpoint = {} if args.no_resume or args.queue_path else load_checkpoint(results_path, STRATEGY, config_id)
+    ### with --queue_path the workers of a run lease their cases from a shared SQLite queue and write their records to it
+    queue = WorkQueue(args.queue_path, STRATEGY, config_id, args.lease_seconds) if args.queue_path else None
+    writer = queue or ResultWriter(results_path)
+    ### the logits mode does not sample
+    batch_size = seeded_batch_size(args, agents, args.mode == 'generate' and bool(shard or checkpoint or queue))
 
     results = []
     # for domain in ['AI_ACT', 'GDPR', 'HIPAA']:
     # for domain in ['GDPR', 'HIPAA']:
-    for domain in ['HIPAA', 'GDPR']:
-        domain_dataset = [item for item in dataset if item.get("domain") == domain]
+    domains = ['HIPAA', 'GDPR']
+    ### the --sample draws are made before the batches reseed, so that every shard draws the same questions
+    domain_datasets = {}
+    for domain in domains:
+        domain_datasets[domain] = [item for item in dataset if item.get("domain") == domain]
         if args.sample:
-            domain_dataset = random.sample(domain_dataset, min(len(domain_dataset), args.sample))
-        for i, item in enumerate(tqdm(domain_dataset)):
-            label = item['label']
-            decision = {}
-            log(str(f"=== domain: {domain} --- case: {i}\n"), args.log_path)
-            for _ in range(args.generation_round):
-                try:
-                    decision = agents.complete(**item)           
-                    result = (decision["decision"] == label)
-                    results.append(result)
-                    acc = (sum(results) / len(results))
-                    print(acc)
-                    log(str(f"sample_id: {i} --- result:{result} --- answer: {decision['decision']}\n"), args.log_path)
-                    log(str(decision)+"\n", args.log_path)
-                    if decision: break
+            domain_datasets[domain] = random.sample(domain_datasets[domain],
+                                                    min(len(domain_datasets[domain]), args.sample))
+    for domain in domains:
+        domain_dataset = domain_datasets[domain]
+        domain_start = len(results)
+        completed = checkpoint.get(domain, {})
+        if completed:
+            print(f'resuming {domain}: {len(completed)} questions already completed')
+        ### feed the questions to the agent in micro-batches of args.batch_size
+        ids = shard_cases(len(domain_dataset), shard)
+        batches = queue.batches(domain, ids, batch_size) if queue else \
+            [ids[start:start + batch_size] for start in range(0, len(ids), batch_size)]
+        for case_ids in tqdm(batches):
+            ### questions completed by an interrupted run with the same config are not asked again
+            batch_ids = [i for i in case_ids if i not in completed]
+            batch_start = time.time()
+            decisions = []
+            if batch_ids:
+                ### seeded by its first question, per question when seeded_batch_size runs the questions one by one
+                set_seeds(args, case_seed(args.seed, domain, batch_ids[0]))
+            if batch_ids and args.mode == 'logits':
+                ### one forward pass per micro-batch, the option is read from the next-token logits
+                decisions = agents.choose_batch([domain_dataset[i] for i in batch_ids], MCQ_CHOICES, MCQ_ANSWER_PREFIX)
+            elif batch_ids:
+                decisions = agents.complete_batch([domain_dataset[i] for i in batch_ids], args.generation_round)
 
-                except Exception as e:
-                    print(e)
+            seconds = (time.time() - batch_start) / max(len(batch_ids), 1)
+
+            outputs = dict(zip(batch_ids, decisions))
+            for i in case_ids:
+                if i in completed:
+                    results.append(completed[i])
                     continue
-            if not decision: results.append(0)
+                decision = outputs[i]
+                label = domain_dataset[i]['label']
+                result = not isinstance(decision, Exception) and decision["decision"] == label
+                results.append(result)
+                writer.write(case_record(domain, i, STRATEGY, label, decision, result, seconds,
+                                         agents.template.format(**domain_dataset[i]), agents.token_counter, config_id))
+                acc = (sum(results) / len(results))
+                print(acc)
+            writer.flush()
 
+        if queue:
+            ### the accuracy of the whole run, over the questions of every worker
+            results[domain_start:] = [record["correct"] for record in queue.records(domain)]
         acc = (sum(results) / len(results))
         print(acc)
-        log(str(f"domain: {domain} --- num_sample: {len(dataset)} --- accuracy:{acc}\n"), args.log_path)
-        log(str(f"domain: {domain} --- num_sample: {len(dataset)} --- accuracy:{acc}\n"), result_save_path)
+        log(str(f"domain: {domain} --- num_sample: {len(ids)} --- accuracy:{acc}\n"), args.log_path)
+        log(str(f"domain: {domain} --- num_sample: {len(ids)} --- accuracy:{acc}\n"), result_save_path)
+    if queue:
+        log(str(f"work queue: {queue.stats()}\n"), args.log_path)
+    writer.close()
+    if args.cache_path:
+        log(str(f"response cache: {get_response_cache(args.cache_path).stats()}\n"), args.log_path)
 
 
 if __name__ == '__main__':
@@ -88,6 +144,15 @@ if __name__ == '__main__':
     #parser.add_argument("--model", type=str, default="meta-llama/Llama-3.1-8B-Instruct")
     parser.add_argument("--model", type=str, default="")
     parser.add_argument("--log_path", type=str, default="logs/MCQ_log.txt")
+    ### JSONL (or .jsonl.zst) of the per-question records, next to the log by default
+    parser.add_argument("--results_path", type=str, default='')
+    ### rerun the questions already in --results_path instead of resuming from them
+    parser.add_argument("--no_resume", action="store_true")
+    ### "i/N": run only the i-th of N interleaved shards of the questions, see launch_shards.py
+    parser.add_argument("--shard", type=str, default='')
+    ### SQLite work queue shared by the workers of a run, see work_queue.py
+    parser.add_argument("--queue_path", type=str, default='')
+    parser.add_argument("--lease_seconds", type=float, default=config.QUEUE_LEASE_SECONDS)
     parser.add_argument("--strategy", type=str, default='medium')
     parser.add_argument("--prompt_template", type=str, default="prompts/MCQ_template.txt")
     parser.add_argument("--max_new_tokens", type=int, default=1024)
@@ -95,13 +160,29 @@ if __name__ == '__main__':
     parser.add_argument("--generation_round", type=int, default=10)
     parser.add_argument("--max_law_items", type=int, default=2)
     parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--fake_latency", type=float, default=0.0)
+    parser.add_argument("--fake_failure_rate", type=float, default=0.0)
     parser.add_argument("--api_name", type=str, default='')
     ### newly appeneded
     # parser.add_argument("--domains", type=str, default='AI_ACT')
     parser.add_argument("--api_model", type=str, default=config.api_model)
     parser.add_argument("--api_token", type=str, default=config.api_key)
+    parser.add_argument("--api_base_url", type=str, default=config.api_base_url)
+    parser.add_argument("--api_concurrency", type=int, default=1)
+    parser.add_argument("--api_rpm", type=int, default=0)
+    parser.add_argument("--api_tpm", type=int, default=0)
     parser.add_argument("--max_retry", type=int, default=5)
+    parser.add_argument("--retry_budget", type=int, default=-1)
+    parser.add_argument("--cache_path", type=str, default='')
+    parser.add_argument("--cache_size", type=int, default=config.RESPONSE_CACHE_SIZE)
+    parser.add_argument("--batch_size", type=int, default=1)
     parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument("--early_stop", action="store_true")
+    parser.add_argument("--prefix_cache", action="store_true")
     parser.add_argument("--sample", type=int, default=0)
+    ### generate: chain-of-thought generation; logits: answer from the next-token logits of the option letters (local models)
+    parser.add_argument("--mode", type=str, default='generate', choices=['generate', 'logits'])
     args = parser.parse_args()
+    if args.mode == 'logits' and args.api_name:
+        parser.error("--mode logits reads the logits of a local model, use --mode generate with --api_name")
     main(args)
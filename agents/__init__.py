@@ -1,3 +1,22 @@
-from agents.chatbot import HuggingfaceChatbot
-from agents.agents import AgentAction, AgentSearch, AgentsIdSearch, AgentTrieSearch, AgentContentSearch, AgentEmbSearch
+import importlib
 
+### submodules are imported on first use: `agents.bm25` or `agents.cache` do not pull in openai,
+### and torch / transformers are only loaded once a HuggingfaceChatbot is created
+_exports = {
+    'HuggingfaceChatbot': 'agents.chatbot',
+    'FakeChatbot': 'agents.fake_chatbot',
+    'AgentAction': 'agents.agents',
+    'AgentSearch': 'agents.agents',
+    'AgentsIdSearch': 'agents.agents',
+    'AgentTrieSearch': 'agents.agents',
+    'AgentContentSearch': 'agents.agents',
+    'AgentEmbSearch': 'agents.agents',
+}
+
+def __getattr__(name):
+    if name in _exports:
+        return getattr(importlib.import_module(_exports[name]), name)
+    raise AttributeError(f"module 'agents' has no attribute '{name}'")
+
+def __dir__():
+    return sorted(list(globals()) + list(_exports))
@@ -2,54 +2,131 @@ import copy
 import sys
 import os
 #sys.path.append("../")
-from agents.bm25 import BM25
-from utils import Trie, list_intersection
+from agents.kb_artifact import build_search_index
+from agents.packer import get_token_counter, pack_references
+from agents.cache import get_response_cache
+from agents.async_client import AsyncOpenAI_model
+from agents.retry import CompletionFailure, RetryBudget, RetryPolicy
+from utils import Trie, VoteAggregator, list_intersection
 import json
-import requests
-import openai
+import math
 from openai import OpenAI
 import time
 import random
-from config import MAX_REFERENCE_NUM
+import re
+import string
+import threading
+from parse_string import get_stop_pattern, get_decision_choices
+from config import DECISION_REFERENCE_TOKENS, MAX_REFERENCE_NUM, RESPONSE_CACHE_SIZE
+
+def read_stream(stream, stop_pattern):
+    ### read a streamed completion, closing the stream once the answer block matched stop_pattern
+    pattern = re.compile(stop_pattern, re.IGNORECASE)
+    msg = ''
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            msg += chunk.choices[0].delta.content
+            if pattern.search(msg):
+                break
+    stream.close()
+    return msg
 
 class OpenAI_model:
-    def __init__(self, api_key: str, api_name: str):
+    def __init__(self, api_key: str, api_name: str, base_url: str = None, retry_policy: RetryPolicy = None):
         self.api_key = api_key
         self.api_name = api_name
+        ### retries are handled by retry_policy only, not again inside the client
         if(api_name == 'deepseek'):
             ### using deepseek r1 model from ARK API
             print('using ARK API to respond via deepseek r1...')
             self.client = OpenAI(
                 api_key = self.api_key,
                 base_url = "https://ark.cn-beijing.volces.com/api/v3",
+                max_retries = 0,
             )
         else:
             self.client = OpenAI(
-                api_key=self.api_key
+                api_key=self.api_key,
+                base_url=base_url or None,
+                max_retries=0
             )
+        self.retry_policy = retry_policy or RetryPolicy()
 
-    def compeletion(self, model: str, messages: list, max_retries: int, **kwargs):
-        retries = 0
-        while retries < max_retries:
-            try:
-                if(self.api_name == 'deepseek'):
-                    model = 'ep-20250208151949-2c29b'
-                response = self.client.chat.completions.create(
+    def compeletion(self, model: str, messages: list, max_retries: int, stop_pattern: str = None, **kwargs):
+        '''
+        Returns the response message, or a CompletionFailure once the retry policy gives up.
+        stop_pattern: regex, the response is streamed and the stream closed as soon as it matches
+        '''
+        if(self.api_name == 'deepseek'):
+            model = 'ep-20250208151949-2c29b'
+
+        def request():
+            if stop_pattern:
+                stream = self.client.chat.completions.create(
                     model = model,
                     messages=messages,
+                    stream=True,
                     **kwargs
                 )
-                msg = response.choices[0].message.content
-                assert isinstance(msg, str), "The retruned response is not a string."
-                return msg  # Return the response if successful
+                return read_stream(stream, stop_pattern)
+            response = self.client.chat.completions.create(
+                model = model,
+                messages=messages,
+                **kwargs
+            )
+            msg = response.choices[0].message.content
+            assert isinstance(msg, str), "The retruned response is not a string."
+            return msg
+
+        return self.retry_policy.call(request, max_retries)
+
+    def compeletion_n(self, model: str, messages: list, max_retries: int, n: int, **kwargs):
+        '''
+        Returns n sampled response messages from a single request (the prompt is prefilled once),
+        or a CompletionFailure once the retry policy gives up.
+        '''
+        if(self.api_name == 'deepseek'):
+            model = 'ep-20250208151949-2c29b'
+
+        def request():
+            response = self.client.chat.completions.create(
+                model = model,
+                messages=messages,
+                n=n,
+                **kwargs
+            )
+            msgs = [choice.message.content for choice in response.choices]
+            assert len(msgs) == n and all(isinstance(msg, str) for msg in msgs), "The retruned responses are not n strings."
+            return msgs
+
+        return self.retry_policy.call(request, max_retries)
+
+_api_models = {}
+
+def get_api_model(api_key, api_name, base_url='', concurrency=1, requests_per_minute=0, tokens_per_minute=0,
+                  retry_budget=-1):
+    '''
+    The agents of a run share one api client, so that the concurrency, rate limits and retry budget hold for the whole run.
+    '''
+    key = (api_key, api_name, base_url, concurrency, requests_per_minute, tokens_per_minute, retry_budget)
+    if key not in _api_models:
+        retry_policy = RetryPolicy(budget=RetryBudget(retry_budget))
+        if concurrency > 1 or requests_per_minute or tokens_per_minute:
+            _api_models[key] = AsyncOpenAI_model(api_key, api_name, base_url, concurrency,
+                                                 requests_per_minute, tokens_per_minute, retry_policy)
+        else:
+            _api_models[key] = OpenAI_model(api_key=api_key, api_name=api_name, base_url=base_url,
+                                            retry_policy=retry_policy)
+    return _api_models[key]
+
+def softmax(scores):
+    top = max(scores)
+    exps = [math.exp(score - top) for score in scores]
+    return [exp / sum(exps) for exp in exps]
+
+### template fields that do not change from case to case, they belong to the reusable prompt prefix
+STATIC_FIELDS = ('domain', 'generated_num', 'look_up_pool_size', 'selected_pool_size')
 
-            except Exception as e:
-                # Catch all other exceptions
-                print(f"Unexpected error: {e}. Retrying in 5 seconds...")
-                retries += 1
-                time.sleep(1)
-        
-        return ''  # Return an empty string if max_retries is exceeded
 
 class AgentAction:
     def __init__(self, chatbot, template, parser_fn, 
@@ -59,10 +136,23 @@ class AgentAction:
                  api_token = None,
                  max_retry = 5,
                  temperature = 0.2,
+                 cache_path = '',
+                 cache_size = RESPONSE_CACHE_SIZE,
+                 api_base_url = '',
+                 api_concurrency = 1,
+                 api_rpm = 0,
+                 api_tpm = 0,
+                 retry_budget = -1,
+                 early_stop = False,
                  **kwargs
                  ):
         '''
         api_name: str, the name of the api (use OpenAI API), if api is empty, use chatbot to respond
+        cache_path: str, the sqlite file of the persistent response cache, if empty, do not cache responses
+        api_concurrency: int, the number of api requests in flight, above 1 the asyncio client is used
+        api_rpm, api_tpm: int, the requests / tokens per minute allowed for the api, 0 for no limit
+        retry_budget: int, the number of api retries shared by the whole run, -1 for no limit
+        early_stop: bool, stop generating once the block read by parser_fn is complete (see parse_string.STOP_PATTERNS)
         '''
         self.api_token = api_token
         self.api_name = api_name
@@ -77,50 +167,336 @@ class AgentAction:
             self.chatbot = chatbot
         else:
             print('using OpenAI API to respond...')
-            self.chatbot = OpenAI_model(api_key=self.api_token, api_name = self.api_name)
+            self.chatbot = get_api_model(self.api_token, self.api_name, api_base_url,
+                                         api_concurrency, api_rpm, api_tpm, retry_budget)
         self.template = self.load_template(template)
         self.parse_fn = parser_fn
         self.max_new_tokens = max_new_tokens
+        self.stop_pattern = get_stop_pattern(parser_fn) if early_stop else None
+        self.cache = get_response_cache(cache_path, cache_size) if cache_path else None
+        self.token_counter = get_token_counter(self.chatbot, self.api_model if self.api_name else '')
+        ### prompts sent to the model (cache hits are free), shared by the threads of a run
+        self.num_requests = 0
+        self.lock = threading.Lock()
+        ### content-free label distributions of the score decision mode, computed once under priors_lock
+        self.priors = {}
+        self.priors_lock = threading.Lock()
+
+    def count_requests(self, num):
+        with self.lock:
+            self.num_requests += num
 
     def load_template(self, path):
         with open(path, "r", encoding="utf-8") as f:
             template = f.read()
         return template
 
+    def get_prefix(self, **kwargs):
+        '''
+        The template rendered up to its first case-specific field, shared by every case of the run.
+        '''
+        prefix = ''
+        for literal, field, spec, conversion in string.Formatter().parse(self.template):
+            prefix += literal
+            if field is None:
+                break
+            if field not in STATIC_FIELDS or field not in kwargs:
+                break
+            prefix += format(kwargs[field], spec)
+        return prefix
+
+    def respond(self, message, prefix=None):
+        return self.respond_batch([message], [prefix])[0]
+
+    def respond_batch(self, messages, prefixes=None):
+        '''
+        Respond to a list of rendered prompts, serving what is already in the response cache from disk.
+        prefixes: list of str, the static template prefix of each prompt, used by the HF prefix cache
+        '''
+        responses = [None] * len(messages)
+        keys = [None] * len(messages)
+        if self.cache is not None:
+            model = self.api_model if self.api_name else getattr(self.chatbot, 'model_name', '')
+            for idx, message in enumerate(messages):
+                keys[idx] = self.cache.make_key(self.api_name or 'hf', model, message,
+                                                max_new_tokens=self.max_new_tokens,
+                                                temperature=self.temperature,
+                                                stop_pattern=self.stop_pattern)
+                responses[idx] = self.cache.get(keys[idx])
+
+        missed = [idx for idx, response in enumerate(responses) if response is None]
+        self.count_requests(len(missed))
+        if missed:
+            if(not self.api_name):
+                ### HF models
+                ##msg will be stripped inside the respond function
+                generated = self.chatbot.respond_batch([messages[idx] for idx in missed], self.max_new_tokens,
+                                                       self.stop_pattern,
+                                                       [prefixes[idx] for idx in missed] if prefixes else None)
+            elif hasattr(self.chatbot, 'compeletion_batch'):
+                ### dispatch the whole batch to the asyncio client at once
+                generated = self.chatbot.compeletion_batch(self.api_model,
+                                                           [self.api_messages(messages[idx]) for idx in missed],
+                                                           self.max_retry, self.stop_pattern)
+            else:
+                generated = [self.api_respond(messages[idx]) for idx in missed]
+            for idx, response in zip(missed, generated):
+                responses[idx] = response
+                ### failed api calls are not cached
+                if self.cache is not None and not isinstance(response, CompletionFailure):
+                    self.cache.put(keys[idx], response)
+        return responses
+
+    def is_deterministic(self):
+        '''
+        Whether the same prompt always gets the same response, so that repeated voting rounds can be collapsed.
+        The api is sampled with the provider's default temperature and never counts as deterministic.
+        '''
+        if self.api_name:
+            return False
+        return getattr(self.chatbot, 'is_deterministic', lambda: False)()
+
+    def respond_n(self, message, n, prefix=None):
+        '''
+        n sampled responses to the same prompt, the samples missing from the response cache come from
+        one request (generate(num_return_sequences-like) for HF models, n=N for the api) sharing the prefill.
+        '''
+        responses = [None] * n
+        keys = [None] * n
+        if self.cache is not None:
+            model = self.api_model if self.api_name else getattr(self.chatbot, 'model_name', '')
+            for idx in range(n):
+                keys[idx] = self.cache.make_key(self.api_name or 'hf', model, message,
+                                                max_new_tokens=self.max_new_tokens,
+                                                temperature=self.temperature,
+                                                stop_pattern=self.stop_pattern)
+                responses[idx] = self.cache.get(keys[idx])
+
+        missed = [idx for idx, response in enumerate(responses) if response is None]
+        self.count_requests(len(missed))
+        if not missed:
+            return responses
+        try:
+            generated = self.sample_n(message, len(missed), prefix)
+        except Exception as e:
+            print(e)
+            ### the votes are sampled one at a time, a failing call only loses its own vote
+            generated = []
+            for _ in missed:
+                try:
+                    generated += self.sample_n(message, 1, prefix)
+                except Exception as e:
+                    print(e)
+                    generated.append(e)
+        for idx, response in zip(missed, generated):
+            responses[idx] = response
+            if self.cache is not None and not isinstance(response, Exception):
+                self.cache.put(keys[idx], response)
+        return responses
+
+    def sample_n(self, message, n, prefix=None):
+        ### n responses to message from the backend, a CompletionFailure of the api stands for each of them
+        if(not self.api_name):
+            generated = self.chatbot.respond_n(message, n, self.max_new_tokens, self.stop_pattern, prefix)
+        elif hasattr(self.chatbot, 'compeletion_n'):
+            generated = self.chatbot.compeletion_n(self.api_model, self.api_messages(message), self.max_retry, n)
+        else:
+            generated = [self.api_respond(message) for _ in range(n)]
+        if isinstance(generated, CompletionFailure):
+            generated = [generated] * n
+        return generated
+
+    def api_messages(self, message):
+        message = message.replace("Assistant:", "").strip()
+        # message_list = [
+        #     {"role": "system", "content": "You are a helpful assistant."},
+        #     {"role": "user", "content": message}
+        # ]
+        message_list = [
+            {"role": "user", "content": message}
+        ]
+        return message_list
+
+    def api_respond(self, message):
+        ### use api
+        message_list = self.api_messages(message)
+        response = self.chatbot.compeletion(self.api_model, message_list, self.max_retry, self.stop_pattern)# temperature = self.temperature, max_tokens = self.max_new_tokens)
+        return response
+
     def complete(self, **kwargs):
         message = self.template.format(**kwargs)
         # print(message)
-        if(not self.api_name):
-            ### HF models
-            ##msg will be stripped inside the respond function
-            response = self.chatbot.respond(message, self.max_new_tokens)
-            # print(response)
-        else:
-            ### use api
-            message = message.replace("Assistant:", "").strip()
-            # message_list = [
-            #     {"role": "system", "content": "You are a helpful assistant."},
-            #     {"role": "user", "content": message}
-            # ]
-            message_list = [
-                {"role": "user", "content": message}
-            ]
-            
-            response = self.chatbot.compeletion(self.api_model, message_list, self.max_retry,)# temperature = self.temperature, max_tokens = self.max_new_tokens)
+        response = self.respond(message, self.get_prefix(**kwargs))
+        if isinstance(response, CompletionFailure):
+            ### the backend already retried, the callers should not retry again
+            raise response
             
         ## TODO : complete the parsing
         parserd_response = self.parse_fn(response)
         return parserd_response
 
+    def respond_each(self, messages, prefixes=None):
+        '''
+        respond_batch, with the failure of one item kept from the others: when the batch call raises (CUDA OOM,
+        a tokenizer or generate error), the items are responded one at a time and an item whose call raises
+        gets the exception as its response.
+        '''
+        prefixes = prefixes or [None] * len(messages)
+        try:
+            return self.respond_batch(messages, prefixes)
+        except Exception as e:
+            print(e)
+            if len(messages) == 1:
+                return [e]
+        responses = []
+        for message, prefix in zip(messages, prefixes):
+            try:
+                responses.append(self.respond(message, prefix))
+            except Exception as e:
+                print(e)
+                responses.append(e)
+        return responses
+
+    def complete_batch(self, kwargs_list, generation_round=1):
+        '''
+        kwargs_list: list of dict, the template arguments of each item in the micro-batch
+        generation_round: int, the number of attempts for the items whose response cannot be parsed
+        HF chatbots answer the whole micro-batch with one generate call, the asyncio api client sends the
+        requests concurrently and the plain api client answers item by item.
+        Returns the parsed response of each item, or the last raised exception if all its attempts failed.
+        Items whose request failed (a CompletionFailure of the api, an error of the model) are not retried
+        and get the exception, which the drivers score as a wrong answer.
+        '''
+        parserd_responses = [ValueError("Not generated!")] * len(kwargs_list)
+        pending = list(range(len(kwargs_list)))
+        for _ in range(generation_round):
+            if not pending: break
+            messages = [self.template.format(**kwargs_list[idx]) for idx in pending]
+            prefixes = [self.get_prefix(**kwargs_list[idx]) for idx in pending]
+            responses = self.respond_each(messages, prefixes)
+
+            failed = []
+            for idx, response in zip(pending, responses):
+                if isinstance(response, Exception):
+                    parserd_responses[idx] = response
+                    continue
+                try:
+                    parserd_responses[idx] = self.parse_fn(response)
+                except Exception as e:
+                    print(e)
+                    parserd_responses[idx] = e
+                    failed.append(idx)
+            pending = failed
+        return parserd_responses
+
+    def score_batch(self, kwargs_list, calibrate=True):
+        '''
+        Decide a micro-batch of decision prompts by the likelihood of each answer line of the template
+        (parse_string.DECISION_CHOICES) after the prompt: one forward pass, no decoding and no parse failures.
+        calibrate: bool, divide the label probabilities by those of a content-free prompt of the same domain
+                   (every case field set to "N/A"), which removes the prior of the model for each label
+        Returns dicts like parse_decision, with the label distribution in "probs".
+        '''
+        if self.api_name or not hasattr(self.chatbot, 'score_continuations'):
+            raise ValueError("The score decision mode needs a local model.")
+        choices = get_decision_choices(self.template)
+        decisions, continuations = list(choices), list(choices.values())
+        messages = [self.template.format(**kwargs) for kwargs in kwargs_list]
+        self.count_requests(len(messages))
+        scores = self.chatbot.score_continuations(messages, continuations)
+
+        results = []
+        for kwargs, row in zip(kwargs_list, scores):
+            raw = softmax(row)
+            probs = raw
+            if calibrate:
+                prior = self.content_free_prior(kwargs, continuations)
+                probs = softmax([score - math.log(p) for score, p in zip(row, prior)])
+            best = max(range(len(decisions)), key=lambda idx: probs[idx])
+            results.append({"response": continuations[best], "decision": decisions[best],
+                            "probs": dict(zip(decisions, probs)), "raw_probs": dict(zip(decisions, raw))})
+        return results
+
+    def choose_batch(self, kwargs_list, options, answer_prefix=""):
+        '''
+        Answer a micro-batch of multiple choice prompts by the next-token logits of the option letters after
+        answer_prefix, with one forward pass and no decoding.
+        Returns dicts like parse_MCQ, with the option distribution in "probs".
+        '''
+        if self.api_name or not hasattr(self.chatbot, 'score_next_token'):
+            raise ValueError("The logits MCQ mode needs a local model.")
+        messages = [self.template.format(**kwargs) for kwargs in kwargs_list]
+        self.count_requests(len(messages))
+        scores = self.chatbot.score_next_token(messages, options, answer_prefix)
+        results = []
+        for row in scores:
+            probs = softmax(row)
+            best = max(range(len(options)), key=lambda idx: probs[idx])
+            results.append({"response": f"{answer_prefix} {options[best]}", "decision": options[best],
+                            "probs": dict(zip(options, probs))})
+        return results
+
+    def content_free_prior(self, kwargs, continuations):
+        ### label distribution for the template without any case content, computed once per domain
+        content_free = {key: (value if key in STATIC_FIELDS else "N/A") for key, value in kwargs.items()}
+        message = self.template.format(**content_free)
+        ### the threads of a run wait for the first one to score the prior instead of scoring it again
+        with self.priors_lock:
+            if message not in self.priors:
+                self.count_requests(1)
+                self.priors[message] = softmax(self.chatbot.score_continuations([message], continuations)[0])
+            return self.priors[message]
+
+    def complete_n(self, n, generation_round=1, **kwargs):
+        '''
+        n votes on the same prompt, e.g. the law_generation_round / law_filtering_round rounds of the search agents.
+        Under deterministic decoding every vote would be the same response: the prompt is completed once (with
+        generation_round attempts) and its result reused n times. Otherwise the n votes are sampled at once
+        by respond_n and only the unparsable ones are sampled again.
+        Returns the parsed response of each vote, or the last raised exception if all its attempts failed.
+        A vote whose request failed gets the exception, so the callers skip it like an unparsable one.
+        '''
+        if self.is_deterministic():
+            return self.complete_batch([kwargs], generation_round) * n
+
+        message = self.template.format(**kwargs)
+        prefix = self.get_prefix(**kwargs)
+        parserd_responses = [ValueError("Not generated!")] * n
+        pending = list(range(n))
+        for _ in range(generation_round):
+            if not pending: break
+            responses = self.respond_n(message, len(pending), prefix)
+            failed = []
+            for idx, response in zip(pending, responses):
+                if isinstance(response, Exception):
+                    parserd_responses[idx] = response
+                    continue
+                try:
+                    parserd_responses[idx] = self.parse_fn(response)
+                except Exception as e:
+                    print(e)
+                    parserd_responses[idx] = e
+                    failed.append(idx)
+            pending = failed
+        return parserd_responses
+
 class AgentSearch:
-    def __init__(self, kb, agent):
-        self.kb = kb
-        self.trie = self.build_trie()
-        self.kb_keys = list(kb.keys())
-        self.kb_keys = [key.strip() for key in self.kb_keys]
-        self.kb_context = [kb[key]["regulation_content"].strip().replace("\n", " ") for key in self.kb.keys()]
-        corpus = [text.split() for text in self.kb_context]
-        self.bm25 = BM25(corpus)
+    def __init__(self, kb, agent, artifact=None, analyzer='whitespace'):
+        '''
+        artifact: dict, the prebuilt search index of the KB (see agents/kb_artifact.py), built from kb if None
+        analyzer: str, the agents.analyzer.ANALYZERS entry tokenising the KB and the queries for BM25
+        '''
+        if artifact is None:
+            artifact = build_search_index(kb, analyzer)
+        self.kb = artifact["kb"]
+        self.trie = artifact["trie"]
+        self.id_index = artifact["id_index"]
+        self.resolver = artifact["resolver"]
+        self.kb_keys = artifact["kb_keys"]
+        self.kb_context = artifact["kb_context"]
+        self.analyzer = artifact["analyzer"]
+        self.bm25 = artifact["bm25"]
+        self.sparse_bm25 = artifact.get("sparse_bm25")
         self.agent = agent
 
     def build_trie(self):
@@ -131,18 +507,28 @@ class AgentSearch:
         return trie
 
     def look_up_trie(self, id_seq):
-        output = " ".join(self.trie.search_content(id_seq))
+        ### free-form citations are mapped to the canonical id of the regulation id index first
+        id = self.resolver.resolve(id_seq)
+        output = self.id_index.nodes[id]["content"] if id else ""
         if output:
-            content = [f"{id_seq} - {output}"]
+            content = [f"{id} - {output}"]
         else:
             content = []
         return content
 
+    def look_up_ids(self, id_seqs):
+        '''
+        look_up_trie for all the citations parsed from one response, deduplicated by canonical id.
+        '''
+        content = []
+        for id in self.resolver.resolve_response(id_seqs):
+            output = self.id_index.nodes[id]["content"]
+            if output:
+                content.append(f"{id} - {output}")
+        return content
+
     def look_up_sons(self, id_seq):
-        sons = self.trie.search_sons(id_seq)
-        son_ids = list(sons.keys())
-        son_ids = [id_seq + id for id in son_ids]
-        return son_ids
+        return self.id_index.children(id_seq)
 
     def decode_sons(self, sons):
         # sons is list(item_nums)
@@ -150,7 +536,7 @@ class AgentSearch:
         sons = [s for son in sons for s in son]
         content = []
         for son in sons:
-            son_content = " ".join(self.trie.search_content(son))
+            son_content = self.id_index.content(son)
             content.append(f"{son} - {son_content}")
         return content
 
@@ -173,6 +559,9 @@ class AgentSearch:
                                                             look_up_pool_size=look_up_pool_size,
                                                             selected_pool_size=selected_pool_size)
                     break
+                except CompletionFailure as e:
+                    print(e)
+                    break
                 except:
                     continue
             selected_law_items += selected[:selected_pool_size]
@@ -195,9 +584,9 @@ class AgentSearch:
     def look_up_section(self, section):
         contents = []
 
-        clean_section = section.replace("§", "").strip()
-        if clean_section in self.kb:
-            context = self.kb[clean_section]["text"].strip().replace('\n', '')
+        id = self.resolver.resolve(section)
+        if id is not None and self.id_index.nodes[id]["content"]:
+            context = self.id_index.nodes[id]["content"]
             contents.append(f"{section}: {context}")
 
         return contents
@@ -206,14 +595,48 @@ class AgentSearch:
         regulations = []
         if isinstance(content, list):
             content = " ".join(content)
-        content = content.split(" ")
-        score_index = self.bm25.get_scores(content)
-        score_index = sorted(score_index, key=lambda x: x[0], reverse=True)[:num]
+        content = self.analyzer.encode(content)
+        score_index = self.bm25.get_top_k(content, num)
         index = [si[1] for si in score_index]
         for idx in index:
             regulations.append(f"{self.kb_keys[idx]} - {self.kb_context[idx]}")
         return regulations
 
+    def get_sparse_bm25(self):
+        ### numpy and scipy are optional, without them batches are scored query by query
+        if self.sparse_bm25 is None:
+            try:
+                from agents.bm25_sparse import SparseBM25
+            except ImportError:
+                return None
+            self.sparse_bm25 = SparseBM25(self.bm25)
+        return self.sparse_bm25
+
+    def search_related_regulations_batch(self, contents, num=5, with_scores=False):
+        '''
+        search_related_regulations for a list of contents, scored with a single sparse matrix product.
+        with_scores: bool, return (regulation, BM25 score) pairs instead of the regulations
+        '''
+        queries = []
+        for content in contents:
+            if isinstance(content, list):
+                content = " ".join(content)
+            queries.append(self.analyzer.encode(content))
+        if not queries:
+            return []
+        sparse_bm25 = self.get_sparse_bm25()
+        if sparse_bm25 is None:
+            top_k = [self.bm25.get_top_k(query, num) for query in queries]
+            indices = [[si[1] for si in top] for top in top_k]
+            scores = [[si[0] for si in top] for top in top_k]
+        else:
+            indices, scores = sparse_bm25.get_top_k_batch(queries, num)
+            indices, scores = indices.tolist(), scores.tolist()
+        if with_scores:
+            return [[(f"{self.kb_keys[idx]} - {self.kb_context[idx]}", score) for idx, score in zip(index, score_row)]
+                    for index, score_row in zip(indices, scores)]
+        return [[f"{self.kb_keys[idx]} - {self.kb_context[idx]}" for idx in index] for index in indices]
+
 class AgentsIdSearch:
     def __init__(self, chatbot, args, parser):
         self.lawyer_agent = AgentAction(chatbot, args.law_template,
@@ -222,7 +645,8 @@ class AgentsIdSearch:
         self.law_filter_agent = AgentAction(chatbot, args.law_filter_template,
                                            parser.parse_law_filter, args.law_filter_tokens, api_name= args.api_name,
                          api_bearer_token = args.api_bearer_token)
-        self.search_agent = AgentSearch(args.kb, self.lawyer_agent)
+        self.search_agent = AgentSearch(args.kb, self.lawyer_agent, getattr(args, 'kb_artifact', None),
+                                        getattr(args, 'analyzer', 'whitespace'))
         self.decision_agent = AgentAction(chatbot, args.decision_making_template,
                                           parser.parse_decision, args.decision_tokens, 
                                           api_name= args.api_name,
@@ -237,33 +661,31 @@ class AgentsIdSearch:
         # conclusion = self.conclusion_agent.complete(event=event)
         collected_candidates = []
         logging = {}
-        for _ in range(self.law_generation_round):
-            # laws = list(item_ids)
-            for __ in range(self.generation_round):
-                try:
-                    laws = self.lawyer_agent.complete(event=event,
-                                                  generated_num=self.max_law_items)[-self.max_law_items:]
-
-                    for law in laws:
-                        candidate = self.search_agent.look_up_trie(law)
-                        if candidate:
-                            collected_candidates.append(candidate[0])
-                    break
-                except: continue
+        ### the rounds are sampled at once, or collapsed into one call under deterministic decoding; unlike the
+        ### filter votes they are not stopped early, the candidates are the union of every round and any round
+        ### left out could change it
+        for laws in self.lawyer_agent.complete_n(self.law_generation_round, self.generation_round,
+                                                 event=event, generated_num=self.max_law_items):
+            if isinstance(laws, Exception):
+                continue
+            collected_candidates += self.search_agent.look_up_ids(laws[-self.max_law_items:])
 
         collected_candidates = list(set(collected_candidates))
-        filtered_candidates = []
         logging["filter_response"] = []
-        for _ in range(self.law_filtering_round):
-            for __ in range(self.generation_round):
-                try:
-                    filtered_laws = self.law_filter_agent.complete(event=event, candidates="\n".join(collected_candidates))
-                    logging["filter_response"].append(filtered_laws["response"])
-                    filtered_candidates.append(filtered_laws["filtered"])
-                    break
-                except: continue
+        ### stop filtering as soon as the remaining rounds cannot change the majority
+        votes = VoteAggregator(self.law_filtering_round)
+        while not votes.done():
+            for filtered_laws in self.law_filter_agent.complete_n(votes.next_rounds(), self.generation_round,
+                                                                  event=event, candidates="\n".join(collected_candidates)):
+                if isinstance(filtered_laws, Exception):
+                    votes.skip()
+                    continue
+                logging["filter_response"].append(filtered_laws["response"])
+                ### vote on canonical ids, so that differently written citations agree
+                votes.add(self.search_agent.resolver.resolve_response(filtered_laws["filtered"]))
+        logging["filter_rounds_saved"] = votes.rounds_saved()
 
-        filtered_laws_item_number = list_intersection(filtered_candidates)
+        filtered_laws_item_number = votes.result()
         filtered_laws = []
         for item_number in filtered_laws_item_number:
             item = self.search_agent.look_up_trie(item_number)
@@ -271,6 +693,7 @@ class AgentsIdSearch:
                 filtered_laws.append(item[0])
         # filtered_laws = [[0]  for law in filtered_laws]
         logging["filtered_laws"] = filtered_laws
+        ### generation_round is a retry budget, not a vote: the loop ends with the first parsable decision
         for _ in range(self.generation_round):
 
             try:
@@ -279,6 +702,9 @@ class AgentsIdSearch:
                 logging["decision"] = decision["decision"]
                 logging["decision_response"] = decision["response"]
                 break
+            except CompletionFailure as e:
+                print(e)
+                break
             except:
                 continue
         return logging
@@ -295,7 +721,8 @@ class AgentTrieSearch:
                                            parser.parse_law_filter, args.law_filter_tokens, 
                                           api_name= args.api_name,
                          api_bearer_token = args.api_bearer_token)
-        self.search_agent = AgentSearch(args.kb, self.lawyer_agent)
+        self.search_agent = AgentSearch(args.kb, self.lawyer_agent, getattr(args, 'kb_artifact', None),
+                                        getattr(args, 'analyzer', 'whitespace'))
         self.decision_agent = AgentAction(chatbot, args.decision_making_template,
                                           parser.parse_decision, args.decision_tokens, 
                                           api_name= args.api_name,
@@ -311,23 +738,31 @@ class AgentTrieSearch:
     def action(self, event):
         collected_candidates = []
         logging = {}
-        for _ in range(self.law_generation_round):
+        ### under deterministic decoding every beam search walks the same path, it is run once and its
+        ### candidates repeated so that the filter prompt stays the same
+        searches = 1 if self.lawyer_agent.is_deterministic() else self.law_generation_round
+        ### the candidates of every search are kept, no search can be skipped without changing them
+        for _ in range(searches):
             candidates = self.search_agent.search_beam_law(event, self.max_law_items, self.max_depth,
                                                            self.generation_round)
             collected_candidates += candidates
+        collected_candidates *= self.law_generation_round // searches
 
-        filtered_candidates = []
         logging["filter_response"] = []
-        for _ in range(self.law_filtering_round):
-            for __ in range(self.generation_round):
-                try:
-                    filtered_laws = self.law_filter_agent.complete(event=event, candidates="\n".join(collected_candidates))
-                    logging["filter_response"].append(filtered_laws["response"])
-                    filtered_candidates.append(filtered_laws["filtered"])
-                    break
-                except: continue
+        ### stop filtering as soon as the remaining rounds cannot change the majority
+        votes = VoteAggregator(self.law_filtering_round)
+        while not votes.done():
+            for filtered_laws in self.law_filter_agent.complete_n(votes.next_rounds(), self.generation_round,
+                                                                  event=event, candidates="\n".join(collected_candidates)):
+                if isinstance(filtered_laws, Exception):
+                    votes.skip()
+                    continue
+                logging["filter_response"].append(filtered_laws["response"])
+                ### vote on canonical ids, so that differently written citations agree
+                votes.add(self.search_agent.resolver.resolve_response(filtered_laws["filtered"]))
+        logging["filter_rounds_saved"] = votes.rounds_saved()
 
-        filtered_laws_item_number = list_intersection(filtered_candidates)
+        filtered_laws_item_number = votes.result()
         filtered_laws = []
         for item_number in filtered_laws_item_number:
             item = self.search_agent.look_up_trie(item_number)
@@ -335,6 +770,7 @@ class AgentTrieSearch:
                 filtered_laws.append(item[0])
         # filtered_laws = [[0]  for law in filtered_laws]
 
+        ### generation_round is a retry budget, not a vote: the loop ends with the first parsable decision
         for _ in range(self.generation_round):
             # decision = {decision:"yes/no", reason:"xxx"}
             try:
@@ -343,6 +779,9 @@ class AgentTrieSearch:
                 logging["decision"] = decision["decision"]
                 logging["decision_response"] = decision["response"]
                 break
+            except CompletionFailure as e:
+                print(e)
+                break
             except:
                 continue
         return logging
@@ -366,7 +805,8 @@ class AgentContentSearch:
                                            max_new_tokens = args.law_judge_tokens, 
                                             **vars(args))
     
-        self.search_agent = AgentSearch(args.kb, self.lawyer_agent)
+        self.search_agent = AgentSearch(args.kb, self.lawyer_agent, getattr(args, 'kb_artifact', None),
+                                        getattr(args, 'analyzer', 'whitespace'))
         self.decision_agent = AgentAction(chatbot, 
                                           template = args.decision_making_template,
                                           parser_fn= parser.parse_decision, 
@@ -378,6 +818,8 @@ class AgentContentSearch:
         self.generation_round = args.generation_round
         self.max_law_items = args.max_law_items
         self.look_up_items = args.look_up_items
+        self.reference_tokens = getattr(args, 'reference_tokens', DECISION_REFERENCE_TOKENS)
+        self.token_counter = self.decision_agent.token_counter
         self.args = args
 
 
@@ -393,19 +835,23 @@ class AgentContentSearch:
     step 5: decision_agent use args.decision_making_template to make the final decision based on the filtered_laws
     '''
     def action(self, event):
-        collected_candidates = []
+        contents = []
         logging = {}
-        for _ in range(self.law_generation_round):
-            for __ in range(self.generation_round):
-                try:
-                    content = self.lawyer_agent.complete(event=event, domain = self.args.domain)
-                    searched_items = self.search_agent.search_related_regulations(content, self.look_up_items)
-                    collected_candidates += searched_items
-                    break
-                except Exception as e: 
-                    print(e)
-                    continue
-        collected_candidates = list(set(collected_candidates))
+        for content in self.lawyer_agent.complete_n(self.law_generation_round, self.generation_round,
+                                                    event=event, domain = self.args.domain):
+            if isinstance(content, Exception):
+                continue
+            ### identical lawyer outputs (always the case under deterministic decoding) retrieve the same regulations
+            if content not in contents:
+                contents.append(content)
+        ### retrieve for all the lawyer outputs at once
+        searched_items = self.search_agent.search_related_regulations_batch(contents, self.look_up_items, with_scores=True)
+        ### the relevance of a candidate is its best BM25 score over the lawyer outputs
+        retrieval_scores = {}
+        for items in searched_items:
+            for item, score in items:
+                retrieval_scores[item] = max(score, retrieval_scores.get(item, score))
+        collected_candidates = list(retrieval_scores)
         ### skip the filters to speedup
         # filtered_candidates = []
         # logging["filter_response"] = []
@@ -432,29 +878,34 @@ class AgentContentSearch:
         logging["filtered_laws_coarse"] = collected_candidates
         filtered_laws = []
 
-        for law in filtered_laws_coarse:
-            for _ in range(self.generation_round):
-                try:
-                    judge = self.law_judge_agent.complete(event=event, candidate_law=law, domain = self.args.domain)
-                    if judge["decision"] == "yes":
-                        filtered_laws.append(law)
-                    break
-                except Exception as e:
-                    print(e)
-                    continue
+        ### judge all the candidates at once: one generate call for HF models, concurrent requests for the
+        ### asyncio api client; unparsable judgments are retried up to generation_round times per candidate, and
+        ### when the batch call fails the candidates are judged one at a time, a failing candidate is skipped
+        judges = self.law_judge_agent.complete_batch([dict(event=event, candidate_law=law, domain=self.args.domain)
+                                                      for law in filtered_laws_coarse], self.generation_round)
+        logging["judge_failed"] = []
+        for law, judge in zip(filtered_laws_coarse, judges):
+            if isinstance(judge, Exception):
+                logging["judge_failed"].append(law.split(" - ")[0])
+                continue
+            if judge["decision"] == "yes":
+                filtered_laws.append(law)
         logging["filtered_laws"] = [k.split(" - ")[0] for k in filtered_laws]
+        ### need to reduce the filtered results to fit the LLM context length: the most relevant regulations
+        ### are packed into the reference token budget, long ones cut at a sentence boundary
+        temp_laws = pack_references([(law, retrieval_scores[law]) for law in filtered_laws], self.reference_tokens,
+                                    self.token_counter, MAX_REFERENCE_NUM)
         for _ in range(self.generation_round):
             try:
-                ### need to reduce the filtered results to fit the LLM context length
-                temp_laws = filtered_laws
-                if len(filtered_laws) > MAX_REFERENCE_NUM:
-                    temp_laws =  random.sample(filtered_laws, MAX_REFERENCE_NUM)
                 decision = self.decision_agent.complete(event=event,
                                                         reference_regulations="\n".join(temp_laws),
                                                         domain = self.args.domain)
                 logging["decision"] = decision["decision"]
                 logging["decision_response"] = decision["response"]
                 break
+            except CompletionFailure as e:
+                print(e)
+                break
             except Exception as e:
                 print(e)
                 continue
@@ -479,7 +930,8 @@ class AgentEmbSearch:
                                            parser.parse_law_judge, args.law_judge_tokens, 
                                           api_name= args.api_name,
                          api_bearer_token = args.api_bearer_token)
-        self.search_agent = AgentSearch(args.kb, self.lawyer_agent)
+        self.search_agent = AgentSearch(args.kb, self.lawyer_agent, getattr(args, 'kb_artifact', None),
+                                        getattr(args, 'analyzer', 'whitespace'))
         self.decision_agent = AgentAction(chatbot, args.decision_making_template,
                                           parser.parse_decision, args.decision_tokens, 
                                           api_name= args.api_name,
@@ -551,6 +1003,9 @@ class AgentEmbSearch:
                 logging["decision"] = decision["decision"]
                 logging["decision_response"] = decision["response"]
                 break
+            except CompletionFailure as e:
+                print(e)
+                break
             except:
                 continue
         return logging
@@ -0,0 +1,89 @@
+import re
+
+
+### common English function words, plus the words every regulation repeats
+STOPWORDS = frozenset('''
+a about above after again against all am an and any are as at be because been before being below between both but by
+can could did do does doing down during each few for from further had has have having he her here hers herself him
+himself his how i if in into is it its itself just me more most my myself no nor not now of off on once only or other
+our ours ourselves out over own same she should so some such than that the their theirs them themselves then there
+these they this those through to too under until up very was we were what when where which while who whom why will
+with would you your yours yourself yourselves shall may must also within upon thereof therein whereas pursuant
+'''.split())
+
+TOKEN_PATTERN = r"\w+(?:[.'’-]\w+)*"
+
+### (suffix, replacement) tried in order, the first match wins
+STEM_RULES = [('ational', 'ate'), ('ization', 'ize'), ('fulness', 'ful'), ('iveness', 'ive'), ('ations', 'ate'),
+              ('ation', 'ate'), ('ities', 'ity'), ('ies', 'y'), ('sses', 'ss'), ('ments', 'ment'), ('ings', ''),
+              ('ing', ''), ('edly', ''), ('ed', ''), ('ness', ''), ('ss', 'ss'), ('us', 'us'), ('is', 'is'), ('s', '')]
+
+
+def light_stem(token):
+    '''
+    Suffix stripping stemmer, deterministic and without dependencies; "processing", "processed" and "processes"
+    all become "process".
+    '''
+    if len(token) <= 3 or not token.isalpha():
+        return token
+    for suffix, replacement in STEM_RULES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            return token[:-len(suffix)] + replacement
+    return token
+
+
+class Analyzer:
+    '''
+    Turns regulation texts and queries into BM25 terms, and interns the terms as integer ids.
+    The vocabulary grows while the index is built (add=True); query terms outside it are dropped since
+    no document contains them.
+    lowercase: bool, fold case
+    strip_punctuation: bool, keep word tokens only (ids like 164.502 stay whole), otherwise split on whitespace
+    stopwords: bool, drop STOPWORDS
+    stem: bool, apply light_stem
+    '''
+    def __init__(self, lowercase=True, strip_punctuation=True, stopwords=True, stem=False):
+        self.lowercase = lowercase
+        self.strip_punctuation = strip_punctuation
+        self.stopwords = stopwords
+        self.stem = stem
+        self.pattern = re.compile(TOKEN_PATTERN)
+        self.vocab = {}
+
+    def config(self):
+        return {"lowercase": self.lowercase, "strip_punctuation": self.strip_punctuation,
+                "stopwords": self.stopwords, "stem": self.stem}
+
+    def tokenize(self, text):
+        if self.lowercase:
+            text = text.lower()
+        tokens = self.pattern.findall(text) if self.strip_punctuation else text.split()
+        if self.stopwords:
+            tokens = [token for token in tokens if token.lower() not in STOPWORDS]
+        if self.stem:
+            tokens = [light_stem(token) for token in tokens]
+        return tokens
+
+    def encode(self, text, add=False):
+        ### interned term ids of text, shared by the index and the queries
+        ids = []
+        for token in self.tokenize(text):
+            if token not in self.vocab:
+                if not add:
+                    continue
+                self.vocab[token] = len(self.vocab)
+            ids.append(self.vocab[token])
+        return ids
+
+
+### the analyzers selectable with --analyzer, "whitespace" is the original text.split() tokenisation
+ANALYZERS = {
+    'whitespace': dict(lowercase=False, strip_punctuation=False, stopwords=False, stem=False),
+    'standard': dict(lowercase=True, strip_punctuation=True, stopwords=True, stem=False),
+    'stem': dict(lowercase=True, strip_punctuation=True, stopwords=True, stem=True),
+}
+
+
+def get_analyzer(name='whitespace'):
+    assert name in ANALYZERS, f'Invalid analyzer name, choose from {list(ANALYZERS)}'
+    return Analyzer(**ANALYZERS[name])
@@ -0,0 +1,170 @@
+import asyncio
+import re
+import threading
+import time
+
+from openai import AsyncOpenAI
+
+from agents.retry import RetryPolicy
+
+
+async def read_stream(stream, stop_pattern):
+    ### read a streamed completion, closing the stream once the answer block matched stop_pattern
+    pattern = re.compile(stop_pattern, re.IGNORECASE)
+    msg = ''
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            msg += chunk.choices[0].delta.content
+            if pattern.search(msg):
+                break
+    await stream.close()
+    return msg
+
+
+class TokenBucket:
+    '''
+    Token bucket refilled continuously at rate_per_minute, used to cap the requests and the tokens sent per minute.
+    A rate of 0 disables the limit.
+    '''
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        if self.rate <= 0:
+            return
+        ### a single request larger than the bucket is let through once the bucket is full
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self.refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def consume(self, amount):
+        ### charge usage that is only known after the request, e.g. the completion tokens
+        if self.rate <= 0:
+            return
+        self.refill()
+        self.tokens -= amount
+
+
+class AsyncOpenAI_model:
+    '''
+    OpenAI backend that keeps up to `concurrency` requests in flight on a background event loop.
+    Requests per minute and tokens per minute are capped by token buckets shared by every caller,
+    so the blocking `compeletion` can also be called from several threads at once.
+    '''
+    def __init__(self, api_key: str, api_name: str, base_url: str = None, concurrency: int = 8,
+                 requests_per_minute: int = 0, tokens_per_minute: int = 0, retry_policy: RetryPolicy = None):
+        self.api_key = api_key
+        self.api_name = api_name
+        if(api_name == 'deepseek'):
+            ### using deepseek r1 model from ARK API
+            print('using ARK API to respond via deepseek r1...')
+            base_url = "https://ark.cn-beijing.volces.com/api/v3"
+        ### retries are handled by retry_policy only, not again inside the client
+        self.client = AsyncOpenAI(api_key=self.api_key, base_url=base_url or None, max_retries=0)
+        self.retry_policy = retry_policy or RetryPolicy()
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+
+    @staticmethod
+    def estimate_tokens(messages):
+        ### ~4 characters per token, only used for the rate limiter
+        return sum(len(message["content"]) for message in messages) // 4 + 1
+
+    async def acompeletion(self, model: str, messages: list, max_retries: int, stop_pattern: str = None, **kwargs):
+        '''
+        Returns the response message, or a CompletionFailure once the retry policy gives up.
+        stop_pattern: regex, the response is streamed and the stream closed as soon as it matches
+        '''
+        if(self.api_name == 'deepseek'):
+            model = 'ep-20250208151949-2c29b'
+
+        async def request():
+            async with self.semaphore:
+                await self.request_bucket.acquire(1)
+                await self.token_bucket.acquire(self.estimate_tokens(messages))
+                if stop_pattern:
+                    stream = await self.client.chat.completions.create(
+                        model = model,
+                        messages=messages,
+                        stream=True,
+                        **kwargs
+                    )
+                    return await read_stream(stream, stop_pattern)
+                response = await self.client.chat.completions.create(
+                    model = model,
+                    messages=messages,
+                    **kwargs
+                )
+            if response.usage is not None:
+                self.token_bucket.consume(response.usage.completion_tokens)
+            msg = response.choices[0].message.content
+            assert isinstance(msg, str), "The retruned response is not a string."
+            return msg
+
+        return await self.retry_policy.acall(request, max_retries)
+
+    async def acompeletion_n(self, model: str, messages: list, max_retries: int, n: int, **kwargs):
+        '''
+        Returns n sampled response messages from a single request, or a CompletionFailure once the retry policy gives up.
+        '''
+        if(self.api_name == 'deepseek'):
+            model = 'ep-20250208151949-2c29b'
+
+        async def request():
+            async with self.semaphore:
+                await self.request_bucket.acquire(1)
+                await self.token_bucket.acquire(self.estimate_tokens(messages))
+                response = await self.client.chat.completions.create(
+                    model = model,
+                    messages=messages,
+                    n=n,
+                    **kwargs
+                )
+            if response.usage is not None:
+                self.token_bucket.consume(response.usage.completion_tokens)
+            msgs = [choice.message.content for choice in response.choices]
+            assert len(msgs) == n and all(isinstance(msg, str) for msg in msgs), "The retruned responses are not n strings."
+            return msgs
+
+        return await self.retry_policy.acall(request, max_retries)
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def compeletion(self, model: str, messages: list, max_retries: int, stop_pattern: str = None, **kwargs):
+        return self.run(self.acompeletion(model, messages, max_retries, stop_pattern, **kwargs))
+
+    def compeletion_n(self, model: str, messages: list, max_retries: int, n: int, **kwargs):
+        return self.run(self.acompeletion_n(model, messages, max_retries, n, **kwargs))
+
+    def compeletion_batch(self, model: str, message_lists: list, max_retries: int, stop_pattern: str = None, **kwargs):
+        '''
+        Dispatch all the message lists concurrently and return the responses in the input order.
+        '''
+        async def gather():
+            return await asyncio.gather(*[self.acompeletion(model, messages, max_retries, stop_pattern, **kwargs)
+                                          for messages in message_lists])
+        return self.run(gather())
+
+    def close(self):
+        self.run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -1,3 +1,4 @@
+import heapq
 import math
 
 from six import iteritems
@@ -22,6 +23,8 @@ class BM25(object):
         Dictionary with inversed documents frequencies for whole `corpus`. Words used as keys and frequencies as values.
     doc_len : list of int
         List of document lengths.
+    postings : dict
+        Inverted index, words used as keys and lists of (document index, term weight) as values.
     """
 
     def __init__(self, corpus):
@@ -39,7 +42,9 @@ class BM25(object):
         self.idf = {}
         self.doc_len = []
         self.nd = {}
+        self.postings = {}
         self._initialize(corpus)
+        self._build_postings()
 
 
     def _initialize(self, corpus):
@@ -81,6 +86,69 @@ class BM25(object):
         for word in negative_idfs:
             self.idf[word] = eps
 
+    def _build_postings(self):
+        """Builds the inverted index with the BM25 weight of every (word, document) pair, so that scoring a query
+        only touches the documents that contain its words."""
+        # length normalisation of each document, as in get_score
+        norms = [PARAM_K1 * (1 - PARAM_B + PARAM_B * doc_len / self.avgdl) for doc_len in self.doc_len]
+        for index, doc_freqs in enumerate(self.doc_freqs):
+            for word, freq in iteritems(doc_freqs):
+                weight = self.idf[word] * freq * (PARAM_K1 + 1) / (freq + norms[index])
+                self.postings.setdefault(word, []).append((index, weight))
+
+    def get_sparse_scores(self, document):
+        """Computes BM25 scores of given `document` for the documents sharing at least one word with it.
+
+        Parameters
+        ----------
+        document : list of str
+            Document to be scored.
+
+        Returns
+        -------
+        dict
+            Document indexes as keys and BM25 scores as values, other documents score 0.
+
+        """
+        scores = {}
+        # words are added in the order of the query, so that the sums equal get_score
+        for word in document:
+            for index, weight in self.postings.get(word, ()):
+                scores[index] = scores.get(index, 0) + weight
+        return scores
+
+    def get_top_k(self, document, k):
+        """Returns the `k` best (score, index) pairs of given `document`, by descending score then ascending index,
+        i.e. the first `k` items of sorted(get_scores(document), key=lambda x: x[0], reverse=True).
+        Documents without any query word score 0 and fill the list in index order.
+
+        Parameters
+        ----------
+        document : list of str
+            Document to be scored.
+        k : int
+            Number of documents to return.
+
+        Returns
+        -------
+        list of (float, int)
+            BM25 scores and indexes of the best documents.
+
+        """
+        scores = self.get_sparse_scores(document)
+        candidates = list(iteritems(scores))
+        if len(candidates) < self.corpus_size:
+            # the first k documents without a match are the only zero-score documents that can make the top k
+            zeros = []
+            for index in range(self.corpus_size):
+                if len(zeros) >= k:
+                    break
+                if index not in scores:
+                    zeros.append((index, 0))
+            candidates += zeros
+        best = heapq.nsmallest(k, candidates, key=lambda x: (-x[1], x[0]))
+        return [(score, index) for index, score in best]
+
     def get_score(self, document, index):
         """Computes BM25 score of given `document` in relation to item of corpus selected by `index`.
 
@@ -123,7 +191,8 @@ class BM25(object):
             BM25 scores.
 
         """
-        scores = [(self.get_score(document, index), index) for index in range(self.corpus_size)]
+        sparse_scores = self.get_sparse_scores(document)
+        scores = [(sparse_scores.get(index, 0), index) for index in range(self.corpus_size)]
         return scores
 
     def get_words_score(self,document, index):
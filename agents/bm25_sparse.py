@@ -0,0 +1,89 @@
+import numpy as np
+from scipy import sparse
+
+
+class SparseBM25(object):
+    """BM25 as a sparse (documents x vocabulary) weight matrix, to score a batch of queries with one matrix product.
+
+    Attributes
+    ----------
+    vocab : dict
+        Words used as keys and column indexes as values.
+    weights : scipy.sparse.csr_matrix
+        BM25 weight of every (document, word) pair, the same values as `BM25.postings`.
+    """
+
+    def __init__(self, bm25):
+        """
+        Parameters
+        ----------
+        bm25 : agents.bm25.BM25
+            Index built on the corpus, its precomputed weights are reused.
+
+        """
+        self.corpus_size = bm25.corpus_size
+        self.vocab = {word: col for col, word in enumerate(bm25.postings)}
+        rows, cols, data = [], [], []
+        for word, postings in bm25.postings.items():
+            for index, weight in postings:
+                rows.append(index)
+                cols.append(self.vocab[word])
+                data.append(weight)
+        self.weights = sparse.csr_matrix((data, (rows, cols)), shape=(self.corpus_size, len(self.vocab)))
+
+    @classmethod
+    def from_arrays(cls, bm25, data, indices, indptr):
+        """Rebuilds the weight matrix from stored CSR arrays (e.g. memory-mapped from a KB artifact)."""
+        self = cls.__new__(cls)
+        self.corpus_size = bm25.corpus_size
+        self.vocab = {word: col for col, word in enumerate(bm25.postings)}
+        self.weights = sparse.csr_matrix((data, indices, indptr), shape=(self.corpus_size, len(self.vocab)))
+        return self
+
+    def query_matrix(self, documents):
+        """Term counts of each query, words outside the vocabulary are dropped (they score 0)."""
+        rows, cols = [], []
+        for row, document in enumerate(documents):
+            for word in document:
+                col = self.vocab.get(word)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+        # duplicated (row, col) pairs are summed, a repeated query word counts once per occurrence as in get_score
+        return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(documents), len(self.vocab)))
+
+    def get_scores_batch(self, documents):
+        """Returns the (queries x corpus) array of BM25 scores of given `documents`."""
+        return (self.query_matrix(documents) @ self.weights.T).toarray()
+
+    def get_top_k_batch(self, documents, k):
+        """Returns the `k` best documents of every query, by descending score then ascending index.
+
+        Parameters
+        ----------
+        documents : list of list of str
+            Queries to be scored.
+        k : int
+            Number of documents to return per query.
+
+        Returns
+        -------
+        (numpy.ndarray, numpy.ndarray)
+            (queries x k) arrays of document indexes and of their BM25 scores.
+
+        """
+        scores = self.get_scores_batch(documents)
+        k = min(k, self.corpus_size)
+        if k < self.corpus_size:
+            candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            # the partition boundary may split a tie, keep every document scoring as much as the k-th one
+            kth = np.take_along_axis(scores, candidates, axis=1).min(axis=1, keepdims=True)
+        else:
+            kth = scores.min(axis=1, keepdims=True)
+        indices = np.empty((len(documents), k), dtype=np.int64)
+        for row in range(len(documents)):
+            tied = np.flatnonzero(scores[row] >= kth[row])
+            # np.lexsort sorts by the last key first: descending score, then ascending index
+            order = np.lexsort((tied, -scores[row, tied]))[:k]
+            indices[row] = tied[order]
+        return indices, np.take_along_axis(scores, indices, axis=1)
@@ -0,0 +1,128 @@
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    '''
+    On-disk LLM response cache backed by SQLite.
+    Entries are keyed by a hash of the backend, model name, rendered prompt and decoding parameters,
+    and the least recently used entries are evicted once there are more than max_entries of them.
+    A hit does not write to the database: the access times are kept in memory and written with the next
+    put, or every touch_every hits, or on close. The row count is kept in memory and only recounted to evict.
+    '''
+    def __init__(self, path, max_entries=100000, touch_every=256):
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_every = touch_every
+        self.hits = 0
+        self.misses = 0
+        ### prompt digest -> requests of the run, least recently requested first, at most max_entries of them
+        self.occurrences = OrderedDict()
+        ### key -> last access of the hits not written yet
+        self.touched = {}
+        self.closed = False
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses "
+                          "(key TEXT PRIMARY KEY, response TEXT NOT NULL, last_access REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def make_key(self, backend, model, prompt, **params):
+        payload = json.dumps({"backend": backend, "model": model, "prompt": prompt, "params": params},
+                             sort_keys=True, ensure_ascii=False)
+        digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        ### the n-th identical request of a run maps to the n-th cached sample, so that voting rounds and
+        ### parse-failure retries are replayed instead of collapsed into one response. The numbering is per process
+        ### and per prompt; every prompt embeds its case, so the numbering of the requests of a case does not depend
+        ### on the other cases, threads, shards or queue workers, unless two cases render the very same prompt.
+        ### A prompt not requested among the last max_entries ones starts again from its first sample.
+        with self.lock:
+            occurrence = self.occurrences.pop(digest, 0)
+            self.occurrences[digest] = occurrence + 1
+            if len(self.occurrences) > self.max_entries:
+                self.occurrences.popitem(last=False)
+        return f"{digest}-{occurrence}"
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touched[key] = time.time()
+            if len(self.touched) >= self.touch_every:
+                self.write_touched()
+                self.conn.commit()
+            return row[0]
+
+    def put(self, key, response):
+        with self.lock:
+            inserted = self.conn.execute("INSERT OR IGNORE INTO responses (key, response, last_access) "
+                                         "VALUES (?, ?, ?)", (key, response, time.time())).rowcount
+            if inserted:
+                self.size += 1
+            else:
+                self.conn.execute("UPDATE responses SET response = ?, last_access = ? WHERE key = ?",
+                                  (response, time.time(), key))
+            self.write_touched()
+            if self.size > self.max_entries:
+                self.evict()
+            self.conn.commit()
+
+    def write_touched(self):
+        ### the access times of the hits since the last write, committed by the caller
+        if self.touched:
+            self.conn.executemany("UPDATE responses SET last_access = ? WHERE key = ?",
+                                  [(last_access, key) for key, last_access in self.touched.items()])
+            self.touched = {}
+
+    def evict(self):
+        ### drop the least recently used entries beyond max_entries, recounted as other processes may share the file
+        self.size = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if self.size > self.max_entries:
+            self.conn.execute("DELETE FROM responses WHERE key IN "
+                              "(SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                              (self.size - self.max_entries,))
+            self.size = self.max_entries
+
+    def __len__(self):
+        with self.lock:
+            return self.size
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0, "entries": len(self)}
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.write_touched()
+            self.conn.commit()
+            self.conn.close()
+
+
+_caches = {}
+
+def get_response_cache(path, max_entries=100000):
+    '''
+    Return the cache opened on path, so that all agents of a run share one connection and one set of counters.
+    '''
+    if path not in _caches:
+        _caches[path] = ResponseCache(path, max_entries)
+        ### the access times of the last hits are written when the run ends
+        atexit.register(_caches[path].close)
+    return _caches[path]
@@ -1,18 +1,60 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM
-import torch
+import copy
 import pprint
+import re
+from collections import OrderedDict
 from config import CACHE_DIR
+from agents.retry import CompletionFailure
+
+
+def get_stopping_criteria(tokenizer, prompt_length, stop_pattern, window=48):
+    '''
+    StoppingCriteria that ends each sequence once the regex stop_pattern matches its last `window` generated tokens.
+    '''
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+    pattern = re.compile(stop_pattern, re.IGNORECASE)
+
+    class RegexStoppingCriteria(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            start = max(prompt_length, input_ids.shape[1] - window)
+            tails = tokenizer.batch_decode(input_ids[:, start:], skip_special_tokens=True)
+            done = [pattern.search(tail) is not None for tail in tails]
+            return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    return StoppingCriteriaList([RegexStoppingCriteria()])
+
+
+### marks where the case-specific part of a prompt starts when rendering a template prefix
+PREFIX_SENTINEL = "<<<CASE>>>"
 
 
 class HuggingfaceChatbot:
-    def __init__(self, model, max_mem_per_gpu='80GiB'):
+    def __init__(self, model, max_mem_per_gpu='80GiB', prefix_cache=False, max_prefixes=16):
+        '''
+        prefix_cache: bool, keep the past key values of each template's static prefix and only prefill the rest of the prompt
+        max_prefixes: int, the number of prefixes kept, the least recently used one is dropped beyond it
+        '''
+        ### torch and transformers are only imported once a local model is requested
+        import torch
+        from transformers import AutoTokenizer
+        self.model_name = model
+        self.use_prefix_cache = prefix_cache
+        self.max_prefixes = max_prefixes
+        self.prefix_cache = OrderedDict()
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model = self.load_hugging_face_model(model, max_mem_per_gpu)
         self.tokenizer = AutoTokenizer.from_pretrained(model)
-        
+        ### context window of the model (capped at the 8192 tokens the runs always used), prompts and new tokens are checked against it
+        self.max_length = min(getattr(self.model.config, 'max_position_embeddings', None) or 8192, 8192)
+        ### left padding for batched generation
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
 
 
     def load_hugging_face_model(self, model, max_mem_per_gpu='80GiB'):
+        import torch
+        from transformers import AutoModelForCausalLM
         MAX_MEM_PER_GPU = max_mem_per_gpu
         map_list = {}
         for i in range(torch.cuda.device_count()):
@@ -28,7 +70,28 @@ class HuggingfaceChatbot:
         ).to(self.device)
         return model
 
-    def respond(self, message, max_new_tokens=128):
+    def prompt_failure(self, prompt_length):
+        '''
+        The CompletionFailure answering a prompt of prompt_length tokens that fills the whole context window,
+        instead of failing inside generate; None if the prompt fits.
+        '''
+        if prompt_length < self.max_length:
+            return None
+        return CompletionFailure("permanent", ValueError(
+            f"The prompt ({prompt_length} tokens) does not fit the context window of {self.max_length} tokens."))
+
+    def fit_new_tokens(self, prompt_length, max_new_tokens):
+        '''
+        The new tokens that fit in the context window after a prompt of prompt_length tokens (checked by prompt_failure).
+        '''
+        if prompt_length + max_new_tokens > self.max_length:
+            print(f"prompt of {prompt_length} tokens, max_new_tokens cut to {self.max_length - prompt_length}")
+        return min(max_new_tokens, self.max_length - prompt_length)
+
+    def respond(self, message, max_new_tokens=128, stop_pattern=None, prefix=None):
+        return self.respond_batch([message], max_new_tokens, stop_pattern, [prefix])[0]
+
+    def build_prompt(self, message):
         message = message.replace("Assistant:", "").strip()
         messages = [
             {"role": "system", "content": "You are a helpful assistant."},
@@ -39,24 +102,221 @@ class HuggingfaceChatbot:
             tokenize=False,
             add_generation_prompt=True
         )
-        tokenized = self.tokenizer(message, return_tensors="pt")
+        return message
 
-        #input_ids = tokenized.input_ids
-        input_ids = tokenized.input_ids.to(self.model.device)
-        attention_mask = tokenized.attention_mask.to(self.model.device)
+    def get_prefix_cache(self, prefix):
+        '''
+        Token ids and past key values of the chat prompt rendered up to the static prefix of a template.
+        Computed once per (tokenizer, prefix) and kept for the following cases.
+        '''
+        import torch
+        key = (self.tokenizer.name_or_path, prefix)
+        if key in self.prefix_cache:
+            self.prefix_cache.move_to_end(key)
+            return self.prefix_cache[key]
+
+        rendered = self.build_prompt(prefix + PREFIX_SENTINEL)
+        rendered = rendered[:rendered.index(PREFIX_SENTINEL)]
+        prefix_ids = self.tokenizer(rendered, return_tensors="pt").input_ids.to(self.model.device)
+        with torch.no_grad():
+            past_key_values = self.model(prefix_ids, use_cache=True).past_key_values
+        self.prefix_cache[key] = (prefix_ids[0], past_key_values)
+        if len(self.prefix_cache) > self.max_prefixes:
+            self.prefix_cache.popitem(last=False)
+        return self.prefix_cache[key]
+
+    def reuse_prefix(self, input_ids, prefix, min_tokens=16):
+        '''
+        A copy of the prefix past key values cropped to the tokens input_ids shares with the prefix, None if too few.
+        '''
+        prefix_ids, past_key_values = self.get_prefix_cache(prefix)
+        length = min(len(prefix_ids), input_ids.shape[1] - 1)
+        ### tokens at the prefix boundary may merge differently with the case text, keep the common part only
+        same = (input_ids[0, :length] == prefix_ids[:length]).int()
+        common = int(same.cumprod(0).sum())
+        if common < min_tokens:
+            return None
+        past_key_values = copy.deepcopy(past_key_values)
+        past_key_values.crop(common)
+        return past_key_values
+
+    def respond_batch(self, messages, max_new_tokens=128, stop_pattern=None, prefixes=None):
+        '''
+        Respond to a micro-batch of messages with a single generate call.
+        Prompts are left-padded so that every continuation starts at the same position.
+        stop_pattern: regex, a sequence stops generating once its answer block matches it
+        prefixes: list of str, the static template prefix of each message, reused from the prefix cache
+                  for single prompts (padding shifts the prefix positions inside a batch)
+        A prompt that does not fit the context window gets a CompletionFailure, the others are still answered.
+        '''
+        prompts = [self.build_prompt(message) for message in messages]
+        tokenized = self.tokenizer(prompts, return_tensors="pt", padding=True)
+        ### each prompt is checked with its own length, not the padded length of the micro-batch
+        lengths = tokenized.attention_mask.sum(dim=1).tolist()
+        responses = [self.prompt_failure(length) for length in lengths]
+        fitting = [idx for idx, response in enumerate(responses) if response is None]
+        if not fitting:
+            return responses
+        ### left padding: the columns left of the longest fitting prompt are padding only
+        width = max(lengths[idx] for idx in fitting)
+        input_ids = tokenized.input_ids[fitting][:, -width:].to(self.model.device)
+        attention_mask = tokenized.attention_mask[fitting][:, -width:].to(self.model.device)
         generation_config = self.model.generation_config
-        generation_config.max_length = 8192
-        generation_config.max_new_tokens = max_new_tokens
+        generation_config.max_length = self.max_length
+        generation_config.max_new_tokens = self.fit_new_tokens(width, max_new_tokens)
+        generation_config.pad_token_id = self.tokenizer.pad_token_id
+        stopping_criteria = None
+        if stop_pattern:
+            stopping_criteria = get_stopping_criteria(self.tokenizer, input_ids.shape[1], stop_pattern)
+        past_key_values = None
+        if self.use_prefix_cache and len(messages) == 1 and prefixes and prefixes[0]:
+            past_key_values = self.reuse_prefix(input_ids, prefixes[0])
         output = self.model.generate(
             input_ids,
             attention_mask=attention_mask,
-            generation_config=generation_config
+            generation_config=generation_config,
+            stopping_criteria=stopping_criteria,
+            past_key_values=past_key_values
+        )
+        generated = self.tokenizer.batch_decode(output[:, input_ids.shape[1]:], skip_special_tokens=True)
+        for idx, response in zip(fitting, generated):
+            responses[idx] = response.strip()
+        return responses
+
+    def score_continuations(self, messages, continuations):
+        '''
+        Log-likelihood of each continuation as the start of the response to each message, with one forward pass
+        over every (message, continuation) pair instead of generating and parsing a response.
+        Returns a list (one per message) of lists (one per continuation) of summed token log-probabilities.
+        '''
+        import torch
+        prompt_ids = [self.tokenizer(self.build_prompt(message), add_special_tokens=False).input_ids
+                      for message in messages]
+        continuation_ids = [self.tokenizer(continuation, add_special_tokens=False).input_ids
+                            for continuation in continuations]
+        sequences = [prompt + continuation for prompt in prompt_ids for continuation in continuation_ids]
+        ### right padding, the continuation tokens of every sequence are gathered by position
+        length = max(len(sequence) for sequence in sequences)
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+        input_ids = torch.full((len(sequences), length), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), length), dtype=torch.long)
+        for idx, sequence in enumerate(sequences):
+            input_ids[idx, :len(sequence)] = torch.tensor(sequence)
+            attention_mask[idx, :len(sequence)] = 1
+        with torch.no_grad():
+            logits = self.model(input_ids.to(self.model.device),
+                                attention_mask=attention_mask.to(self.model.device)).logits
+        log_probs = torch.log_softmax(logits.float(), dim=-1)
+
+        scores = []
+        for i, prompt in enumerate(prompt_ids):
+            row = []
+            for j, continuation in enumerate(continuation_ids):
+                idx = i * len(continuation_ids) + j
+                ### the token at position t is predicted by the logits at position t - 1
+                positions = torch.arange(len(prompt) - 1, len(prompt) + len(continuation) - 1)
+                targets = torch.tensor(continuation)
+                row.append(float(log_probs[idx, positions, targets].sum()))
+            scores.append(row)
+        return scores
+
+    def score_next_token(self, messages, options, answer_prefix=""):
+        '''
+        Log-probability of each single-token option (e.g. the letters of a multiple choice question) as the next
+        token after the response starts with answer_prefix, read from the logits of one forward pass over the batch.
+        An option counts with and without a leading space, the way the tokenizer may merge it with the prefix.
+        Returns a list (one per message) of lists (one per option) of log-probabilities.
+        '''
+        import torch
+        prompt_ids = [self.tokenizer(self.build_prompt(message) + answer_prefix, add_special_tokens=False).input_ids
+                      for message in messages]
+        option_ids = [self.option_token_ids(option) for option in options]
+        ### right padding, the next-token logits of each prompt are read at its own last position
+        length = max(len(prompt) for prompt in prompt_ids)
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+        input_ids = torch.full((len(prompt_ids), length), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(prompt_ids), length), dtype=torch.long)
+        for idx, prompt in enumerate(prompt_ids):
+            input_ids[idx, :len(prompt)] = torch.tensor(prompt)
+            attention_mask[idx, :len(prompt)] = 1
+        with torch.no_grad():
+            logits = self.model(input_ids.to(self.model.device),
+                                attention_mask=attention_mask.to(self.model.device)).logits
+        last = torch.tensor([len(prompt) - 1 for prompt in prompt_ids], device=logits.device)
+        log_probs = torch.log_softmax(logits[torch.arange(len(prompt_ids), device=logits.device), last].float(), dim=-1)
+        return [[float(torch.logsumexp(row[ids], dim=0)) for ids in option_ids] for row in log_probs]
+
+    def option_token_ids(self, option):
+        '''
+        The token ids of option with and without a leading space, for the variants that encode to one token.
+        '''
+        ids = set()
+        for variant in [option, " " + option]:
+            encoded = self.tokenizer(variant, add_special_tokens=False).input_ids
+            ### SentencePiece tokenizers (Llama-2, Mistral) encode " A" as ["▁", "A"], the space token is not the option
+            if len(encoded) > 1 and not self.tokenizer.decode(encoded[:-1]).strip():
+                encoded = encoded[-1:]
+            if len(encoded) == 1:
+                ids.add(encoded[0])
+        if not ids:
+            raise ValueError(f"The option {option!r} is not a single token.")
+        return sorted(ids)
+
+    def is_deterministic(self):
+        ### greedy decoding (the default of most generation configs) answers a prompt the same way every time
+        return not self.model.generation_config.do_sample
+
+    def respond_n(self, message, n, max_new_tokens=128, stop_pattern=None, prefix=None):
+        '''
+        Sample n responses to one message with a single generate call.
+        The prompt is prefilled once (starting from the prefix cache when enabled) and its past key values
+        are repeated for the n sequences, instead of prefilling n copies of the prompt. Without a cache object
+        that can be repeated (a one-token prompt, or a transformers version whose caches lack
+        batch_repeat_interleave), the n copies of the prompt are encoded by generate as before.
+        '''
+        import torch
+        prompt = self.build_prompt(message)
+        tokenized = self.tokenizer(prompt, return_tensors="pt")
+        input_ids = tokenized.input_ids.to(self.model.device)
+        attention_mask = tokenized.attention_mask.to(self.model.device)
+        failure = self.prompt_failure(input_ids.shape[1])
+        if failure is not None:
+            return [failure] * n
+
+        past_key_values = None
+        if self.use_prefix_cache and prefix:
+            past_key_values = self.reuse_prefix(input_ids, prefix)
+        start = past_key_values.get_seq_length() if past_key_values is not None else 0
+        ### the last prompt token is left to generate, which computes the logits of the first new token
+        if start < input_ids.shape[1] - 1:
+            with torch.no_grad():
+                past_key_values = self.model(input_ids[:, start:-1], past_key_values=past_key_values,
+                                             use_cache=True).past_key_values
+        if hasattr(past_key_values, 'batch_repeat_interleave'):
+            past_key_values.batch_repeat_interleave(n)
+        else:
+            past_key_values = None
+
+        generation_config = copy.deepcopy(self.model.generation_config)
+        generation_config.max_length = self.max_length
+        generation_config.max_new_tokens = self.fit_new_tokens(input_ids.shape[1], max_new_tokens)
+        generation_config.pad_token_id = self.tokenizer.pad_token_id
+        stopping_criteria = None
+        if stop_pattern:
+            stopping_criteria = get_stopping_criteria(self.tokenizer, input_ids.shape[1], stop_pattern)
+        output = self.model.generate(
+            input_ids.repeat(n, 1),
+            attention_mask=attention_mask.repeat(n, 1),
+            generation_config=generation_config,
+            stopping_criteria=stopping_criteria,
+            past_key_values=past_key_values
         )
-        response = self.tokenizer.batch_decode(output[:, input_ids.shape[1]:], skip_special_tokens=True)[0]
-        response = response.strip()
-        return response
+        responses = self.tokenizer.batch_decode(output[:, input_ids.shape[1]:], skip_special_tokens=True)
+        responses = [response.strip() for response in responses]
+        return responses
 
 if __name__ == '__main__':
+    from transformers import AutoTokenizer, AutoModelForCausalLM
     model = AutoModelForCausalLM.from_pretrained(
         "meta-llama/Meta-Llama-3-8B-Instruct",
     ).to("cuda:0")
@@ -0,0 +1,126 @@
+'''
+Maps the free-form regulation citations of model outputs ("45 CFR §164.502(a)", "Art. 6(1)(a)",
+"article 6 (1)", "Article 10(2)(a)") to the canonical ids of a RegulationIndex.
+
+Resolution order:
+    1. alias table, precomputed per domain from every id of the index (and the GDPR article titles)
+    2. the domain id pattern on the normalised citation
+    3. fuzzy fallback: the nearest existing ancestor of the parsed id (e.g. a paragraph that is not
+       in the KB falls back to its article), or the closest alias by string similarity when no id
+       can be parsed at all
+'''
+import difflib
+import re
+
+### rewrites applied before any lookup, in order
+NORMALIZATIONS = [
+    (re.compile(r"\b\d+\s*c\.?f\.?r\.?\s*(part\s*)?"), ""),
+    (re.compile(r"§+"), " "),
+    (re.compile(r"\b(sec\.|section)\s*(?=\d)"), ""),
+    (re.compile(r"\bart(\.|icle)?\s*(?=\d)"), "article "),
+    (re.compile(r"\b(gdpr|hipaa|eu ai act|ai act)\b"), ""),
+    (re.compile(r"\s+(?=\()"), ""),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def normalize_citation(text):
+    text = text.lower().strip().strip('"').strip()
+    for pattern, replacement in NORMALIZATIONS:
+        text = pattern.sub(replacement, text)
+    return text.strip(" .,;:-")
+
+
+class CitationResolver:
+    '''
+    id_index: agents.id_index.RegulationIndex, the ids citations are resolved to
+    fuzzy_cutoff: float, minimal difflib similarity for the string fallback, 1 disables it
+    '''
+    def __init__(self, id_index, fuzzy_cutoff=0.9):
+        self.id_index = id_index
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.aliases = self.build_aliases()
+        self.counts = {"exact": 0, "alias": 0, "pattern": 0, "fuzzy": 0, "missed": 0}
+        self.responses_recovered = 0
+        ### citation -> (how, id), the same citations come back in every round
+        self.resolved = {}
+
+    def alias_forms(self, id, node):
+        ### the spellings models use for id, before normalisation
+        forms = [id]
+        forms += node["keys"]
+        path = self.id_index.parse(id)
+        if self.id_index.domain == 'HIPAA':
+            forms += [f"§ {id}", f"45 CFR {id}", f"section {id}"]
+        elif self.id_index.domain == 'GDPR':
+            number = path[0].split(" ")[1]
+            kind = "Recital" if path[0].startswith("recital") else "Article"
+            forms += [f"{kind} {number}" + "".join(f" ({part})" for part in path[1:]),
+                      f"{kind} {number}" + "".join(f".{part}" for part in path[1:])]
+            if len(path) == 1 and kind == "Article" and node["content"]:
+                ### the content of an article row is its title, e.g. "Lawfulness of processing"
+                forms.append(node["content"])
+        else:
+            number = path[0][len("article"):]
+            forms += [f"Article {number}" + "".join(f"({part})" for part in path[1:]),
+                      f"Article {number}" + "".join(f" ({part})" for part in path[1:])]
+        return forms
+
+    def build_aliases(self):
+        aliases = {}
+        for id, node in self.id_index.nodes.items():
+            for form in self.alias_forms(id, node):
+                aliases.setdefault(normalize_citation(form), id)
+        return aliases
+
+    def resolve(self, text):
+        '''
+        Canonical id cited by text, None if nothing close exists in the KB.
+        '''
+        if text not in self.resolved:
+            self.resolved[text] = self.lookup(text)
+        how, id = self.resolved[text]
+        self.counts[how] += 1
+        return id
+
+    def lookup(self, text):
+        if text in self.id_index.nodes:
+            return "exact", text
+        normalized = normalize_citation(text)
+        if normalized in self.aliases:
+            return "alias", self.aliases[normalized]
+        path = self.id_index.parse(normalized)
+        if path is not None:
+            ### walk up to the nearest id of the KB, an id outside the KB (e.g. "Article 999") stays unresolved
+            for depth in range(len(path), 0, -1):
+                id = self.id_index.format(path[:depth])
+                if id in self.id_index.nodes:
+                    return ("pattern" if depth == len(path) else "fuzzy"), id
+            return "missed", None
+        ### misspelt citations without a parsable id, e.g. "Artcle 6(1)"
+        if self.fuzzy_cutoff < 1 and normalized:
+            close = difflib.get_close_matches(normalized, list(self.aliases), n=1, cutoff=self.fuzzy_cutoff)
+            if close:
+                return "fuzzy", self.aliases[close[0]]
+        return "missed", None
+
+    def resolve_response(self, citations):
+        '''
+        Resolve the citations parsed from one model response, deduplicated in order.
+        A response none of whose citations matches a KB id exactly would have come back empty; it is counted
+        in responses_recovered when the resolver maps some of them to KB ids. No model call is avoided here,
+        the count only measures how many responses the exact lookup alone would have lost.
+        '''
+        ids = []
+        exact = 0
+        for citation in citations:
+            exact += citation.lower().strip().strip('"') in self.id_index.nodes
+            id = self.resolve(citation)
+            if id is not None and id not in ids:
+                ids.append(id)
+        if citations and not exact and ids:
+            self.responses_recovered += 1
+        return ids
+
+    def stats(self):
+        return dict(self.counts, responses_recovered=self.responses_recovered)
@@ -0,0 +1,142 @@
+import hashlib
+import random
+import re
+import time
+
+
+DOMAINS = ['AI_ACT', 'GDPR', 'HIPAA', 'ACLU']
+
+### section ids that LlamaParser.section_pattern recognises, per domain
+SECTION_IDS = {
+    'HIPAA': ['164.502(a)', '164.506(c)', '164.508(a)(1)', '164.510(b)', '164.512(f)(1)', '164.530(c)'],
+    'GDPR': ['article 5(1)', 'article 6(1)', 'article 9(2)', 'article 13(1)', 'article 32(1)', 'recital 47'],
+    'AI_ACT': ['eu_ai_act.chapter2.article5.1', 'eu_ai_act.chapter3.section2-1.article10.2',
+               'eu_ai_act.chapter3.section2-1.article13.1', 'eu_ai_act.chapter4.article50.1'],
+    'ACLU': ['article 1(1)'],
+}
+
+DECISIONS = ['A. Prohibited', 'B. Permitted', 'C. Not related']
+
+
+def truncate_at_stop(response, stop_pattern):
+    ### what a backend honouring stop_pattern would have generated
+    match = re.search(stop_pattern, response, re.IGNORECASE)
+    return response[:match.end()].strip() if match else response
+
+
+class FakeChatbot:
+    '''
+    Deterministic stand-in for HuggingfaceChatbot that needs neither a GPU nor an api.
+    It recognises the prompt template from its output format and answers with a response that the
+    matching LlamaParser method accepts; the answer itself is a stable function of the prompt and seed.
+    latency: seconds slept per respond_batch call (one "generate"), plus token_latency per requested new token
+    failure_rate: probability of answering with an unparsable response, to exercise the retry paths
+    deterministic: bool, report greedy decoding (voting rounds are collapsed) or sampling (rounds are sampled at once)
+    '''
+    def __init__(self, latency=0.0, token_latency=0.0, failure_rate=0.0, seed=42, deterministic=True):
+        self.model_name = 'fake'
+        self.latency = latency
+        self.token_latency = token_latency
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self.deterministic = deterministic
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.generated = 0
+
+    def respond(self, message, max_new_tokens=128, stop_pattern=None, prefix=None):
+        return self.respond_batch([message], max_new_tokens, stop_pattern, [prefix])[0]
+
+    def respond_batch(self, messages, max_new_tokens=128, stop_pattern=None, prefixes=None):
+        self.calls += 1
+        self.generated += len(messages)
+        if self.latency or self.token_latency:
+            time.sleep(self.latency + self.token_latency * max_new_tokens)
+        responses = [self.generate(message) for message in messages]
+        if stop_pattern:
+            responses = [truncate_at_stop(response, stop_pattern) for response in responses]
+        return responses
+
+    def is_deterministic(self):
+        return self.deterministic
+
+    def respond_n(self, message, n, max_new_tokens=128, stop_pattern=None, prefix=None):
+        ### one call answering n copies of the prompt, as a sampling backend would
+        return self.respond_batch([message] * n, max_new_tokens, stop_pattern)
+
+    def score_continuations(self, messages, continuations):
+        ### one forward pass: a stable pseudo log-likelihood per (message, continuation)
+        self.calls += 1
+        self.generated += len(messages)
+        if self.latency:
+            time.sleep(self.latency)
+        scores = []
+        for message in messages:
+            digests = [hashlib.md5(f"{self.seed}{continuation}{message}".encode('utf-8')).hexdigest()
+                       for continuation in continuations]
+            scores.append([-len(continuation) / 4 - int(digest, 16) % 1000 / 250
+                           for continuation, digest in zip(continuations, digests)])
+        return scores
+
+    def score_next_token(self, messages, options, answer_prefix=""):
+        return self.score_continuations([message + answer_prefix for message in messages], options)
+
+    def pick(self, message, options, salt=''):
+        digest = hashlib.md5(f"{self.seed}{salt}{message}".encode('utf-8')).hexdigest()
+        return options[int(digest, 16) % len(options)]
+
+    def get_domain(self, message):
+        found = [(message.find(domain), domain) for domain in DOMAINS if domain in message]
+        return min(found)[1] if found else 'HIPAA'
+
+    def get_candidates(self, message, header):
+        ### the "id - content" lines listed after header in the prompt
+        if header not in message:
+            return []
+        block = message[message.index(header) + len(header):]
+        return [line.strip() for line in block.split('\n') if ' - ' in line][:3]
+
+    def generate(self, message):
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            return "I am not sure how to answer this question."
+        domain = self.get_domain(message)
+        ids = SECTION_IDS[domain]
+        first_id = self.pick(message, ids)
+        second_id = self.pick(message, ids, salt='second')
+
+        if "**Choice**: A or B or C or D" in message:
+            ### parse_MCQ
+            choice = self.pick(message, ['A', 'B', 'C', 'D'])
+            return f"**Analysis**: The information flow matches option {choice}.\n**Choice**: {choice}"
+        if "Lookup:" in message and "Selected:" in message:
+            ### parse_law_beam
+            return (f"Lookup:\n1. {first_id} - needs more details.\n"
+                    f"Selected:\n1. {second_id} - directly applies to the event.")
+        if f"Generated {domain} Content" in message:
+            ### parse_law_content
+            event = message.split('Event Details:')[-1].strip().split('\n')[0]
+            return (f"**Execution**:\n1. The key players exchange information.\n"
+                    f"**Generated {domain} Content**:\n1. The {domain} Rule with its content: {event}\n"
+                    f"**References**:\n{first_id}")
+        if "Generated Relevant" in message or "Generated Related" in message:
+            ### parse_law
+            return (f"Generated Related {domain} Regulations:\n"
+                    f"1. {first_id} - applies to the event.\n2. {second_id} - applies to the event.")
+        if "Regulation Candidates:" in message:
+            ### parse_law_filter
+            candidates = self.get_candidates(message, "Regulation Candidates:")
+            lines = [f"{i + 1}. {candidate}" for i, candidate in enumerate(candidates)]
+            return f"Seleted Related {domain} Regulations:\n" + "\n".join(lines)
+        if "Judgment" in message:
+            ### parse_law_judge / parse_decision_judge
+            judgment = self.pick(message, ['yes', 'no'])
+            return f"**Judgment**: {judgment}\n**Reason**: The regulation and the event share their context."
+        if "answer yes or no" in message:
+            ### parse_yes_no
+            return self.pick(message, ['Yes', 'No']) + ", the regulation addresses the same context."
+        if "Choice" in message:
+            ### parse_decision / parse_cot_auto
+            options = [decision for decision in DECISIONS if decision in message] or DECISIONS
+            choice = self.pick(message, options)
+            return f"**Execution**:\n1. - The event was analysed.\n\nChoice: {choice}\nReason: decided by the fake backend."
+        return "Reason: the fake backend has no template for this prompt."
@@ -0,0 +1,154 @@
+'''
+Regulation id index: canonical id -> node (KB key, content, parent, children), built once from the
+regulation_id column of a KB so that content, ancestor and child lookups are dict accesses.
+
+Canonical ids per domain (lower case, whatever the citation style):
+    HIPAA   164.502(a)(1)(i)        from "164.502(a)(1)(i)", "§ 164.502(a)(1)(i)"
+    GDPR    article 6(1), recital 47 from "Article 6(1)", "Art. 6(1)", "Recital 47"
+    AI_ACT  article10.2.a           from "EU_AI_ACT.chapter3.section3-2.article10.2.a", "Article 10(2)(a)"
+Ancestors that are not rows of the KB (e.g. "164.502", "article10") are added as nodes without a KB key.
+KB rows with the same canonical id (e.g. HIPAA "164.504(a)planadministrationfunctions" and
+"164.504(a)summaryhealthinformation") share one node, which keeps every key and joins their contents in KB order.
+'''
+import os
+import re
+
+
+ID_PATTERNS = {
+    'HIPAA': re.compile(r"(\d+\.\d+)((?:\([0-9a-z]+\))*)"),
+    'GDPR': re.compile(r"(article|art\.|recital)s?\s*(\d+)((?:\(\d+\))*)"),
+    'AI_ACT': re.compile(r"article\s*(\d+)((?:\.[0-9a-z]+\b|\([0-9a-z]+\))*)"),
+}
+COMPONENT_PATTERN = re.compile(r"[0-9a-z]+")
+
+
+def detect_domain(ids):
+    ### the KB domain its regulation ids are written for
+    ids = [str(id).lower() for id in ids]
+    if any('eu_ai_act' in id for id in ids):
+        return 'AI_ACT'
+    if any(id.strip('"').startswith(('article', 'recital')) for id in ids):
+        return 'GDPR'
+    return 'HIPAA'
+
+
+class RegulationIndex:
+    '''
+    kb: dict, regulation id -> KB item, e.g. the output of utils.KB_to_dict
+    domain: str, one of ID_PATTERNS, detected from the ids if None
+    '''
+    def __init__(self, kb, domain=None):
+        self.domain = domain if domain in ID_PATTERNS else detect_domain(kb.keys())
+        self.pattern = ID_PATTERNS[self.domain]
+        self.nodes = {}
+        self.roots = []
+        ### citation text -> canonical id, ids are looked up again in every round
+        self.resolved = {}
+        ### canonical id -> KB keys, for the ids of several KB rows
+        self.collisions = {}
+        for key, item in kb.items():
+            path = self.parse(key)
+            if path is None:
+                continue
+            node = self.add(path)
+            content = item["regulation_content"].strip().replace("\n", " ")
+            if node["key"] is None:
+                node["key"] = key.strip()
+                node["content"] = content
+            else:
+                node["content"] += " " + content
+                self.collisions[node["id"]] = node["keys"] + [key.strip()]
+            node["keys"].append(key.strip())
+        if self.collisions:
+            print(f"{len(self.collisions)} {self.domain} regulation ids of several KB rows, their contents are joined: "
+                  + ", ".join(self.collisions))
+        self.fill_content(self.roots)
+
+    def parse(self, text):
+        ### path of the first regulation id cited in text, e.g. ('164.502', 'a', '1'), None if there is none
+        match = self.pattern.search(text.lower())
+        if match is None:
+            return None
+        return self.match_path(match)
+
+    def match_path(self, match):
+        groups = match.groups()
+        if self.domain == 'GDPR':
+            kind = 'recital' if groups[0] == 'recital' else 'article'
+            return (f"{kind} {groups[1]}",) + tuple(COMPONENT_PATTERN.findall(groups[2]))
+        if self.domain == 'AI_ACT':
+            return (f"article{groups[0]}",) + tuple(COMPONENT_PATTERN.findall(groups[1]))
+        return (groups[0],) + tuple(COMPONENT_PATTERN.findall(groups[1]))
+
+    def format(self, path):
+        if self.domain == 'AI_ACT':
+            return ".".join(path)
+        return path[0] + "".join(f"({part})" for part in path[1:])
+
+    def canonical(self, text):
+        if text not in self.resolved:
+            path = self.parse(text)
+            self.resolved[text] = self.format(path) if path else None
+        return self.resolved[text]
+
+    def find_all(self, text):
+        ### canonical ids of every regulation cited in text, in order
+        return [self.format(self.match_path(match)) for match in self.pattern.finditer(text.lower())]
+
+    def add(self, path):
+        id = self.format(path)
+        if id in self.nodes:
+            return self.nodes[id]
+        parent = self.add(path[:-1])["id"] if len(path) > 1 else None
+        node = {"id": id, "key": None, "keys": [], "content": "", "parent": parent, "children": []}
+        self.nodes[id] = node
+        if parent is None:
+            self.roots.append(id)
+        else:
+            self.nodes[parent]["children"].append(id)
+        return node
+
+    def fill_content(self, ids):
+        ### ancestors outside the KB get the text their children share (the headings of the path)
+        for id in ids:
+            node = self.nodes[id]
+            self.fill_content(node["children"])
+            if node["key"] is None and node["children"]:
+                contents = [self.nodes[child]["content"] for child in node["children"]]
+                prefix = os.path.commonprefix(contents)
+                node["content"] = prefix[:prefix.rfind(" ") + 1].strip() if len(contents) > 1 else prefix
+
+    def get(self, text):
+        ### node of the id cited in text, None if it is not in the KB
+        id = self.canonical(text)
+        return self.nodes.get(id) if id else None
+
+    def content(self, text):
+        node = self.get(text)
+        return node["content"] if node else ""
+
+    def parent(self, text):
+        node = self.get(text)
+        return node["parent"] if node else None
+
+    def ancestors(self, text):
+        ### ids from the root down to the parent of the cited id
+        node = self.get(text)
+        ancestors = []
+        while node is not None and node["parent"] is not None:
+            ancestors.append(node["parent"])
+            node = self.nodes[node["parent"]]
+        return ancestors[::-1]
+
+    def children(self, text=""):
+        ### ids one level below the cited id, the top-level ids for an empty text
+        if not text:
+            return list(self.roots)
+        node = self.get(text)
+        return list(node["children"]) if node else []
+
+    def __contains__(self, text):
+        return self.get(text) is not None
+
+    def __len__(self):
+        return len(self.nodes)
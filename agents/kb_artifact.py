@@ -0,0 +1,148 @@
+'''
+Prebuilt retrieval structures of a domain knowledge base (regulation dict, Trie, regulation id index, BM25 index),
+compiled once by compile_kb.py and loaded by AgentSearch instead of being rebuilt on every run.
+
+An artifact is the directory <artifact_dir>/<domain>/<analyzer>/ holding
+    meta.json           format version, analyzer settings, sha256 of the source Arrow files and of the code building
+                        the pickled objects
+    search.pkl          kb dict, Trie, regulation id index and citation aliases, regulation ids and texts, analyzer vocabulary,
+                        BM25 statistics
+    bm25_*.npy          CSR arrays of the SparseBM25 weight matrix, memory-mapped on load (numpy only)
+It is rebuilt when the format version, the analyzer, the Arrow files of the domain or the code of the pickled classes
+change.
+'''
+import glob
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import time
+
+import config
+from agents.analyzer import get_analyzer
+from agents.bm25 import BM25
+from agents.citations import CitationResolver
+from agents.id_index import RegulationIndex
+from utils import Trie, KB_to_dict, load_local_HF_dataset
+
+KB_ARTIFACT_VERSION = 4
+SPARSE_ARRAYS = ('data', 'indices', 'indptr')
+### modules of agents/ whose classes are pickled in the artifact or build its arrays
+ARTIFACT_MODULES = ('analyzer.py', 'bm25.py', 'bm25_sparse.py', 'citations.py', 'id_index.py')
+
+
+def build_search_index(kb, analyzer='whitespace'):
+    '''
+    The structures AgentSearch retrieves from, built from a KB_to_dict dictionary.
+    analyzer: str, the agents.analyzer.ANALYZERS entry turning the regulation texts into BM25 terms
+    '''
+    trie = Trie("", "")
+    for value in kb.values():
+        trie.add_sons(value["regulation_content"])
+    kb_keys = [key.strip() for key in kb.keys()]
+    kb_context = [kb[key]["regulation_content"].strip().replace("\n", " ") for key in kb.keys()]
+    analyzer = get_analyzer(analyzer)
+    corpus = [analyzer.encode(text, add=True) for text in kb_context]
+    id_index = RegulationIndex(kb)
+    return {"kb": kb, "trie": trie, "id_index": id_index, "resolver": CitationResolver(id_index),
+            "kb_keys": kb_keys, "kb_context": kb_context, "analyzer": analyzer, "bm25": BM25(corpus)}
+
+
+def source_hash(domain):
+    ### sha256 of the Arrow files the KB of the domain is loaded from
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(config.HF_KBs_path, domain, '*.arrow'))):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def code_hash():
+    ### sha256 of the code of the pickled objects and of the arrays, a change to it makes the artifacts stale
+    digest = hashlib.sha256()
+    for name in ARTIFACT_MODULES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), 'rb') as f:
+            digest.update(f.read())
+    for obj in (Trie, KB_to_dict, build_search_index):
+        digest.update(inspect.getsource(obj).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def compile_kb_artifact(domain, artifact_dir, kb=None, analyzer='whitespace'):
+    '''
+    Build the search index of domain and write it to artifact_dir/domain/analyzer.
+    kb: dict, the KB_to_dict of the domain, loaded from HF_KBs_path if None
+    '''
+    if kb is None:
+        kb = KB_to_dict(load_local_HF_dataset(os.path.join(config.HF_KBs_path, domain)))
+    index = build_search_index(kb, analyzer)
+    path = os.path.join(artifact_dir, domain, analyzer)
+    os.makedirs(path, exist_ok=True)
+    ### meta.json is written last, an interrupted compile is never loaded
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        os.remove(os.path.join(path, 'meta.json'))
+    with open(os.path.join(path, 'search.pkl'), 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    sparse = False
+    try:
+        import numpy as np
+        from agents.bm25_sparse import SparseBM25
+        weights = SparseBM25(index["bm25"]).weights
+        for name in SPARSE_ARRAYS:
+            np.save(os.path.join(path, f'bm25_{name}.npy'), getattr(weights, name))
+        sparse = True
+    except ImportError:
+        pass
+
+    meta = {"version": KB_ARTIFACT_VERSION, "domain": domain, "source_hash": source_hash(domain),
+            "code_hash": code_hash(), "analyzer": index["analyzer"].config(),
+            "num_regulations": len(kb), "sparse": sparse, "created": time.time()}
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return index
+
+
+def load_kb_artifact(domain, artifact_dir, analyzer='whitespace'):
+    '''
+    The search index stored in artifact_dir/domain/analyzer, None if it is missing or stale.
+    '''
+    path = os.path.join(artifact_dir, domain, analyzer)
+    try:
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != KB_ARTIFACT_VERSION or meta.get("source_hash") != source_hash(domain):
+        return None
+    if meta.get("code_hash") != code_hash():
+        return None
+    if meta.get("analyzer") != get_analyzer(analyzer).config():
+        return None
+    with open(os.path.join(path, 'search.pkl'), 'rb') as f:
+        index = pickle.load(f)
+
+    index["sparse_bm25"] = None
+    if meta.get("sparse"):
+        try:
+            import numpy as np
+            from agents.bm25_sparse import SparseBM25
+        except ImportError:
+            return index
+        arrays = [np.load(os.path.join(path, f'bm25_{name}.npy'), mmap_mode='r') for name in SPARSE_ARRAYS]
+        index["sparse_bm25"] = SparseBM25.from_arrays(index["bm25"], *arrays)
+    return index
+
+
+def get_kb_artifact(domain, artifact_dir, analyzer='whitespace'):
+    '''
+    Load the search index of domain from artifact_dir, compiling it first if it is missing or stale.
+    '''
+    index = load_kb_artifact(domain, artifact_dir, analyzer)
+    if index is None:
+        print(f'compiling the {domain} KB artifact into {artifact_dir}...')
+        compile_kb_artifact(domain, artifact_dir, analyzer=analyzer)
+        index = load_kb_artifact(domain, artifact_dir, analyzer)
+    return index
@@ -0,0 +1,92 @@
+'''
+Packs the reference regulations of a decision prompt into a token budget, by decreasing relevance score,
+instead of sampling MAX_REFERENCE_NUM of them at random.
+
+Tokens are counted with the tokenizer of the local model, with tiktoken for api models when it is installed,
+and estimated as 4 characters per token otherwise.
+'''
+import re
+
+### sentence ends, a reference too long for the remaining budget is cut after the last one that fits
+SENTENCE_END = re.compile(r"(?<=[.;:!?])\s+")
+
+
+class TokenCounter:
+    '''
+    tokenizer: a HF tokenizer, or anything with an encode(text) method returning a list of tokens (tiktoken)
+    '''
+    def __init__(self, tokenizer=None):
+        self.tokenizer = tokenizer
+
+    def encode(self, text):
+        if hasattr(self.tokenizer, 'name_or_path'):
+            ### HF tokenizer, the special tokens belong to the chat template, not to the references
+            return self.tokenizer(text, add_special_tokens=False).input_ids
+        return self.tokenizer.encode(text)
+
+    def count(self, text):
+        if self.tokenizer is None:
+            return len(text) // 4 + 1
+        return len(self.encode(text))
+
+
+def get_token_counter(chatbot=None, api_model=''):
+    '''
+    The counter matching the backend of an AgentAction: the HF tokenizer of the chatbot, tiktoken for the
+    api model (optional dependency), or the character estimate.
+    '''
+    if getattr(chatbot, 'tokenizer', None) is not None:
+        return TokenCounter(chatbot.tokenizer)
+    if api_model:
+        try:
+            import tiktoken
+        except ImportError:
+            return TokenCounter()
+        try:
+            return TokenCounter(tiktoken.encoding_for_model(api_model))
+        except KeyError:
+            return TokenCounter(tiktoken.get_encoding('cl100k_base'))
+    return TokenCounter()
+
+
+def truncate_sentences(text, max_tokens, counter):
+    '''
+    The longest prefix of text made of whole sentences that fits max_tokens, "" if the first sentence does not fit.
+    '''
+    sentences = SENTENCE_END.split(text)
+    kept = ""
+    for sentence in sentences:
+        candidate = f"{kept} {sentence}" if kept else sentence
+        if counter.count(candidate) > max_tokens:
+            break
+        kept = candidate
+    return kept
+
+
+def pack_references(references, budget, counter, max_items=None, min_tokens=32):
+    '''
+    references: list of (text, score), packed by descending score (stable for equal scores)
+    budget: int, the tokens available to the joined references
+    max_items: int, the number of references kept at most, no limit if None
+    min_tokens: int, a reference is only truncated to fit when at least this many tokens are left
+    Returns the packed texts, in packing order.
+    '''
+    packed = []
+    used = 0
+    newline = counter.count("\n")
+    for text, _ in sorted(references, key=lambda reference: -reference[1]):
+        if max_items is not None and len(packed) >= max_items:
+            break
+        ### every reference after the first one is preceded by a newline in the prompt
+        remaining = budget - used - (newline if packed else 0)
+        tokens = counter.count(text)
+        if tokens > remaining:
+            if remaining < min_tokens:
+                continue
+            text = truncate_sentences(text, remaining, counter)
+            if not text:
+                continue
+            tokens = counter.count(text)
+        packed.append(text)
+        used += tokens + (newline if len(packed) > 1 else 0)
+    return packed
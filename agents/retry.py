@@ -0,0 +1,139 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+
+import openai
+
+
+class CompletionFailure(Exception):
+    '''
+    Returned by the api backends instead of an empty response when a request cannot be completed, and by
+    HuggingfaceChatbot for a prompt that does not fit the context window.
+    reason is "permanent" for errors that retrying cannot fix (e.g. 400/401/404), "exhausted" when
+    max_retries transient errors happened in a row and "budget" when the run has no retries left.
+    '''
+    def __init__(self, reason, error=None, attempts=0):
+        super().__init__(f"completion failed ({reason}) after {attempts} attempt(s): {error}")
+        self.reason = reason
+        self.error = error
+        self.attempts = attempts
+
+
+class RetryBudget:
+    '''
+    Number of retries shared by every request of a run, so that a failing backend cannot multiply
+    the run time by max_retries. A budget of -1 is unlimited.
+    '''
+    def __init__(self, total=-1):
+        self.total = total
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.total >= 0 and self.used >= self.total:
+                return False
+            self.used += 1
+            return True
+
+
+def error_status(error):
+    return getattr(error, "status_code", None)
+
+def is_retryable(error):
+    '''
+    429, 408, 409 and 5xx responses, timeouts and connection errors are transient, other 4xx are permanent.
+    Errors that are not from the http layer (e.g. an empty message) are retried as before.
+    '''
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    status = error_status(error)
+    if status is None:
+        return True
+    return status in (408, 409, 429) or status >= 500
+
+def retry_after(error):
+    ### seconds requested by the server through the Retry-After(-ms) headers, None if absent
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        ### neither seconds nor an HTTP date, the backoff delay is used
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class RetryPolicy:
+    '''
+    Jittered exponential backoff: the n-th retry waits uniformly in [0, min(max_delay, base_delay * 2**n)],
+    or what the server asked for with Retry-After.
+    '''
+    def __init__(self, max_retries=5, base_delay=1.0, max_delay=60.0, budget=None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget if budget is not None else RetryBudget()
+
+    def delay(self, attempt, error):
+        requested = retry_after(error)
+        if requested is not None:
+            return min(requested, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def next_delay(self, attempt, error, max_retries=None):
+        '''
+        Return how long to wait before retrying after the attempt-th failure, or the CompletionFailure to give up with.
+        '''
+        max_retries = self.max_retries if max_retries is None else max_retries
+        if not is_retryable(error):
+            return CompletionFailure("permanent", error, attempt + 1)
+        if attempt + 1 >= max_retries:
+            return CompletionFailure("exhausted", error, attempt + 1)
+        if not self.budget.acquire():
+            return CompletionFailure("budget", error, attempt + 1)
+        return self.delay(attempt, error)
+
+    def call(self, fn, max_retries=None):
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except Exception as e:
+                delay = self.next_delay(attempt, e, max_retries)
+                if isinstance(delay, CompletionFailure):
+                    print(delay)
+                    return delay
+                print(f"Retryable error: {e}. Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
+                attempt += 1
+
+    async def acall(self, fn, max_retries=None):
+        attempt = 0
+        while True:
+            try:
+                return await fn()
+            except Exception as e:
+                delay = self.next_delay(attempt, e, max_retries)
+                if isinstance(delay, CompletionFailure):
+                    print(delay)
+                    return delay
+                print(f"Retryable error: {e}. Retrying in {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
+                attempt += 1
@@ -0,0 +1,81 @@
+'''
+BM25 index size and retrieval quality of each analyzer in agents/analyzer.py.
+
+The query of a case is its case_content and the relevant regulations are its followed_articles and
+violated_articles. A gold article counts as recalled when one of the top-k regulations belongs to it
+(same article for GDPR and AI_ACT, same section, e.g. 164.512, for HIPAA); recall@k is averaged over the
+cases that cite at least one article.
+
+    python benchmarks/bench_analyzer.py --domain GDPR+HIPAA+AI_ACT --k 5+10+20
+
+Stopword removal helps GDPR and AI_ACT but lowers the HIPAA recall@5 (.541 whitespace, .415 standard, .456 stem),
+HIPAA is best left on the whitespace analyzer.
+'''
+import argparse
+import pickle
+import re
+import time
+import tracemalloc
+
+from common import load_cases, load_kb
+
+from agents.analyzer import ANALYZERS
+from agents.bm25_sparse import SparseBM25
+from agents.kb_artifact import build_search_index
+
+
+def article_of(domain, text):
+    ### the article (section for HIPAA) a regulation id or a gold label belongs to
+    text = text.lower()
+    pattern = r"(\d+\.\d+)" if domain == 'HIPAA' else r"article\s*(\d+)"
+    match = re.search(pattern, text)
+    return match.group(1) if match else None
+
+
+def recall_at_k(domain, index, cases, ks):
+    articles = [article_of(domain, key) for key in index["kb_keys"]]
+    queries = [index["analyzer"].encode(case['case_content']) for case in cases]
+    indices, _ = SparseBM25(index["bm25"]).get_top_k_batch(queries, max(ks))
+    recalls = {k: [] for k in ks}
+    for case, top in zip(cases, indices.tolist()):
+        gold = {article_of(domain, item) for item in case['followed_articles'] + case['violated_articles']}
+        gold.discard(None)
+        if not gold:
+            continue
+        for k in ks:
+            retrieved = {articles[idx] for idx in top[:k]}
+            recalls[k].append(len(gold & retrieved) / len(gold))
+    return {k: sum(values) / len(values) for k, values in recalls.items()}, len(recalls[ks[0]])
+
+
+def bench(domain, ks, num_cases):
+    kb = load_kb(domain)
+    cases = load_cases(domain)[:num_cases]
+    for name in ANALYZERS:
+        tracemalloc.start()
+        start = time.perf_counter()
+        index = build_search_index(kb, name)
+        build = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        bm25 = index["bm25"]
+        postings = sum(len(p) for p in bm25.postings.values())
+        size = len(pickle.dumps((index["analyzer"], bm25), protocol=pickle.HIGHEST_PROTOCOL))
+        recalls, num_gold = recall_at_k(domain, index, cases, ks)
+        recall = "".join(f"{recalls[k]:>8.3f}" for k in ks)
+        print(f"{domain:<8}{name:<12}{len(bm25.postings):>8}{postings:>10}{size / 2 ** 20:>9.2f}"
+              f"{memory / 2 ** 20:>9.2f}{build:>8.2f}{num_gold:>7}{recall}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--domain", type=str, default='GDPR+HIPAA+AI_ACT')
+    parser.add_argument("--k", type=str, default='5+10+20')
+    parser.add_argument("--num_cases", type=int, default=-1)
+    args = parser.parse_args()
+    ks = [int(k) for k in args.k.split('+')]
+    num_cases = None if args.num_cases < 0 else args.num_cases
+    print(f"{'domain':<8}{'analyzer':<12}{'vocab':>8}{'postings':>10}{'size MB':>9}{'mem MB':>9}{'build s':>8}"
+          f"{'cases':>7}" + "".join(f"{'R@' + str(k):>8}" for k in ks))
+    for domain in args.domain.split('+'):
+        bench(domain, ks, num_cases)
@@ -0,0 +1,67 @@
+'''
+BM25 retrieval as used by AgentSearch.search_related_regulations: the per-document scorer
+(get_score on every document, then a full sort) against the inverted index with heap top-k,
+and the sparse matrix backend scoring every case of the domain in one batch.
+The cases of each domain are the queries; the scorers must return the same top k.
+
+    python benchmarks/bench_bm25.py --domain GDPR+HIPAA+AI_ACT --k 5
+'''
+import argparse
+import time
+
+from common import load_cases, load_kb
+
+from agents.bm25 import BM25
+from agents.bm25_sparse import SparseBM25
+
+
+def old_top_k(bm25, query, k):
+    score_index = [(bm25.get_score(query, index), index) for index in range(bm25.corpus_size)]
+    return sorted(score_index, key=lambda x: x[0], reverse=True)[:k]
+
+
+def bench(domain, k, num_cases):
+    kb = load_kb(domain)
+    corpus = [value["regulation_content"].strip().replace("\n", " ").split() for value in kb.values()]
+    start = time.perf_counter()
+    bm25 = BM25(corpus)
+    build = time.perf_counter() - start
+    cases = load_cases(domain)
+    all_queries = [case['case_content'].split(" ") for case in cases]
+    queries = all_queries[:num_cases]
+
+    start = time.perf_counter()
+    old = [old_top_k(bm25, query, k) for query in queries]
+    old_time = time.perf_counter() - start
+    start = time.perf_counter()
+    new = [bm25.get_top_k(query, k) for query in queries]
+    new_time = time.perf_counter() - start
+
+    assert [[i for _, i in r] for r in old] == [[i for _, i in r] for r in new], f"{domain}: top-{k} differs"
+    print(f"{domain:<8}{bm25.corpus_size:>7} docs{len(queries):>6} queries{build:>8.2f}s build"
+          f"{old_time / len(queries) * 1000:>10.2f} ms/query old{new_time / len(queries) * 1000:>10.2f} ms/query index"
+          f"{old_time / new_time:>8.1f}x")
+
+    start = time.perf_counter()
+    sparse_bm25 = SparseBM25(bm25)
+    sparse_build = time.perf_counter() - start
+    start = time.perf_counter()
+    indices, _ = sparse_bm25.get_top_k_batch(all_queries, k)
+    batch_time = time.perf_counter() - start
+    start = time.perf_counter()
+    heap = [[i for _, i in bm25.get_top_k(query, k)] for query in all_queries]
+    heap_time = time.perf_counter() - start
+    ### summation order differs from the per-query scorer, a near tie may swap
+    same = sum(row == ref for row, ref in zip(indices.tolist(), heap))
+    print(f"{'':<8}{len(all_queries):>7} cases{sparse_build:>8.2f}s matrix{batch_time:>8.2f}s batch"
+          f"{heap_time:>8.2f}s index{same:>7}/{len(all_queries)} identical top-{k}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--domain", type=str, default='GDPR+HIPAA+AI_ACT')
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--num_cases", type=int, default=200)
+    args = parser.parse_args()
+    for domain in args.domain.split('+'):
+        bench(domain, args.k, args.num_cases)
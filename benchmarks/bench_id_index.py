@@ -0,0 +1,76 @@
+'''
+Regulation id lookups of AgentSearch.look_up_trie: the regex Trie walk, the RegulationIndex dict and the
+CitationResolver (aliases and fuzzy fallback on top of the index).
+The ids looked up are the KB regulation ids and the articles cited by the cases of each domain, then
+the case citations rewritten the way models write them ("Art. 6 (1)", "45 CFR § 164.502(a)");
+"found" counts the lookups returning some content.
+
+    python benchmarks/bench_id_index.py --domain GDPR+HIPAA+AI_ACT
+'''
+import argparse
+import time
+
+from common import load_cases, load_kb
+
+from agents.citations import CitationResolver
+from agents.id_index import RegulationIndex
+from utils import Trie
+
+
+def trie_look_up(trie, id_seq):
+    return " ".join(trie.search_content(id_seq))
+
+
+def rewrite(citation):
+    ### free-form spellings of a citation
+    citation = citation.split(" - ")[0]
+    return [citation.upper(), citation.replace("(", " ("), citation.replace("Article ", "Art. "),
+            f"45 CFR § {citation}", f"GDPR {citation}"]
+
+
+def bench(domain, repeat):
+    kb = load_kb(domain)
+    ids = [key.strip('"') for key in kb] + [item for case in load_cases(domain)
+                                              for item in case['followed_articles'] + case['violated_articles']]
+    start = time.perf_counter()
+    trie = Trie("", "")
+    for value in kb.values():
+        trie.add_sons(value["regulation_content"])
+    trie_build = time.perf_counter() - start
+    start = time.perf_counter()
+    index = RegulationIndex(kb)
+    index_build = time.perf_counter() - start
+    start = time.perf_counter()
+    resolver = CitationResolver(index)
+    resolver_build = time.perf_counter() - start + index_build
+
+    for name, build, look_up in [("trie", trie_build, lambda id: trie_look_up(trie, id)),
+                                 ("id index", index_build, index.content),
+                                 ("resolver", resolver_build, resolver.resolve)]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            found = sum(bool(look_up(id)) for id in ids)
+        elapsed = (time.perf_counter() - start) / repeat / len(ids)
+        print(f"{domain:<8}{name:<10}{build * 1000:>8.1f} ms build{elapsed * 1e6:>8.2f} us/lookup"
+              f"{found:>7}/{len(ids)} found")
+    print(f"{'':<8}resolver  {resolver.stats()}")
+    ### one "response" per case and spelling: a response without any exact id would have come back empty
+    resolver.responses_recovered = 0
+    for case in load_cases(domain):
+        citations = case['followed_articles'] + case['violated_articles']
+        for i in range(len(rewrite(''))):
+            resolver.resolve_response([rewrite(citation)[i] for citation in citations])
+    print(f"{'':<8}resolver  {resolver.responses_recovered} rewritten responses recovered")
+    variants = [variant for id in ids[len(kb):] for variant in rewrite(id)]
+    for name, look_up in [("id index", index.content), ("resolver", resolver.resolve)]:
+        found = sum(bool(look_up(variant)) for variant in variants)
+        print(f"{domain:<8}{name:<10}{found:>7}/{len(variants)} rewritten citations found")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--domain", type=str, default='GDPR+HIPAA+AI_ACT')
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    for domain in args.domain.split('+'):
+        bench(domain, args.repeat)
@@ -0,0 +1,65 @@
+'''
+Cold-start import time of the modules used by api runs and utilities.
+
+Each module is imported in a fresh interpreter, the wall time is measured and the heavy
+frameworks it pulled in are listed. Exits with status 1 if a module loads a heavy framework
+or takes longer than --max_seconds, so it can be used to catch import regressions.
+
+    python benchmarks/bench_import_time.py
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ['config', 'utils', 'parse_string', 'agents', 'agents.bm25', 'agents.cache', 'agents.agents']
+HEAVY_MODULES = ['torch', 'transformers', 'numpy', 'pandas', 'datasets', 'scipy']
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "heavy": [m for m in {heavy} if m in sys.modules]}}))
+'''
+
+
+def measure(module, repeat):
+    times = []
+    heavy = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                cwd=BASE_DIR, capture_output=True, text=True)
+        if output.returncode != 0:
+            return None, output.stderr.strip().split('\n')[-1]
+        result = json.loads(output.stdout.strip().split('\n')[-1])
+        times.append(result['seconds'])
+        heavy = result['heavy']
+    return min(times), heavy
+
+
+def main(args):
+    failed = False
+    print(f"{'module':<20}{'import (s)':>12}  heavy frameworks")
+    for module in args.modules.split('+'):
+        seconds, heavy = measure(module, args.repeat)
+        if seconds is None:
+            print(f"{module:<20}{'error':>12}  {heavy}")
+            failed = True
+            continue
+        print(f"{module:<20}{seconds:>12.3f}  {', '.join(heavy) if heavy else '-'}")
+        if heavy or seconds > args.max_seconds:
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", type=str, default='+'.join(MODULES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max_seconds", type=float, default=1.0)
+    args = parser.parse_args()
+    main(args)
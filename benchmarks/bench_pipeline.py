@@ -0,0 +1,86 @@
+'''
+Orchestration overhead of the agent pipelines, measured offline with FakeChatbot.
+
+The wall time of each pipeline is split into the simulated model time (latency of every
+generate call) and the remaining orchestration time (templating, parsing, retrieval, voting).
+
+    python benchmarks/bench_pipeline.py --domain GDPR --num_cases 50 --latency 0.01
+'''
+import argparse
+import copy
+import time
+
+from common import load_cases, load_kb
+
+import config
+from agents.agents import AgentAction, AgentContentSearch
+from agents.fake_chatbot import FakeChatbot
+from parse_string import LlamaParser
+from utils import get_case_elements
+
+
+def report(name, chatbot, num_cases, elapsed, latency):
+    model_time = chatbot.calls * latency
+    print(f"{name:<28}{num_cases / elapsed:>10.1f} cases/s{chatbot.calls:>8} calls{chatbot.generated:>8} prompts"
+          f"{elapsed:>9.2f}s total{elapsed - model_time:>9.2f}s orchestration")
+
+
+def bench_direct(args, cases):
+    for batch_size in [1, args.batch_size]:
+        chatbot = FakeChatbot(latency=args.latency, failure_rate=args.failure_rate, seed=args.seed)
+        agent = AgentAction(chatbot, template='prompts/direct_answer_prompt_with_ci_element.txt',
+                            parser_fn=LlamaParser().parse_decision, max_new_tokens=1024)
+        start = time.perf_counter()
+        for i in range(0, len(cases), batch_size):
+            batch_kwargs = []
+            for cur_case in cases[i:i + batch_size]:
+                kwargs = get_case_elements(cur_case)
+                kwargs.update(event=cur_case['case_content'], domain=args.domain)
+                batch_kwargs.append(kwargs)
+            agent.complete_batch(batch_kwargs, args.generation_round)
+        report(f"direct (batch_size={batch_size})", chatbot, len(cases), time.perf_counter() - start, args.latency)
+
+
+def bench_content_search(args, cases):
+    pipeline_args = copy.copy(args)
+    pipeline_args.kb = load_kb(args.domain)
+    ### greedy decoding collapses the voting rounds, sampling draws them in one call
+    for deterministic in [True, False]:
+        chatbot = FakeChatbot(latency=args.latency, failure_rate=args.failure_rate, seed=args.seed,
+                              deterministic=deterministic)
+        agents = AgentContentSearch(chatbot, pipeline_args, LlamaParser(domain=args.domain))
+        start = time.perf_counter()
+        for cur_case in cases:
+            agents.action(cur_case['case_content'])
+        name = f"AgentContentSearch ({'greedy' if deterministic else 'sampling'})"
+        report(name, chatbot, len(cases), time.perf_counter() - start, args.latency)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--domain", type=str, default='GDPR')
+    parser.add_argument("--num_cases", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--failure_rate", type=float, default=0.0)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=42)
+    ### AgentContentSearch settings, defaults of search_content_for_answer.py
+    parser.add_argument("--law_template", type=str, default="prompts/cot-knowledge-lookup-prompt.txt")
+    parser.add_argument("--law_filter_template", type=str, default="prompts/3-beam-law-filter-prompt.txt")
+    parser.add_argument("--law_judge_template", type=str, default="prompts/3-judge-regulation-prompt.txt")
+    parser.add_argument("--decision_making_template", type=str, default="prompts/4-cot-decision-making-merge.txt")
+    parser.add_argument("--lawyer_tokens", type=int, default=1024)
+    parser.add_argument("--law_filter_tokens", type=int, default=512)
+    parser.add_argument("--decision_tokens", type=int, default=512)
+    parser.add_argument("--law_judge_tokens", type=int, default=512)
+    parser.add_argument("--law_generation_round", type=int, default=3)
+    parser.add_argument("--law_filtering_round", type=int, default=3)
+    parser.add_argument("--generation_round", type=int, default=5)
+    parser.add_argument("--max_law_items", type=int, default=3)
+    parser.add_argument("--look_up_items", type=int, default=3)
+    parser.add_argument("--reference_tokens", type=int, default=config.DECISION_REFERENCE_TOKENS)
+    args = parser.parse_args()
+
+    cases = load_cases(args.domain)[:args.num_cases]
+    bench_direct(args, cases)
+    bench_content_search(args, cases)
@@ -0,0 +1,25 @@
+'''
+Helpers shared by the benchmarks: they read the jsonl copies under HF_cache, so that the
+benchmarks run without the datasets library.
+'''
+import json
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import config
+
+
+def read_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def load_kb(domain):
+    ### same layout as utils.KB_to_dict: lower-cased regulation id -> item
+    items = read_jsonl(os.path.join(config.HF_KBs_path, domain, 'data-00000-of-00001.jsonl'))
+    return {item['regulation_id'].lower(): item for item in items}
+
+def load_cases(domain):
+    return read_jsonl(os.path.join(config.HF_cases_path, domain, 'data-00000-of-00001.jsonl'))
@@ -0,0 +1,266 @@
+'''
+Cascade of the two answering strategies: every case is first answered by the cheap direct prompt
+(direct_answer.py), and only the cases it is not confident about are escalated to the retrieval and judge
+pipeline of search_content_for_answer.py (AgentContentSearch).
+
+The confidence of a direct answer is the share of its --direct_votes votes that agree with the majority
+decision (0 when no vote could be parsed), or with --decision_mode score (local models) the calibrated
+probability of its label. Cases below --confidence_threshold are escalated; a threshold
+above 1 escalates every case, which gives the accuracy of the full pipeline to compare with.
+With greedy decoding the votes of a prompt always agree, use a sampling backend (the api, or a
+generation config with do_sample) for the votes to carry a signal.
+
+    python cascade_answer.py --log_path logs/cascade/gpt-4o-mini.txt --api_name openai --direct_votes 3 --confidence_threshold 0.7
+'''
+import os
+import sys
+import config
+os.environ['HF_TOKEN'] = config.HF_TOKEN
+os.environ['HF_HOME'] = config.HF_HOME
+
+import argparse
+import copy
+import json
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+from parse_string import LlamaParser
+from agents.cache import get_response_cache
+from agents import AgentAction, AgentContentSearch, HuggingfaceChatbot, FakeChatbot
+from agents.kb_artifact import get_kb_artifact
+from utils import *
+from results import ResultWriter, case_record, config_hash, load_checkpoint, timed
+import random
+import time
+
+STRATEGY = 'cascade'
+
+
+def set_seeds(args, seed=None):
+    seed = args.seed if seed is None else seed
+    random.seed(seed)
+    ### numpy and torch are only needed (and imported) for local models
+    if not args.api_name and args.model != 'fake':
+        import numpy as np
+        import torch
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+
+
+def vote_decision(decisions):
+    '''
+    Majority decision of the direct votes and its confidence, the share of votes agreeing with it.
+    '''
+    labels = [decision["decision"] for decision in decisions if not isinstance(decision, Exception)]
+    if not labels:
+        return None, 0.0
+    label, count = Counter(labels).most_common(1)[0]
+    return label, count / len(decisions)
+
+
+def pipeline_requests(pipeline):
+    return sum(agent.num_requests for agent in [pipeline.lawyer_agent, pipeline.law_filter_agent,
+                                                pipeline.law_judge_agent, pipeline.decision_agent])
+
+
+class Cascade:
+    def __init__(self, chatbot, args, domain):
+        self.args = args
+        self.domain = domain
+        self.direct_agent = AgentAction(chatbot,
+                                        template = args.direct_template,
+                                        parser_fn = LlamaParser().parse_decision,
+                                        max_new_tokens = args.direct_tokens,
+                                        **vars(args))
+        self.pipeline = AgentContentSearch(chatbot, args, LlamaParser(domain = domain))
+
+    def action(self, case):
+        kwargs = get_case_elements(case)
+        kwargs.update(event=case['case_content'], domain=self.domain)
+        if self.args.decision_mode == 'score':
+            ### the confidence is the calibrated probability of the best label
+            scored = self.direct_agent.score_batch([kwargs], not self.args.no_calibration)[0]
+            direct_decision, confidence = scored["decision"], max(scored["probs"].values())
+            logging = {"direct_decision": direct_decision, "confidence": confidence, "direct_probs": scored["probs"]}
+        else:
+            votes = self.direct_agent.complete_n(self.args.direct_votes, self.args.generation_round, **kwargs)
+            direct_decision, confidence = vote_decision(votes)
+            logging = {"direct_decision": direct_decision, "confidence": confidence,
+                       "direct_response": [vote["response"] for vote in votes if not isinstance(vote, Exception)]}
+        logging["escalated"] = confidence < self.args.confidence_threshold
+        if logging["escalated"]:
+            logging.update(self.pipeline.action(case['case_content']))
+        ### the direct answer stands when the case is confident enough or the pipeline could not decide
+        if "decision" not in logging and direct_decision is not None:
+            logging["decision"] = direct_decision
+        return logging
+
+
+def main(args):
+    ### a shard runs every N-th case with its own log and results files, merged by launch_shards.py
+    shard = parse_shard(args.shard)
+    args.log_path = shard_path(args.log_path, shard)
+    set_seeds(args)
+    config_id = config_hash(args)
+    log(str(args)+"\n",args.log_path)
+    ### with prebuilt KB artifacts the KB datasets are only loaded to (re)compile them
+    KBs = None if args.kb_artifact_dir else get_local_KB_dataset()
+    cases = get_local_case_dataset()
+    if args.api_name:
+        chatbot = ''
+    elif args.model == 'fake':
+        ### offline backend to benchmark the pipeline without a model
+        chatbot = FakeChatbot(latency=args.fake_latency, failure_rate=args.fake_failure_rate, seed=args.seed)
+    else:
+        chatbot = HuggingfaceChatbot(args.model, prefix_cache=args.prefix_cache)
+
+    result_save_path = args.log_path.replace('.txt', '_results.txt')
+    ### one structured record per case, the text log only keeps the run arguments and the accuracies
+    results_path = shard_path(args.results_path, shard) if args.results_path else args.log_path.replace('.txt', '.jsonl')
+    ### the records of a previous run with the same config are its checkpoint
+    checkpoint = {} if args.no_resume else load_checkpoint(results_path, STRATEGY, config_id, full=True)
+    writer = ResultWriter(results_path)
+    for domain in args.domains.split('+'):
+        ### ACLU has no knowledge base to retrieve from
+        assert domain in ['GDPR', 'HIPAA', 'AI_ACT'], 'Invalid domain name'
+        case_dataset = cases[domain]
+        if args.kb_artifact_dir:
+            args.kb_artifact = get_kb_artifact(domain, args.kb_artifact_dir, args.analyzer)
+            args.kb = args.kb_artifact["kb"]
+        else:
+            args.kb_artifact = None
+            args.kb = KB_to_dict(KBs[domain])
+        args.domain = domain
+        cascade = Cascade(chatbot, args, domain)
+
+        results = []
+        direct_results = []
+        escalated = []
+        run_escalations = []
+        ### with the api, args.api_concurrency cases run the cascade at once; decisions are consumed in order
+        workers = args.api_concurrency if args.api_name else 1
+        executor = ThreadPoolExecutor(max_workers=workers)
+        ### cases completed by an interrupted run with the same config are not asked again
+        completed = checkpoint.get(domain, {})
+        if completed:
+            print(f'resuming {domain}: {len(completed)} cases already completed')
+        ids = shard_cases(len(case_dataset), shard)
+        pending = [i for i in ids if i not in completed]
+
+        def run_case(i):
+            ### only the torch sampling of a local model depends on the seed, and local models run the cases on one
+            ### thread, so the global RNGs are reseeded per case there; concurrent api cases are sampled by the
+            ### provider and never reseed the state the other threads share
+            if workers == 1:
+                set_seeds(args, case_seed(args.seed, domain, i))
+            return cascade.action(case_dataset[i])
+        decisions = executor.map(timed(run_case), pending)
+        for i in tqdm(ids):
+            if i in completed:
+                results.append(completed[i]["correct"])
+                direct_results.append(completed[i]["direct_correct"])
+                if completed[i]["escalated"]:
+                    escalated.append((completed[i]["direct_correct"], completed[i]["correct"]))
+                continue
+            cur_case = case_dataset[i]
+            decision, seconds = next(decisions)
+            norm_type = cur_case['norm_type']
+            label_list = label_transform(norm_type)
+            direct_result = decision["direct_decision"] is not None and decision["direct_decision"] in label_list
+            direct_results.append(direct_result)
+            result = "decision" in decision and decision["decision"].lower() in label_list
+            if decision["escalated"]:
+                escalated.append((direct_result, result))
+            run_escalations.append(decision["escalated"])
+            results.append(result)
+            record = case_record(domain, i, STRATEGY, norm_type, decision, result, seconds,
+                                 counter=cascade.direct_agent.token_counter, config=config_id)
+            record["extra"]["direct_correct"] = direct_result
+            writer.write(record)
+            print(sum(results) / len(results))
+        executor.shutdown()
+
+        acc = (sum(results) / len(results))
+        direct_acc = sum(direct_results) / len(direct_results)
+        ### cost in model requests; the full pipeline would have spent the average cost of an escalated case on every case
+        direct_cost = cascade.direct_agent.num_requests
+        pipeline_cost = pipeline_requests(cascade.pipeline)
+        ### only the cases run by this process spent requests, the resumed ones are left out of the costs
+        run_escalated = sum(run_escalations)
+        full_cost = pipeline_cost / run_escalated * len(pending) if run_escalated else float('nan')
+        cost_saved = 1 - (direct_cost + pipeline_cost) / full_cost if run_escalated else float('nan')
+        report = (f"domain: {domain} --- num_sample: {len(ids)} --- escalated: {len(escalated)}"
+                  f" --- direct accuracy: {direct_acc} --- cascade accuracy: {acc}"
+                  f" --- escalated direct accuracy: {sum(d for d, _ in escalated) / max(len(escalated), 1)}"
+                  f" --- escalated pipeline accuracy: {sum(p for _, p in escalated) / max(len(escalated), 1)}"
+                  f" --- requests: {direct_cost} direct + {pipeline_cost} pipeline"
+                  f" --- estimated full pipeline requests: {full_cost:.0f} --- cost saved: {cost_saved:.3f}\n")
+        print(report)
+        log(report, args.log_path)
+        log(str(f"domain: {domain} --- num_sample: {len(ids)} --- accuracy:{acc}\n"), args.log_path)
+        log(str(f"domain: {domain} --- num_sample: {len(ids)} --- accuracy:{acc}\n"), result_save_path)
+        log(report, result_save_path)
+    writer.close()
+    if args.cache_path:
+        log(str(f"response cache: {get_response_cache(args.cache_path).stats()}\n"), args.log_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="")
+    parser.add_argument("--log_path", type=str, default=os.path.join('logs','log.txt'))
+    ### JSONL (or .jsonl.zst) of the per-case records, next to the log by default
+    parser.add_argument("--results_path", type=str, default='')
+    ### rerun the cases already in --results_path instead of resuming from them
+    parser.add_argument("--no_resume", action="store_true")
+    ### "i/N": run only the i-th of N interleaved shards of the cases, see launch_shards.py
+    parser.add_argument("--shard", type=str, default='')
+
+    ### first stage
+    parser.add_argument("--direct_template", type=str, default="prompts/direct_answer_prompt.txt")
+    parser.add_argument("--direct_tokens", type=int, default=1024)
+    parser.add_argument("--direct_votes", type=int, default=3)
+    parser.add_argument("--confidence_threshold", type=float, default=0.7)
+    parser.add_argument("--decision_mode", type=str, default='generate', choices=['generate', 'score'])
+    parser.add_argument("--no_calibration", action="store_true")
+
+    ### second stage, defaults of search_content_for_answer.py
+    parser.add_argument("--law_template", type=str, default="prompts/cot-knowledge-lookup-prompt.txt")
+    parser.add_argument("--law_filter_template", type=str, default="prompts/3-beam-law-filter-prompt.txt")
+    parser.add_argument("--law_judge_template", type=str, default="prompts/3-judge-regulation-prompt.txt")
+    parser.add_argument("--decision_making_template", type=str, default="prompts/4-cot-decision-making-merge.txt")
+    parser.add_argument("--lawyer_tokens", type=int, default=1024)
+    parser.add_argument("--law_filter_tokens", type=int, default=512)
+    parser.add_argument("--decision_tokens", type=int, default=512)
+    parser.add_argument("--law_judge_tokens", type=int, default=512)
+    parser.add_argument("--law_generation_round", type=int, default=3)
+    parser.add_argument("--law_filtering_round", type=int, default=3)
+    parser.add_argument("--generation_round", type=int, default=5)
+    parser.add_argument("--max_law_items", type=int, default=3)
+    parser.add_argument("--look_up_items", type=int, default=3)
+    parser.add_argument("--reference_tokens", type=int, default=config.DECISION_REFERENCE_TOKENS)
+
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--fake_latency", type=float, default=0.0)
+    parser.add_argument("--fake_failure_rate", type=float, default=0.0)
+    parser.add_argument("--api_name", type=str, default='')
+    parser.add_argument("--domains", type=str, default='GDPR+HIPAA+AI_ACT')
+    parser.add_argument("--api_model", type=str, default=config.api_model)
+    parser.add_argument("--api_token", type=str, default=config.api_key)
+    parser.add_argument("--api_base_url", type=str, default=config.api_base_url)
+    parser.add_argument("--api_concurrency", type=int, default=1)
+    parser.add_argument("--api_rpm", type=int, default=0)
+    parser.add_argument("--api_tpm", type=int, default=0)
+    parser.add_argument("--max_retry", type=int, default=5)
+    parser.add_argument("--retry_budget", type=int, default=-1)
+    parser.add_argument("--cache_path", type=str, default='')
+    parser.add_argument("--cache_size", type=int, default=config.RESPONSE_CACHE_SIZE)
+    parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument("--early_stop", action="store_true")
+    parser.add_argument("--prefix_cache", action="store_true")
+    parser.add_argument("--kb_artifact_dir", type=str, default='')
+    parser.add_argument("--analyzer", type=str, default='whitespace', choices=['whitespace', 'standard', 'stem'])
+    args = parser.parse_args()
+    main(args)
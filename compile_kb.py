@@ -0,0 +1,30 @@
+import argparse
+import time
+
+import config
+
+from agents.kb_artifact import compile_kb_artifact, load_kb_artifact
+
+
+def main(args):
+    for domain in args.domains.split('+'):
+        assert domain in ['GDPR', 'HIPAA', 'AI_ACT'], 'Invalid domain name'
+        if not args.force and load_kb_artifact(domain, args.kb_artifact_dir, args.analyzer) is not None:
+            print(f'{domain}: artifact is up to date')
+            continue
+        start = time.perf_counter()
+        compile_kb_artifact(domain, args.kb_artifact_dir, analyzer=args.analyzer)
+        compiled = time.perf_counter() - start
+        start = time.perf_counter()
+        load_kb_artifact(domain, args.kb_artifact_dir, args.analyzer)
+        print(f'{domain}: compiled in {compiled:.2f}s, loads in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--domains", type=str, default='GDPR+HIPAA+AI_ACT')
+    parser.add_argument("--kb_artifact_dir", type=str, default=config.KB_artifact_path)
+    parser.add_argument("--analyzer", type=str, default='whitespace', choices=['whitespace', 'standard', 'stem'])
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+    main(args)
@@ -5,8 +5,11 @@ from dotenv import load_dotenv
 load_dotenv()
 
 logging_path = 'log.txt'
-openai_api = os.environ['OPENAI_API_KEY']
+### only required by api runs, local models and utilities import config without a key
+openai_api = os.environ.get('OPENAI_API_KEY', '')
 api_key = openai_api
+### point the api at another OpenAI-compatible server, e.g. a local stub
+api_base_url = os.environ.get('OPENAI_BASE_URL', '')
 CACHE_DIR = ''
 
 HF_TOKEN = ""
@@ -17,6 +20,13 @@ api_model = 'gpt-4o-mini'
 HF_cases_path = os.path.join(BASE_DIR, 'HF_cache', 'cases')
 HF_KBs_path = os.path.join(BASE_DIR, 'HF_cache', 'KBs')
 HF_MCQ_path = os.path.join(BASE_DIR, 'HF_cache', 'MCQ')
+### prebuilt retrieval structures written by compile_kb.py
+KB_artifact_path = os.path.join(BASE_DIR, 'HF_cache', 'artifacts')
 
 #other paras
-MAX_REFERENCE_NUM = 10
\ No newline at end of file
+MAX_REFERENCE_NUM = 10
+### tokens of the reference regulations packed into the decision prompt (see agents/packer.py)
+DECISION_REFERENCE_TOKENS = 3072
+RESPONSE_CACHE_SIZE = 100000
+### seconds a worker holds the cases it leased from a work_queue.WorkQueue before another worker may take them over
+QUEUE_LEASE_SECONDS = 1800
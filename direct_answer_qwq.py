@@ -7,40 +7,64 @@ os.environ['HF_HOME'] = config.HF_HOME
 import argparse
 import copy
 import json
-import pandas as pd
 import sys
 
 from tqdm import tqdm
 
 from parse_string import LlamaParser
-from agents import AgentAction, HuggingfaceChatbot
+from agents.cache import get_response_cache
+from agents import AgentAction, HuggingfaceChatbot, FakeChatbot
 from utils import *
+from results import ResultWriter, case_record, config_hash, load_checkpoint
+from work_queue import WorkQueue
 import random
-import numpy as np
-import torch
+import time
 
-def set_seeds(args):
-    random.seed(args.seed)
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
+STRATEGY = 'direct'
+
+def set_seeds(args, seed=None):
+    seed = args.seed if seed is None else seed
+    random.seed(seed)
+    ### numpy and torch are only needed (and imported) for local models
+    if not args.api_name and args.model != 'fake':
+        import numpy as np
+        import torch
+        np.random.seed(seed)
+        torch.manual_seed(seed)
 
 
 
 
 def main(args):
+    ### a shard runs every N-th case with its own log and results files, merged by launch_shards.py
+    shard = parse_shard(args.shard)
+    args.log_path = shard_path(args.log_path, shard)
     set_seeds(args)
+    config_id = config_hash(args)
     log(str(args),args.log_path)
     KBs = get_local_KB_dataset()
     cases = get_local_case_dataset()
     if args.api_name:
         chatbot = ''
+    elif args.model == 'fake':
+        ### offline backend to benchmark the pipeline without a model
+        chatbot = FakeChatbot(latency=args.fake_latency, failure_rate=args.fake_failure_rate, seed=args.seed)
     else:    
-        chatbot = HuggingfaceChatbot(args.model)
+        chatbot = HuggingfaceChatbot(args.model, prefix_cache=args.prefix_cache)
     agents = AgentAction(chatbot, 
                          parser_fn = LlamaParser().parse_decision,
                          template = args.prompt_template,
                          **vars(args))
     result_save_path = args.log_path.replace('.txt', '_results.txt')
+    ### one structured record per case, the text log only keeps the run arguments and the accuracies
+    results_path = shard_path(args.results_path, shard) if args.results_path else args.log_path.replace('.txt', '.jsonl')
+    ### the records of a previous run with the same config are its checkpoint
+    checkpoint = {} if args.no_resume or args.queue_path else load_checkpoint(results_path, STRATEGY, config_id)
+    ### with --queue_path the workers of a run lease their cases from a shared SQLite queue and write their records to it
+    queue = WorkQueue(args.queue_path, STRATEGY, config_id, args.lease_seconds) if args.queue_path else None
+    writer = queue or ResultWriter(results_path)
+    ### the score mode does not sample
+    batch_size = seeded_batch_size(args, agents, args.decision_mode == 'generate' and bool(shard or checkpoint or queue))
     for domain in args.domains.split('+'):
         assert domain in ['GDPR', 'HIPAA', 'AI_ACT', 'ACLU'], 'Invalid domain name' 
         if domain == 'ACLU':
@@ -48,51 +72,68 @@ def main(args):
         else:
             KB_dataset = KBs[domain]
         case_dataset = cases[domain]
+        completed = checkpoint.get(domain, {})
+        if completed:
+            print(f'resuming {domain}: {len(completed)} cases already completed')
     #events = events[:5]
     ### if use api, replace chatbot with empty string
         predictions = []
         results = []
-        for i, cur_case in enumerate(tqdm(case_dataset)):
-            if domain == 'AI_ACT' and i < 2983: continue
-            case_content = cur_case['case_content']
-            norm_type = cur_case['norm_type']
-            # ci elements
-            args.sender = cur_case['sender']
-            args.sender_role=cur_case['sender_role']
-            args.recipient=cur_case['recipient']
-            args.recipient_role=cur_case['recipient_role']
-            args.subject=cur_case['subject']
-            args.subject_role=cur_case['subject_role']
-            args.information_type=cur_case['information_type']
-            args.consent_form=cur_case['consent_form']
-            args.purpose=cur_case['purpose']
-            # if add clauses
-            args.clauses=cur_case['followed_articles']+cur_case['violated_articles']
+        ### feed the cases to the agent in micro-batches of args.batch_size
+        ids = shard_cases(len(case_dataset), shard)
+        batches = queue.batches(domain, ids, batch_size) if queue else \
+            [ids[start:start + batch_size] for start in range(0, len(ids), batch_size)]
+        for case_ids in tqdm(batches):
+            ### cases completed by an interrupted run with the same config are not asked again
+            batch_ids = [i for i in case_ids if i not in completed]
+            batch_kwargs = []
+            for i in batch_ids:
+                cur_case = case_dataset[i]
+                kwargs = copy.copy(vars(args))
+                # ci elements and clauses
+                kwargs.update(get_case_elements(cur_case))
+                kwargs.update(event=cur_case['case_content'], domain=domain)
+                batch_kwargs.append(kwargs)
+            batch_start = time.time()
+            decisions = []
+            if batch_ids:
+                ### seeded by its first case, per case when seeded_batch_size runs the cases one by one
+                set_seeds(args, case_seed(args.seed, domain, batch_ids[0]))
+                if args.decision_mode == 'score':
+                    ### one forward pass per micro-batch, the labels are scored instead of generated and parsed
+                    decisions = agents.score_batch(batch_kwargs, not args.no_calibration)
+                else:
+                    decisions = agents.complete_batch(batch_kwargs, args.generation_round)
 
-            label_list = label_transform(norm_type)
-            decision = {}
-            log(str(f"=== domain: {domain} --- case: {i}\n"), args.log_path)
-            for _ in range(args.generation_round):
-                try:
-                    decision = agents.complete(event=case_content, domain = domain, **vars(args))           
-                    result = decision["decision"].lower() in label_list
-                    results.append(result)
-                    # print(results[-1])
-                    acc = (sum(results) / len(results))
-                    print(acc)
-                    log(str(f"sample_id: {i} --- result:{result} --- answer: {norm_type}\n"), args.log_path)
-                    log(str(decision)+"\n", args.log_path)
-                    if decision: break
+            seconds = (time.time() - batch_start) / max(len(batch_ids), 1)
 
-                except Exception as e:
-                    print(e)
+            outputs = dict(zip(batch_ids, zip(batch_kwargs, decisions)))
+            for i in case_ids:
+                if i in completed:
+                    results.append(completed[i])
                     continue
-            if not decision: results.append(0)
+                kwargs, decision = outputs[i]
+                norm_type = case_dataset[i]['norm_type']
+                label_list = label_transform(norm_type)
+                result = not isinstance(decision, Exception) and decision["decision"].lower() in label_list
+                results.append(result)
+                writer.write(case_record(domain, i, STRATEGY, norm_type, decision, result, seconds,
+                                         agents.template.format(**kwargs), agents.token_counter, config_id))
+                print(sum(results) / len(results))
+            writer.flush()
 
+        if queue:
+            ### the accuracy of the whole run, over the cases of every worker
+            results = [record["correct"] for record in queue.records(domain)]
         acc = (sum(results) / len(results))
         print(acc)
-        log(str(f"domain: {domain} --- num_sample: {len(case_dataset)} --- accuracy:{acc}\n"), args.log_path)
-        log(str(f"domain: {domain} --- num_sample: {len(case_dataset)} --- accuracy:{acc}\n"), result_save_path)
+        log(str(f"domain: {domain} --- num_sample: {len(ids)} --- accuracy:{acc}\n"), args.log_path)
+        log(str(f"domain: {domain} --- num_sample: {len(ids)} --- accuracy:{acc}\n"), result_save_path)
+    if queue:
+        log(str(f"work queue: {queue.stats()}\n"), args.log_path)
+    writer.close()
+    if args.cache_path:
+        log(str(f"response cache: {get_response_cache(args.cache_path).stats()}\n"), args.log_path)
 
 
 if __name__ == '__main__':
@@ -100,18 +141,41 @@ if __name__ == '__main__':
     #parser.add_argument("--model", type=str, default="meta-llama/Llama-3.1-8B-Instruct")
     parser.add_argument("--model", type=str, default="")
     parser.add_argument("--log_path", type=str, default="logs/log.txt")
+    ### JSONL (or .jsonl.zst) of the per-case records, next to the log by default
+    parser.add_argument("--results_path", type=str, default='')
+    ### rerun the cases already in --results_path instead of resuming from them
+    parser.add_argument("--no_resume", action="store_true")
+    ### "i/N": run only the i-th of N interleaved shards of the cases, see launch_shards.py
+    parser.add_argument("--shard", type=str, default='')
+    ### SQLite work queue shared by the workers of a run, see work_queue.py
+    parser.add_argument("--queue_path", type=str, default='')
+    parser.add_argument("--lease_seconds", type=float, default=config.QUEUE_LEASE_SECONDS)
     parser.add_argument("--prompt_template", type=str, default="prompts/direct_answer_prompt.txt")
     parser.add_argument("--max_new_tokens", type=int, default=1024)
 
     parser.add_argument("--generation_round", type=int, default=10)
     parser.add_argument("--max_law_items", type=int, default=2)
     parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--fake_latency", type=float, default=0.0)
+    parser.add_argument("--fake_failure_rate", type=float, default=0.0)
     parser.add_argument("--api_name", type=str, default='')
     ### newly appeneded
     parser.add_argument("--domains", type=str, default='AI_ACT')
     parser.add_argument("--api_model", type=str, default=config.api_model)
     parser.add_argument("--api_token", type=str, default=config.api_key)
+    parser.add_argument("--api_base_url", type=str, default=config.api_base_url)
+    parser.add_argument("--api_concurrency", type=int, default=1)
+    parser.add_argument("--api_rpm", type=int, default=0)
+    parser.add_argument("--api_tpm", type=int, default=0)
     parser.add_argument("--max_retry", type=int, default=5)
+    parser.add_argument("--retry_budget", type=int, default=-1)
+    parser.add_argument("--cache_path", type=str, default='')
+    parser.add_argument("--cache_size", type=int, default=config.RESPONSE_CACHE_SIZE)
+    parser.add_argument("--batch_size", type=int, default=1)
     parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument("--early_stop", action="store_true")
+    parser.add_argument("--prefix_cache", action="store_true")
+    parser.add_argument("--decision_mode", type=str, default='generate', choices=['generate', 'score'])
+    parser.add_argument("--no_calibration", action="store_true")
     args = parser.parse_args()
     main(args)
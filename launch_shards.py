@@ -0,0 +1,59 @@
+'''
+Runs a driver as N shard processes and merges their results, e.g. one shard per GPU:
+
+    python launch_shards.py direct_answer.py --num_shards 4 --gpus 0,1,2,3 --log_path logs/run.txt --model $model
+
+Every argument after the launcher options is passed to the driver, which runs with --shard i/N, writes
+logs/run.shard<i>of<N>.txt and .jsonl, and resumes from them when restarted. Once every shard has finished, the
+shard results files are merged into logs/run.jsonl and the accuracy lines of the whole run are appended to
+logs/run.txt and logs/run_results.txt (results.merge_shards).
+'''
+import argparse
+import os
+import subprocess
+import sys
+
+from results import merge_shards
+
+
+def launch(driver, num_shards, driver_args, gpus=''):
+    '''
+    Starts the num_shards shards of driver, round robin over the comma separated gpus, and waits for them.
+    Returns the exit codes of the shards.
+    '''
+    gpus = [gpu for gpu in gpus.split(',') if gpu]
+    processes = []
+    for index in range(num_shards):
+        env = dict(os.environ)
+        if gpus:
+            env['CUDA_VISIBLE_DEVICES'] = gpus[index % len(gpus)]
+        command = [sys.executable, driver, *driver_args, '--shard', f'{index}/{num_shards}']
+        processes.append(subprocess.Popen(command, env=env))
+    return [process.wait() for process in processes]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("driver", type=str)
+    parser.add_argument("--num_shards", type=int, default=2)
+    parser.add_argument("--gpus", type=str, default='')
+    ### only merge the results of shards that already ran
+    parser.add_argument("--merge_only", action="store_true")
+    ### also passed to the driver, the merge needs them
+    parser.add_argument("--log_path", type=str, default="logs/log.txt")
+    parser.add_argument("--results_path", type=str, default='')
+    args, driver_args = parser.parse_known_args()
+    driver_args += ['--log_path', args.log_path] + (['--results_path', args.results_path] if args.results_path else [])
+
+    if not args.merge_only:
+        codes = launch(args.driver, args.num_shards, driver_args, args.gpus)
+        failed = [index for index, code in enumerate(codes) if code != 0]
+        if failed:
+            ### the finished cases are kept, rerunning the same command resumes the failed shards
+            sys.exit(f'shards {failed} failed, rerun to resume them')
+    try:
+        accuracies = merge_shards(args.log_path, args.num_shards, args.results_path)
+    except ValueError as e:
+        sys.exit(f'cannot merge the shards: {e}')
+    for domain, (num_sample, acc) in accuracies.items():
+        print(f"domain: {domain} --- num_sample: {num_sample} --- accuracy:{acc}")
@@ -1,15 +1,52 @@
 import re
 
+### regexes (case-insensitive) matching a complete answer block that the parser can read,
+### generation can stop as soon as one matches since the remaining tokens are never parsed
+### lines with "|" or " or " only restate the output format, e.g. "Choice: [A. Prohibited | B. Permitted ...]"
+STOP_PATTERNS = {
+    "parse_decision": r"choice[^\n|]*(permitted|prohibited|not related)[^\n|]*\n",
+    "parse_cot_auto": r"choice[^\n|]*(permitted|prohibited|not related|irrelated|not relevant|irrelevant)[^\n|]*\n",
+    "parse_law_judge": r"judgment[^\n/]*\b(yes|no)\b[^\n/]*\n",
+    "parse_MCQ": r"(choice\**:\s*\**\s*[ABCD]\b(?![^\n]* or [ABCD]\b)[^\n]*\n|boxed\{[ABCD]\})",
+}
+
+### the answer lines of the decision prompts, scored instead of generated in the score decision mode,
+### keyed by the decision parse_decision reads from them
+DECISION_CHOICES = {
+    "negative": "Choice: A. Prohibited",
+    "positive": "Choice: B. Permitted",
+    "not applicable": "Choice: C. Not related",
+}
+
+### the options of prompts/MCQ_template.txt and the start of the answer line its output format asks for,
+### the option letter is read from the next-token logits after it in the logits MCQ mode
+MCQ_CHOICES = ['A', 'B', 'C', 'D']
+MCQ_ANSWER_PREFIX = "**Choice**:"
+
+def get_decision_choices(template):
+    '''
+    The DECISION_CHOICES offered by a prompt template, e.g. the ACLU prompts have no "not related" option.
+    '''
+    return {decision: choice for decision, choice in DECISION_CHOICES.items()
+            if choice.split(": ")[1].lower() in template.lower()}
+
+def get_stop_pattern(parse_fn):
+    '''
+    Return the stop regex of a parser method, None if the whole response is parsed.
+    '''
+    return STOP_PATTERNS.get(getattr(parse_fn, "__name__", ""))
+
 class LlamaParser:
     def __init__(self, domain = None):
         '''
-        section_pattern is used to match the section number in the law
-        [0-9]+\.[0-9]+(\([0-9A-Za-zivx]+\))* is the pattern for HIPAA
-        recital\s\d+ is the pattern for GDPR
-        article\s\d+(\(\d+\))? is the pattern for GDPR
+        section_pattern is used to match the section number in the law, case-insensitively
+        [0-9]+\.[0-9]+(\s?\([0-9A-Za-zivx]+\))* is the pattern for HIPAA
+        recital\s?\d+ is the pattern for GDPR
+        art(icle|\.)?\s?\d+(\s?\(\d+\))*(\s?\([a-z]\))? is the pattern for GDPR and AI_ACT citations such as "Art. 6 (1)(a)"
         EU_AI_ACT\.chapter\d+(\.section\d+-\d+)?\.article\d+(\.\w+)* is the pattern for AI_ACT
+        the matched citations are mapped to KB ids by agents.citations.CitationResolver
         '''
-        self.section_pattern = r"[0-9]+\.[0-9]+(\([0-9A-Za-zivx]+\))*|recital\s\d+|article\s\d+(\(\d+\))?|eu_ai_act\.chapter\d+(\.section\d+-\d+)?\.article\d+(\.\w+)*"
+        self.section_pattern = r"(?i)eu_ai_act\.chapter\d+(\.section\d+-\d+)?\.article\d+(\.\w+)*|[0-9]+\.[0-9]+(\s?\([0-9A-Za-zivx]+\))*|recital\s?\d+|\bart(icle|\.)?\s?\d+(\s?\(\d+\))*(\s?\([a-z]\))?"
         self.law_generation_errors = []
         self.law_judge_errors = []
         self.decision_errors = []
@@ -216,7 +253,7 @@ class LlamaParser:
         ret["response"] = response
         response = response.split("\n")
         map_list = ['**{Choice}**', '**Choice**: {Choice}', '**Choice**:{Choice}', 'boxed{{{Choice}}}', 'answer is {Choice}', 'to be option {Choice}', 'choice is {Choice}', '**Final Choice**: {Choice}', 'text{{{Choice}}}}}','**Final Choice: {Choice}', 'text{{{Choice}:']
-        Choice_list = ['A', 'B', 'C', 'D']
+        Choice_list = MCQ_CHOICES
         
         for r in response:
             for Choice in Choice_list:
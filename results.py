@@ -0,0 +1,257 @@
+'''
+Structured results of the drivers: one JSON record per case, appended to a JSONL file (zstd compressed when
+the path ends with .zst) through a buffered writer, read back by read_results for analysis and resuming.
+
+Every record has the fields of RESULT_FIELDS:
+    version     RESULT_SCHEMA_VERSION
+    domain      GDPR / HIPAA / AI_ACT / ACLU
+    id          index of the case in its domain dataset
+    strategy    the driver strategy, e.g. direct, cot_auto, content_search, mcq, cascade
+    label       gold label (norm_type, or the MCQ option)
+    decision    predicted decision, None if no response could be parsed
+    correct     bool
+    responses   dict, every raw model response of the case (the "*response*" fields of the agent output)
+    timings     dict, seconds spent on the case
+    tokens      dict, prompt and response tokens counted with agents.packer.TokenCounter, when known
+    extra       dict, the rest of the agent output (reasons, retrieved laws, label probabilities...)
+    error       str, the exception that ended the case, if any
+    config      config_hash of the run arguments; with (domain, id, strategy) the checkpoint key of the case
+'''
+import hashlib
+import io
+import json
+import os
+import re
+import time
+
+RESULT_SCHEMA_VERSION = 2
+RESULT_FIELDS = ('version', 'domain', 'id', 'strategy', 'label', 'decision', 'correct', 'responses', 'timings',
+                 'tokens', 'extra', 'error', 'config')
+### arguments that do not change the answers of a run, left out of its config hash
+RUN_ONLY_ARGS = ('log_path', 'results_path', 'shard', 'domains', 'api_token', 'api_concurrency', 'api_rpm', 'api_tpm',
+                 'retry_budget', 'cache_path', 'cache_size', 'batch_size', 'fake_latency', 'no_resume',
+                 'kb_artifact_dir', 'prefix_cache', 'queue_path', 'lease_seconds')
+
+
+def config_hash(args):
+    '''
+    Short sha256 of the arguments that determine the answers of a run (everything but RUN_ONLY_ARGS).
+    '''
+    config = {key: value for key, value in sorted(vars(args).items()) if key not in RUN_ONLY_ARGS}
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def case_record(domain, id, strategy, label, output, correct, seconds=None, prompt=None, counter=None, config=None):
+    '''
+    The record of one case from the output of its agent: a parsed response dict, or the exception of a failed case.
+    prompt, counter: the rendered prompt and an agents.packer.TokenCounter, to count the tokens of the case
+    config: str, the config_hash of the run
+    '''
+    record = dict.fromkeys(RESULT_FIELDS)
+    record.update(version=RESULT_SCHEMA_VERSION, domain=domain, id=id, strategy=strategy, label=label,
+                  correct=bool(correct), responses={}, timings={}, tokens={}, extra={}, config=config)
+    if isinstance(output, Exception):
+        record["error"] = repr(output)
+    else:
+        for key, value in output.items():
+            if key == "decision":
+                record["decision"] = value
+            elif "response" in key:
+                record["responses"][key] = value
+            elif key != "id":
+                record["extra"][key] = value
+    if seconds is not None:
+        record["timings"]["seconds"] = seconds
+    if counter is not None:
+        if prompt is not None:
+            record["tokens"]["prompt"] = counter.count(prompt)
+        responses = [value for values in record["responses"].values()
+                     for value in (values if isinstance(values, list) else [values]) if isinstance(value, str)]
+        record["tokens"]["response"] = sum(counter.count(response) for response in responses)
+    return record
+
+
+def timed(fn):
+    ### fn returning (output, seconds spent), for the drivers that run cases through an executor
+    def run(*args, **kwargs):
+        start = time.time()
+        output = fn(*args, **kwargs)
+        return output, time.time() - start
+    return run
+
+
+class ResultWriter:
+    '''
+    Appends records to path, one JSON object per line.
+    flush_every: int, records buffered in memory before they are written
+    fsync_interval: float, seconds between two fsyncs of the written records, 0 to fsync on every flush
+    A .zst path is written as a sequence of zstd frames, one per flush, so that the records written before a crash
+    stay readable (needs the optional zstandard package).
+    '''
+    def __init__(self, path, flush_every=32, fsync_interval=30.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.fsync_interval = fsync_interval
+        self.buffer = []
+        self.last_fsync = time.time()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'ab')
+        self.compressor = None
+        if path.endswith('.zst'):
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor()
+
+    def write(self, record):
+        self.buffer.append(json.dumps(record, ensure_ascii=False, default=str))
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self, fsync=False):
+        if self.buffer:
+            data = ("\n".join(self.buffer) + "\n").encode('utf-8')
+            if self.compressor is not None:
+                data = self.compressor.compress(data)
+            self.file.write(data)
+            self.buffer = []
+        self.file.flush()
+        if fsync or time.time() - self.last_fsync >= self.fsync_interval:
+            os.fsync(self.file.fileno())
+            self.last_fsync = time.time()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush(fsync=True)
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_results(path):
+    '''
+    The records of a results file in write order, [] if it does not exist.
+    A last line cut by a crash is skipped.
+    '''
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as f:
+        data = f.read()
+    if path.endswith('.zst'):
+        import zstandard
+        data = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True).read()
+    records = []
+    for line in data.decode('utf-8', errors='replace').split("\n"):
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    return records
+
+
+def load_checkpoint(path, strategy, config, full=False):
+    '''
+    domain -> {case id: correct} of the cases already completed in path by a run of the same strategy and config,
+    the cases a restarted run skips (their stored results keep the running accuracy the same).
+    full: bool, map the case ids to their whole "correct" and "extra" fields instead
+    '''
+    done = {}
+    for record in read_results(path):
+        if record.get("strategy") == strategy and record.get("config") == config:
+            value = dict(record["extra"], correct=record["correct"]) if full else record["correct"]
+            done.setdefault(record["domain"], {})[record["id"]] = value
+    return done
+
+
+def accuracy_by_domain(records, strategy=None):
+    '''
+    domain -> (number of cases, accuracy) of the records, the last record of a case wins.
+    '''
+    cases = {}
+    for record in records:
+        if strategy is None or record["strategy"] == strategy:
+            cases[(record["domain"], record["id"])] = record["correct"]
+    accuracies = {}
+    for (domain, _), correct in cases.items():
+        accuracies.setdefault(domain, []).append(correct)
+    return {domain: (len(values), sum(values) / len(values)) for domain, values in accuracies.items()}
+
+
+def logged_sample_counts(log_path):
+    '''
+    domain -> number of cases of the last accuracy line logged to <log>_results.txt, written once a run has
+    gone through every case of the domain.
+    '''
+    counts = {}
+    path = log_path.replace('.txt', '_results.txt')
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                match = re.match(r"domain: (\S+) --- num_sample: (\d+)", line)
+                if match:
+                    counts[match.group(1)] = int(match.group(2))
+    return counts
+
+
+def merge_shards(log_path, num_shards, results_path='', strategy=None, config=None):
+    '''
+    Combine the results files written by the num_shards shards of a run (see utils.shard_path) into results_path
+    (default: the log path with a .jsonl extension), ordered by domain and case id, and append the per-domain
+    accuracy lines of the whole run to the log and to <log>_results.txt, as an unsharded run writes them.
+    strategy, config: the run merged, by default the run of the last record of the shards, which must agree;
+    the records of other runs appended to the same shard files are left out
+    Raises ValueError when a shard has not recorded every case of a domain it logged an accuracy line for, or of
+    a domain another shard ran.
+    Returns domain -> (number of cases, accuracy).
+    '''
+    from utils import log, shard_path
+    results_path = results_path or log_path.replace('.txt', '.jsonl')
+    shard_records = [read_results(shard_path(results_path, (index, num_shards))) for index in range(num_shards)]
+    if strategy is None or config is None:
+        runs = {(records[-1]["strategy"], records[-1]["config"]) for records in shard_records if records}
+        if len(runs) != 1:
+            raise ValueError(f"Cannot tell which run to merge from the last records of the shards: {runs}")
+        strategy, config = runs.pop()
+
+    cases = {}
+    shard_cases = []
+    for records in shard_records:
+        shard_cases.append({(record["domain"], record["id"]): record for record in records
+                            if record["strategy"] == strategy and record["config"] == config})
+    counts = [logged_sample_counts(shard_path(log_path, (index, num_shards))) for index in range(num_shards)]
+    domains = list(dict.fromkeys([domain for done in shard_cases for domain, _ in done] +
+                                 [domain for count in counts for domain in count]))
+    for index in range(num_shards):
+        for domain in domains:
+            done = sum(case_domain == domain for case_domain, _ in shard_cases[index])
+            if counts[index].get(domain) != done:
+                raise ValueError(f"Shard {index}/{num_shards} recorded {done} cases of {domain} for run {config}, "
+                                 f"its log expects {counts[index].get(domain)}; rerun it before merging")
+        cases.update(shard_cases[index])
+    records = sorted(cases.values(), key=lambda record: (domains.index(record["domain"]), record["id"]))
+    ### the merged file is rewritten, not appended to
+    if os.path.exists(results_path):
+        os.remove(results_path)
+    with ResultWriter(results_path) as writer:
+        for record in records:
+            writer.write(record)
+
+    accuracies = accuracy_by_domain(records)
+    for domain, (num_sample, acc) in accuracies.items():
+        line = f"domain: {domain} --- num_sample: {num_sample} --- accuracy:{acc}\n"
+        log(line, log_path)
+        log(line, log_path.replace('.txt', '_results.txt'))
+    return accuracies
+
+
+if __name__ == '__main__':
+    ### python results.py logs/log.jsonl [more results files]: the accuracy lines of the logged runs
+    import sys
+    for path in sys.argv[1:]:
+        for domain, (num_sample, acc) in accuracy_by_domain(read_results(path)).items():
+            print(f"{path} --- domain: {domain} --- num_sample: {num_sample} --- accuracy:{acc}")
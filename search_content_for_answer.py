@@ -11,60 +11,78 @@ os.environ["CUDA_VISIBLE_DEVICES"] = "7"
 import argparse
 import copy
 import json
-import pandas as pd
 
 
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 from parse_string import LlamaParser
-from agents import AgentContentSearch, HuggingfaceChatbot
+from agents.cache import get_response_cache
+from agents import AgentContentSearch, HuggingfaceChatbot, FakeChatbot
+from agents.kb_artifact import get_kb_artifact
 from utils import *
+from results import ResultWriter, case_record, config_hash, load_checkpoint, timed
+from work_queue import WorkQueue
 
 import random
-import numpy as np
-import torch
+import time
 
+STRATEGY = 'content_search'
 
 
 
-def set_seeds(args):
-    random.seed(args.seed)
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
 
-
-def KB_to_dict(kb):
-    kb_dict = {}
-    for item in kb:
-        ### convert regulation id to lower case
-        key = item['regulation_id']
-        key = key.lower()
-        kb_dict[key] = item
-    return kb_dict
+def set_seeds(args, seed=None):
+    seed = args.seed if seed is None else seed
+    random.seed(seed)
+    ### numpy and torch are only needed (and imported) for local models
+    if not args.api_name and args.model != 'fake':
+        import numpy as np
+        import torch
+        np.random.seed(seed)
+        torch.manual_seed(seed)
 
 
 def main(args):
+    ### a shard runs every N-th case with its own log and results files, merged by launch_shards.py
+    shard = parse_shard(args.shard)
+    args.log_path = shard_path(args.log_path, shard)
     set_seeds(args)
+    config_id = config_hash(args)
     log(str(args)+"\n",args.log_path)
-    KBs = get_local_KB_dataset()
+    ### with prebuilt KB artifacts the KB datasets are only loaded to (re)compile them
+    KBs = None if args.kb_artifact_dir else get_local_KB_dataset()
     cases = get_local_case_dataset()
 
     #events = events[:5]
     ### if use api, replace chatbot with empty string
     if args.api_name:
         chatbot = ''
+    elif args.model == 'fake':
+        ### offline backend to benchmark the pipeline without a model
+        chatbot = FakeChatbot(latency=args.fake_latency, failure_rate=args.fake_failure_rate, seed=args.seed)
     else:    
-        chatbot = HuggingfaceChatbot(args.model)
+        chatbot = HuggingfaceChatbot(args.model, prefix_cache=args.prefix_cache)
 
     result_save_path = args.log_path.replace('.txt', '_results.txt')
+    ### one structured record per case, the text log only keeps the run arguments and the accuracies
+    results_path = shard_path(args.results_path, shard) if args.results_path else args.log_path.replace('.txt', '.jsonl')
+    ### the records of a previous run with the same config are its checkpoint
+    checkpoint = {} if args.no_resume or args.queue_path else load_checkpoint(results_path, STRATEGY, config_id)
+    ### with --queue_path the workers of a run lease their cases from a shared SQLite queue and write their records to it
+    queue = WorkQueue(args.queue_path, STRATEGY, config_id, args.lease_seconds) if args.queue_path else None
+    writer = queue or ResultWriter(results_path)
     for domain in args.domains.split('+'):
         if domain == 'GDPR' or domain == 'HIPAA':
                 continue
         assert domain in ['GDPR', 'HIPAA', 'AI_ACT'], 'Invalid domain name' 
-        KB_dataset = KBs[domain]
         case_dataset = cases[domain]
-        kb = KB_to_dict(KB_dataset)
-        args.kb = kb
+        if args.kb_artifact_dir:
+            args.kb_artifact = get_kb_artifact(domain, args.kb_artifact_dir, args.analyzer)
+            args.kb = args.kb_artifact["kb"]
+        else:
+            args.kb_artifact = None
+            args.kb = KB_to_dict(KBs[domain])
         args.domain = domain
         
         parser = LlamaParser(domain = args.domain)
@@ -72,66 +90,55 @@ def main(args):
         agents = AgentContentSearch(chatbot, args, parser)
         predictions = []
         results = []
-        ### new appened for continuing eval from errors
-        #ids,accs = parse_log(args.log_path)
-        #last_id = ids[-1] if ids else -1
-        last_id = -1
-        if(last_id != -1):
-            acc = accs[-1]
-            correct = round(acc*(last_id+1))
-            results = [0] * last_id
-            results.append(correct)
-            print(f'last_id: {last_id} with acc {acc}, total correct: {correct}')
-        else:
-            print('start from index 0')
-
-        for i, cur_case in enumerate(tqdm(case_dataset)):
-            #if i <= last_id:
-            #    continue
-            #if domain == 'AI_ACT' and i <= 2256:
-            #    continue
-            #if i > 3:
-            #    break
-            case_content = cur_case['case_content']
-            norm_type = cur_case['norm_type']
-            label_list = label_transform(norm_type)
-            decision = {}
-            log(str(f"=== domain: {domain} --- case: {i}\n"), args.log_path)
-            #event = events.loc[i]
-            decision = agents.action(case_content)
-            decision["id"] = i
-            if not "decision" in  decision:
-                results.append(0)
-                continue
-            result = decision["decision"].lower() in label_list
-            results.append(result)
-            log(str(f"sample_id: {i} --- result:{result} --- answer: {norm_type}\n"), args.log_path)
-            print(sum(results) / len(results))
-            log(str(decision)+"\n", args.log_path)
+        ### cases completed by an interrupted run with the same config are not asked again
+        completed = checkpoint.get(domain, {})
+        print(f'resuming {domain}: {len(completed)} cases already completed' if completed else 'start from index 0')
+        ids = shard_cases(len(case_dataset), shard)
+
+        ### with the api, args.api_concurrency cases run the pipeline at once; decisions are consumed in order
+        workers = args.api_concurrency if args.api_name else 1
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+        def run_case(i):
+            ### only the torch sampling of a local model depends on the seed, and local models run the cases on one
+            ### thread, so the global RNGs are reseeded per case there; concurrent api cases are sampled by the
+            ### provider and never reseed the state the other threads share
+            if workers == 1:
+                set_seeds(args, case_seed(args.seed, domain, i))
+            return agents.action(case_dataset[i]['case_content'])
+
+        ### from a work queue, the cases are leased in rounds of one case per thread
+        batches = queue.batches(domain, ids, workers) if queue else [ids]
+        for case_ids in batches:
+            decisions = executor.map(timed(run_case), [i for i in case_ids if i not in completed])
+            for i in tqdm(case_ids):
+                if i in completed:
+                    results.append(completed[i])
+                    continue
+                cur_case = case_dataset[i]
+                decision, seconds = next(decisions)
+                norm_type = cur_case['norm_type']
+                label_list = label_transform(norm_type)
+                #event = events.loc[i]
+                result = "decision" in decision and decision["decision"].lower() in label_list
+                results.append(result)
+                writer.write(case_record(domain, i, STRATEGY, norm_type, decision, result, seconds,
+                                         counter=agents.token_counter, config=config_id))
+                print(sum(results) / len(results))
+            writer.flush()
+        executor.shutdown()
+        if queue:
+            ### the accuracy of the whole run, over the cases of every worker
+            results = [record["correct"] for record in queue.records(domain)]
         acc = (sum(results) / len(results))
         #log(str(f"accuracy:{acc}"), args.log_path)
-        log(str(f"domain: {domain} --- num_sample: {len(case_dataset)} --- accuracy:{acc}\n"), args.log_path)
-        log(str(f"domain: {domain} --- num_sample: {len(case_dataset)} --- accuracy:{acc}\n"), result_save_path)
-
-
-def parse_log(log_path):
-    import ast
-    try:
-        with open(log_path, "r") as f:
-            lines = f.readlines()
-    except:
-        return []
-    
-    results = []
-    acc = []
-    for line in lines:
-        if "{" == line[0]:
-            cur_dict = ast.literal_eval(line.strip())
-            id = cur_dict["id"]
-            results.append(id)
-        if line.startswith("0."):
-            acc.append(float(line.strip()))
-    return results, acc
+        log(str(f"domain: {domain} --- num_sample: {len(ids)} --- accuracy:{acc}\n"), args.log_path)
+        log(str(f"domain: {domain} --- num_sample: {len(ids)} --- accuracy:{acc}\n"), result_save_path)
+    if queue:
+        log(str(f"work queue: {queue.stats()}\n"), args.log_path)
+    writer.close()
+    if args.cache_path:
+        log(str(f"response cache: {get_response_cache(args.cache_path).stats()}\n"), args.log_path)
 
 
 if __name__ == '__main__':
@@ -139,6 +146,15 @@ if __name__ == '__main__':
     #parser.add_argument("--model", type=str, default="meta-llama/Llama-3.1-8B-Instruct")
     parser.add_argument("--model", type=str, default="")
     parser.add_argument("--log_path", type=str, default=os.path.join('logs','log.txt'))
+    ### JSONL (or .jsonl.zst) of the per-case records, next to the log by default
+    parser.add_argument("--results_path", type=str, default='')
+    ### rerun the cases already in --results_path instead of resuming from them
+    parser.add_argument("--no_resume", action="store_true")
+    ### "i/N": run only the i-th of N interleaved shards of the cases, see launch_shards.py
+    parser.add_argument("--shard", type=str, default='')
+    ### SQLite work queue shared by the workers of a run, see work_queue.py
+    parser.add_argument("--queue_path", type=str, default='')
+    parser.add_argument("--lease_seconds", type=float, default=config.QUEUE_LEASE_SECONDS)
 
 
     parser.add_argument("--law_template", type=str, default="prompts/cot-knowledge-lookup-prompt.txt")
@@ -160,8 +176,11 @@ if __name__ == '__main__':
     parser.add_argument("--generation_round", type=int, default=5)
     parser.add_argument("--max_law_items", type=int, default=3)
     parser.add_argument("--look_up_items", type=int, default=3)
+    parser.add_argument("--reference_tokens", type=int, default=config.DECISION_REFERENCE_TOKENS)
 
     parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--fake_latency", type=float, default=0.0)
+    parser.add_argument("--fake_failure_rate", type=float, default=0.0)
 
     #parser.add_argument("--use_content", type=str, default='yes')
 
@@ -170,8 +189,19 @@ if __name__ == '__main__':
     parser.add_argument("--domains", type=str, default='GDPR+HIPAA+AI_ACT')
     parser.add_argument("--api_model", type=str, default=config.api_model)
     parser.add_argument("--api_token", type=str, default=config.api_key)
+    parser.add_argument("--api_base_url", type=str, default=config.api_base_url)
+    parser.add_argument("--api_concurrency", type=int, default=1)
+    parser.add_argument("--api_rpm", type=int, default=0)
+    parser.add_argument("--api_tpm", type=int, default=0)
     parser.add_argument("--max_retry", type=int, default=5)
+    parser.add_argument("--retry_budget", type=int, default=-1)
+    parser.add_argument("--cache_path", type=str, default='')
+    parser.add_argument("--cache_size", type=int, default=config.RESPONSE_CACHE_SIZE)
     parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument("--early_stop", action="store_true")
+    parser.add_argument("--prefix_cache", action="store_true")
+    parser.add_argument("--kb_artifact_dir", type=str, default='')
+    parser.add_argument("--analyzer", type=str, default='whitespace', choices=['whitespace', 'standard', 'stem'])
 
 
     args = parser.parse_args()
@@ -0,0 +1,90 @@
+'''
+AsyncOpenAI_model against a local stub of the chat completions endpoint: result order, concurrency cap and rate limit.
+'''
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from agents.async_client import AsyncOpenAI_model
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.arrivals = []
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            server.arrivals.append(time.monotonic())
+        ### the answer echoes the prompt, so that responses can be matched with their requests
+        time.sleep(server.latency)
+        content = body['messages'][-1]['content']
+        payload = json.dumps({
+            'id': 'stub', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2},
+        }).encode('utf-8')
+        with server.lock:
+            server.in_flight -= 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = StubServer(latency=0.1)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_client(server, **kwargs):
+    return AsyncOpenAI_model('stub-key', 'openai', base_url=f'http://127.0.0.1:{server.server_port}/v1', **kwargs)
+
+
+def test_batch_in_order_under_concurrency_cap(server):
+    client = get_client(server, concurrency=3)
+    prompts = [f'case {i}' for i in range(12)]
+    try:
+        responses = client.compeletion_batch('stub-model', [[{'role': 'user', 'content': prompt}] for prompt in prompts], 1)
+    finally:
+        client.close()
+    assert responses == prompts
+    assert server.max_in_flight == 3
+
+
+def test_request_rate_limit(server):
+    client = get_client(server, concurrency=8, requests_per_minute=600)
+    ### the bucket starts full (a minute of requests), empty it to see the 10 requests per second refill
+    client.request_bucket.tokens = 0
+    try:
+        client.compeletion_batch('stub-model', [[{'role': 'user', 'content': f'case {i}'}] for i in range(5)], 1)
+    finally:
+        client.close()
+    gaps = [later - earlier for earlier, later in zip(server.arrivals, server.arrivals[1:])]
+    assert len(server.arrivals) == 5
+    assert min(gaps) > 0.08
+    assert server.arrivals[-1] - server.arrivals[0] > 0.35
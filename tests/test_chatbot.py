@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+
+import pytest
+
+from agents.chatbot import HuggingfaceChatbot
+
+
+class SpaceSplittingTokenizer:
+    '''
+    Encodes like SentencePiece tokenizers whose leading space is a token of its own: " A" -> ["▁", "A"].
+    '''
+    vocab = {"▁": 1, "A": 2, "B": 3, "C": 4, "D": 5, "AB": 6}
+
+    def __call__(self, text, add_special_tokens=True):
+        ids = [self.vocab["▁"]] if text.startswith(" ") else []
+        text = text.strip()
+        ids += [self.vocab[text]] if text in self.vocab else [self.vocab[char] for char in text]
+        return SimpleNamespace(input_ids=ids)
+
+    def decode(self, ids):
+        words = {id: word for word, id in self.vocab.items()}
+        return "".join(words[id] for id in ids).replace("▁", " ")
+
+
+def get_chatbot(tokenizer):
+    ### only the tokenizer is needed, no model is loaded
+    chatbot = HuggingfaceChatbot.__new__(HuggingfaceChatbot)
+    chatbot.tokenizer = tokenizer
+    return chatbot
+
+
+def test_option_ids_skip_the_leading_space_token():
+    chatbot = get_chatbot(SpaceSplittingTokenizer())
+    option_ids = [chatbot.option_token_ids(option) for option in ["A", "B", "C", "D"]]
+    assert option_ids == [[2], [3], [4], [5]]
+
+
+def test_multi_token_option_is_rejected():
+    chatbot = get_chatbot(SpaceSplittingTokenizer())
+    assert chatbot.option_token_ids("AB") == [6]
+    with pytest.raises(ValueError):
+        chatbot.option_token_ids("BA")
@@ -0,0 +1,31 @@
+from agents.citations import CitationResolver
+from agents.id_index import RegulationIndex
+
+
+def row(content):
+    return {"regulation_content": content}
+
+
+def test_rows_with_the_same_canonical_id_are_kept():
+    kb = {
+        '164.504(a)planadministrationfunctions': row("Plan administration functions means ..."),
+        '164.504(a)summaryhealthinformation': row("Summary health information means ..."),
+        '164.504(b)': row("Standard: Requirements for a covered entity."),
+    }
+    index = RegulationIndex(kb, 'HIPAA')
+    assert index.collisions == {'164.504(a)': ['164.504(a)planadministrationfunctions',
+                                               '164.504(a)summaryhealthinformation']}
+    node = index.get('164.504(a)')
+    assert node["keys"] == index.collisions['164.504(a)']
+    assert index.content('164.504(a)') == "Plan administration functions means ... Summary health information means ..."
+    assert index.children('164.504') == ['164.504(a)', '164.504(b)']
+    ### both KB keys are spellings of the shared id
+    resolver = CitationResolver(index)
+    assert resolver.resolve('164.504(a)summaryhealthinformation') == '164.504(a)'
+    assert resolver.resolve('164.504(a)planadministrationfunctions') == '164.504(a)'
+
+
+def test_no_collisions():
+    index = RegulationIndex({'164.502(a)': row("Standard."), '164.502(b)': row("Minimum necessary.")}, 'HIPAA')
+    assert index.collisions == {}
+    assert index.get('164.502(a)')["keys"] == ['164.502(a)']
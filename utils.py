@@ -1,10 +1,8 @@
 import re
 
-import pandas as pd
+import hashlib
 import json
 import os
-import datasets
-from datasets import load_dataset, load_from_disk
 import config
 
 
@@ -12,6 +10,7 @@ def load_local_HF_dataset(path):
     '''
     Load a dataset from a local path
     '''
+    from datasets import load_from_disk
     dataset = load_from_disk(path)
     return dataset
 
@@ -25,6 +24,15 @@ def get_local_case_dataset():
     case_data = load_local_HF_dataset(case_path)
     return case_data
 
+def KB_to_dict(kb):
+    kb_dict = {}
+    for item in kb:
+        ### convert regulation id to lower case
+        key = item['regulation_id']
+        key = key.lower()
+        kb_dict[key] = item
+    return kb_dict
+
 def list_intersection(candidates, vote_number=-1):
     if vote_number == -1:
         ### LHR modified
@@ -44,8 +52,108 @@ def list_intersection(candidates, vote_number=-1):
     ret = [x[0] for x in ret]
     return ret
 
+class VoteAggregator:
+    '''
+    list_intersection computed round by round, so that the voting stops as soon as more rounds cannot change
+    which candidates get the majority.
+    rounds: int, the number of voting rounds, e.g. law_filtering_round
+    vote_number: int, the votes a candidate needs, -1 for a majority of the rounds that returned a vote
+    (like list_intersection, a failed round lowers the majority)
+    '''
+    def __init__(self, rounds, vote_number=-1):
+        self.rounds = rounds
+        self.vote_number = vote_number
+        self.candidates = []
+        self.failed = 0
+        self.counter = {}
+
+    def add(self, candidate):
+        self.candidates.append(candidate)
+        for c in candidate:
+            self.counter[c] = self.counter.get(c, 0) + 1
+
+    def skip(self):
+        ### a round whose response could not be used
+        self.failed += 1
+
+    def remaining(self):
+        return max(self.rounds - len(self.candidates) - self.failed, 0)
+
+    def threshold(self, votes):
+        return votes // 2 + 1 if self.vote_number == -1 else self.vote_number
+
+    def done(self):
+        ### decided once every candidate (and any candidate not seen yet) is in or out whatever the remaining rounds return
+        remaining = self.remaining()
+        if remaining == 0:
+            return True
+        votes = len(self.candidates)
+        for count in list(self.counter.values()) + [0]:
+            thresholds = [self.threshold(votes + extra) for extra in range(remaining + 1)]
+            always_in = all(count >= threshold for threshold in thresholds)
+            always_out = all(count + extra < threshold for extra, threshold in enumerate(thresholds))
+            if not (always_in or always_out):
+                return False
+        return True
+
+    def next_rounds(self):
+        ### no candidate can be decided before it may have the majority, the first rounds are issued together
+        if not self.candidates and not self.failed:
+            return min(self.threshold(self.rounds), self.rounds)
+        return min(1, self.remaining())
+
+    def rounds_saved(self):
+        return self.remaining()
+
+    def result(self):
+        return list_intersection(self.candidates, self.vote_number)
+
+def parse_shard(shard):
+    ### "i/N" -> (i, N), None for an unsharded run
+    if not shard:
+        return None
+    index, count = (int(x) for x in shard.split('/'))
+    assert 0 <= index < count, f'Invalid shard {shard}'
+    return index, count
+
+def shard_cases(num_cases, shard):
+    ### the case ids of a shard, every N-th case so that the shards get the same mix of case lengths
+    if shard is None:
+        return list(range(num_cases))
+    index, count = shard
+    return list(range(index, num_cases, count))
+
+def shard_path(path, shard):
+    ### logs/run.txt -> logs/run.shard1of4.txt
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard[0]}of{shard[1]}{ext}"
+
+def case_seed(seed, domain, case_id):
+    ### seed of one case, the same whatever the shard (or worker) that runs it
+    return int(hashlib.sha256(f"{seed}-{domain}-{case_id}".encode('utf-8')).hexdigest()[:8], 16)
+
+def seeded_batch_size(args, agents, regrouped):
+    ### a sampled micro-batch of a local model draws every case from one torch RNG stream, so the answers of a case
+    ### depend on the cases batched with it; when shards, a resume or queue workers regroup the cases, run them one by one
+    if args.batch_size > 1 and regrouped and not args.api_name and not agents.is_deterministic():
+        print(f'sampling local model: --batch_size {args.batch_size} -> 1 so that every case is seeded on its own')
+        return 1
+    return args.batch_size
+
+CI_ELEMENTS = ['sender', 'sender_role', 'recipient', 'recipient_role', 'subject', 'subject_role',
+               'information_type', 'consent_form', 'purpose']
+
+def get_case_elements(case):
+    ### ci elements and annotated clauses of a case, used to fill the prompt templates
+    ret = {key: case[key] for key in CI_ELEMENTS}
+    ret['clauses'] = case['followed_articles'] + case['violated_articles']
+    return ret
+
 def read_events(path):
 #real.csv
+    import pandas as pd
     events = pd.read_csv(path)
     return events
 
@@ -55,12 +163,9 @@ def read_kb(path):
     return kb
 
 def log(message, path):
-    if not os.path.exists(path):
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(message+"\n")
-    else:
-        with open(path, "a", encoding="utf-8") as f:
-            f.write(message+"\n")
+    ### append mode creates the file, the per-case records go through results.ResultWriter
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(message+"\n")
 
 
 def label_transform(label):
@@ -75,11 +180,13 @@ def label_transform(label):
     return ret
 
 class Trie:
+    ### compiled once for every node and lookup
+    pattern = re.compile(r"[0-9]+\.[0-9]+|\([0-9A-Za-zivx]+\)")
+
     def __init__(self, id, content):
         self.id = id
         self.content = content
         self.sons = {}
-        self.pattern = r"[0-9]+\.[0-9]+|\([0-9A-Za-zivx]+\)"
         #self.pattern = r"[0-9]+\.[0-9]+(\([0-9A-Za-zivx]+\))*|recital\s\d+|article\s\d+(\(\d+\))?|eu_ai_act\.chapter\d+(\.section\d+-\d+)?\.article\d+(\.\w+)*"
     def add_sons(self, contents):
 
@@ -88,7 +195,7 @@ class Trie:
         cur_trie = self
         for content in contents:
             if not content: continue
-            search = re.search(self.pattern, content)
+            search = self.pattern.search(content)
             if search is not None:
                 start, end = search.span()
                 id = content[start:end]
@@ -104,7 +211,7 @@ class Trie:
         ret_content = []
         cur_trie = self
         while True:
-            search = re.search(self.pattern, id_seq)
+            search = self.pattern.search(id_seq)
             if search is None:
                 break
             start, end = search.span()
@@ -121,7 +228,7 @@ class Trie:
         # ret_content = []
         cur_trie = self
         while True:
-            search = re.search(self.pattern, id_seq)
+            search = self.pattern.search(id_seq)
             if search is None:
                 break
             start, end = search.span()
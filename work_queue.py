@@ -0,0 +1,169 @@
+'''
+SQLite work queue shared by the worker processes of a run, so that workers can be added or killed mid-run.
+
+Every case of a (strategy, config_hash, domain) is a row of the queue. A worker leases a micro-batch of pending
+cases for lease_seconds, runs them and writes their records back in one transaction that also marks them done.
+The cases of a killed worker become pending again once its lease expires; a case is only recorded once, the
+record of a worker whose lease expired is dropped if another worker completed the case first.
+
+    python direct_answer.py --queue_path logs/run.db --log_path logs/run.worker0.txt ...   (as many as needed)
+    python work_queue.py logs/run.db logs/run.jsonl                                       (export the records)
+'''
+import json
+import os
+import socket
+import sqlite3
+import time
+
+import config
+
+### seconds between two looks at the queue while the last cases are leased by other workers
+POLL_SECONDS = 5.0
+
+
+class WorkQueue:
+    '''
+    The queue of the cases of one run, also the sink of their records (same write/flush/close interface as
+    results.ResultWriter).
+    path: str, the SQLite database shared by the workers
+    strategy, config_id: the driver strategy and results.config_hash of the run, workers of other runs do not mix
+    lease_seconds: float, how long a worker holds its leased cases, longer than the slowest micro-batch
+    '''
+    def __init__(self, path, strategy, config_id, lease_seconds=config.QUEUE_LEASE_SECONDS, worker=None):
+        self.path = path
+        self.strategy = strategy
+        self.config = config_id
+        self.lease_seconds = lease_seconds
+        self.worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+        self.buffer = []
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        ### transactions are explicit, BEGIN IMMEDIATE takes the write lock before reading the cases to lease
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cases "
+                          "(strategy TEXT NOT NULL, config TEXT NOT NULL, domain TEXT NOT NULL, id INTEGER NOT NULL, "
+                          "status TEXT NOT NULL, worker TEXT, lease_until REAL, attempts INTEGER NOT NULL, "
+                          "record TEXT, PRIMARY KEY (strategy, config, domain, id))")
+
+    def transaction(self, fn, *args):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            ret = fn(*args)
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        return ret
+
+    def enqueue(self, domain, ids):
+        ### the first worker of a run fills the queue, the others find the cases already there
+        rows = [(self.strategy, self.config, domain, i) for i in ids]
+        self.transaction(self.conn.executemany,
+                         "INSERT OR IGNORE INTO cases (strategy, config, domain, id, status, attempts) "
+                         "VALUES (?, ?, ?, ?, 'pending', 0)", rows)
+
+    def _lease(self, domain, n):
+        now = time.time()
+        ids = [i for i, in self.conn.execute(
+            "SELECT id FROM cases WHERE strategy = ? AND config = ? AND domain = ? "
+            "AND (status = 'pending' OR (status = 'leased' AND lease_until < ?)) ORDER BY id LIMIT ?",
+            (self.strategy, self.config, domain, now, n))]
+        self.conn.executemany(
+            "UPDATE cases SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+            "WHERE strategy = ? AND config = ? AND domain = ? AND id = ?",
+            [(self.worker, now + self.lease_seconds, self.strategy, self.config, domain, i) for i in ids])
+        return ids
+
+    def lease(self, domain, n):
+        '''
+        Up to n case ids of domain, pending or whose lease expired, now leased by this worker.
+        '''
+        return self.transaction(self._lease, domain, n)
+
+    def wait_time(self, domain):
+        '''
+        Seconds to wait before cases of domain may be leased again, None once every case is done.
+        '''
+        row = self.conn.execute(
+            "SELECT COUNT(*), MIN(CASE WHEN status = 'leased' THEN lease_until END) FROM cases "
+            "WHERE strategy = ? AND config = ? AND domain = ? AND status != 'done'",
+            (self.strategy, self.config, domain)).fetchone()
+        if not row[0]:
+            return None
+        if row[1] is None:
+            return 0.0
+        return min(max(row[1] - time.time(), 0.0), POLL_SECONDS)
+
+    def batches(self, domain, ids, batch_size):
+        '''
+        Micro-batches of the case ids leased by this worker, until every case of ids is done by some worker.
+        '''
+        self.enqueue(domain, ids)
+        while True:
+            case_ids = self.lease(domain, batch_size)
+            if case_ids:
+                yield case_ids
+                continue
+            wait = self.wait_time(domain)
+            if wait is None:
+                return
+            time.sleep(wait)
+
+    def write(self, record):
+        self.buffer.append(record)
+
+    def _complete(self, records):
+        for record in records:
+            self.conn.execute(
+                "UPDATE cases SET status = 'done', worker = ?, record = ? "
+                "WHERE strategy = ? AND config = ? AND domain = ? AND id = ? AND status != 'done'",
+                (self.worker, json.dumps(record, ensure_ascii=False, default=str),
+                 self.strategy, self.config, record["domain"], record["id"]))
+
+    def flush(self):
+        ### the records of a micro-batch are committed together, a worker killed before its flush leaves them leased
+        if self.buffer:
+            self.transaction(self._complete, self.buffer)
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def records(self, domain=None):
+        '''
+        The records written to the queue by the workers of the run, by domain and case id.
+        '''
+        query = "SELECT record FROM cases WHERE strategy = ? AND config = ? AND status = 'done'"
+        params = [self.strategy, self.config]
+        if domain is not None:
+            query += " AND domain = ?"
+            params.append(domain)
+        return [json.loads(record) for record, in self.conn.execute(query + " ORDER BY domain, id", params)]
+
+    def stats(self):
+        counts = dict(self.conn.execute("SELECT status, COUNT(*) FROM cases WHERE strategy = ? AND config = ? "
+                                        "GROUP BY status", (self.strategy, self.config)))
+        retried = self.conn.execute("SELECT COUNT(*) FROM cases WHERE strategy = ? AND config = ? AND attempts > 1",
+                                    (self.strategy, self.config)).fetchone()[0]
+        return dict(counts, retried=retried)
+
+
+def export_records(path, results_path):
+    '''
+    Writes the records of every run of the queue at path to the results file results_path.
+    '''
+    from results import ResultWriter
+    conn = sqlite3.connect(path, timeout=60)
+    with ResultWriter(results_path) as writer:
+        for record, in conn.execute("SELECT record FROM cases WHERE status = 'done' "
+                                    "ORDER BY strategy, config, domain, id"):
+            writer.write(json.loads(record))
+    conn.close()
+
+
+if __name__ == '__main__':
+    ### python work_queue.py logs/run.db logs/run.jsonl: the records of the queue, for results.py and the analyses
+    import sys
+    export_records(sys.argv[1], sys.argv[2])